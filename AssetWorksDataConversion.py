@@ -5,6 +5,12 @@
 ## NAD_1983_StatePlane_Virginia_South_FIPS_4502_Feet to WGS_1984 and thenperforms additional tasks on the
 ## pressurized mains followed by changing the privileges on each feature class in the dataset.
 ##
+## After the first run, only the rows added, edited or deleted since the last run are converted, and only
+## the NetworkSegmentIDs whose mains changed are merged again.  Run with /Full to convert everything.
+##
+## The vertices of the pressurized mains are also exported to CSV files, partitioned by SegmentID range, for the
+## AssetWorks interface to bulk load.
+##
 
 ############################################################################
 ############################################################################
@@ -50,8 +56,302 @@
 ############################################################################
 
 import arcpy, time, datetime, string
+import hashlib, itertools, json, os, shutil, subprocess, sys
+import numpy
+import ProjectionService
 from arcpy import env
 
+## Functions
+
+def ReadRows(fc, fields):
+    ## Return {GlobalID: [edit date, other fields...]} for every row of fc
+    with arcpy.da.SearchCursor(fc, ["GlobalID", edit_date_field] + fields) as cursor:
+        return dict((row[0], [str(row[1])] + list(row[2:])) for row in cursor)
+
+def ChangedRows(previous, current):
+    ## Return the GlobalIDs of the rows added, edited or deleted since previous
+    return sorted([g for g in current if previous.get(g) != current[g]] + [g for g in previous if g not in current])
+
+def SQLValue(value):
+    if isinstance(value, basestring):
+        return "'%s'" % value.replace("'", "''")
+    return str(value)
+
+def WhereIn(field, values):
+    ## Return where clauses selecting the rows whose field has one of values, at most 500 values per clause
+    clauses = []
+    if None in values:
+        clauses.append("%s IS NULL" % field)
+    values = [v for v in values if v is not None]
+    for i in range(0, len(values), 500):
+        clauses.append("%s IN (%s)" % (field, ", ".join([SQLValue(v) for v in values[i:i + 500]])))
+    return clauses
+
+def DeleteRows(fc, field, values):
+    ## Delete the rows of fc whose field has one of values
+    count = 0
+    for where in WhereIn(field, values):
+        count += DeleteWhere(fc, where)
+    return count
+
+def DeleteWhere(fc, where):
+    ## Delete the rows of fc selected by where
+    count = 0
+    with arcpy.da.UpdateCursor(fc, ["OID@"], where) as cursor:
+        for row in cursor:
+            cursor.deleteRow()
+            count += 1
+    return count
+
+def AppendRows(source, target, globalIDs):
+    ## Append the rows of source with the given GlobalIDs to target, projecting them to target's spatial reference
+    for where in WhereIn("GlobalID", globalIDs):
+        arcpy.MakeFeatureLayer_management(source, "AppendRows", where)
+        arcpy.Append_management("AppendRows", target, "NO_TEST")
+        arcpy.Delete_management("AppendRows")
+
+def CurrentPrivileges(workspace):
+    ## Return {(class, object or schema name, role): set of permissions} for the privileges granted in the database
+    ##      class = 1 for an object, named owner.name, 3 for a schema.  Names are lower case.
+    result = arcpy.ArcSDESQLExecute(workspace).execute("""
+        SELECT p.class, LOWER(COALESCE(SCHEMA_NAME(o.schema_id) + '.' + o.name, s.name)), LOWER(r.name), p.permission_name
+        FROM sys.database_permissions p
+        JOIN sys.database_principals r ON r.principal_id = p.grantee_principal_id
+        LEFT JOIN sys.objects o ON p.class = 1 AND o.object_id = p.major_id
+        LEFT JOIN sys.schemas s ON p.class = 3 AND s.schema_id = p.major_id
+        WHERE p.state IN ('G', 'W') AND p.class IN (1, 3) AND p.minor_id = 0""")
+    ## ArcSDESQLExecute returns a list for a one-row result, a list of lists otherwise, and True for no rows
+    if not isinstance(result, list):
+        result = []
+    elif result and not isinstance(result[0], list):
+        result = [result]
+    privileges = {}
+    for permissionClass, name, role, permission in result:
+        privileges.setdefault((int(permissionClass), name, role), set()).add(permission)
+    return privileges
+
+edit_permissions = ["INSERT", "UPDATE", "DELETE"]
+
+def PrivilegesDiffer(permissions, view, edit):
+    ## Return True if the permissions differ from the view and edit privileges, as given to ChangePrivileges
+    if view == "GRANT" and "SELECT" not in permissions or view == "REVOKE" and "SELECT" in permissions:
+        return True
+    if edit == "GRANT":
+        return not set(edit_permissions) <= permissions
+    if edit == "REVOKE":
+        return bool(set(edit_permissions) & permissions)
+    return False
+
+def ObjectIDRanges(fc, count):
+    ## Return where clauses splitting the rows of fc into count ObjectID ranges with about the same number of rows
+    oidField = arcpy.Describe(fc).OIDFieldName
+    with arcpy.da.SearchCursor(fc, ["OID@"]) as cursor:
+        oids = sorted([row[0] for row in cursor])
+    bounds = sorted(set([oids[len(oids) * i / count] for i in range(1, count)])) if oids else []
+    if not bounds:
+        return [""]
+    clauses = ["%s < %s" % (oidField, bounds[0])]
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        clauses.append("%s >= %s AND %s < %s" % (oidField, low, oidField, high))
+    clauses.append("%s >= %s" % (oidField, bounds[-1]))
+    return clauses
+
+def ConvertInParallel(tasks):
+    ## Project each task [name, source, where] into its own staging file geodatabase, in a separate
+    ## /ConvertLayer process, at most conversion_workers at a time.
+    ## Return [[name, staged feature class, seconds], ...] in the order of tasks.
+    results = [None] * len(tasks)
+    pending = range(len(tasks))
+    running = []
+    try:
+        while pending or running:
+            while pending and len(running) < conversion_workers:
+                i = pending.pop(0)
+                name, source, where = tasks[i]
+                stagingGDB = os.path.join(stagingLocation, "%s_%s.gdb" % (name, i))
+                log = open(os.path.join(stagingLocation, "%s_%s.log" % (name, i)), "w")
+                process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "/ConvertLayer", source, stagingGDB, name, where],
+                                           stdout=log, stderr=subprocess.STDOUT)
+                running.append([i, process, log, stagingGDB, time.time()])
+            time.sleep(1)
+            for task in running[:]:
+                i, process, log, stagingGDB, startTime = task
+                if process.poll() is None:
+                    continue
+                log.close()
+                running.remove(task)
+                assert process.returncode == 0, "Conversion of %s failed - see %s" % (tasks[i][0], log.name)
+                results[i] = [tasks[i][0], os.path.join(stagingGDB, tasks[i][0]), time.time() - startTime]
+                print "%s projected into staging in %.0f seconds" % (tasks[i][0], results[i][2])
+    finally:
+        for i, process, log, stagingGDB, startTime in running:
+            if process.poll() is None:
+                process.kill()
+            log.close()
+    return results
+
+def PointKey(point):
+    ## Return the key of a line end point in the end point index - its coordinates to 1/10000 foot
+    return (round(point[0], 4), round(point[1], 4))
+
+def MergeLines(lines):
+    ## Stitch together lines (lists of (x, y) points) whose ends meet, and return the merged lines.
+    ## Lines are joined where exactly two line ends meet; where three or more meet, the merged lines
+    ## end, since a single part line cannot branch.
+    ends = {}                                                               # end point -> [line index, ...]
+    for i, line in enumerate(lines):
+        ends.setdefault(PointKey(line[0]), []).append(i)
+        ends.setdefault(PointKey(line[-1]), []).append(i)
+    joined = lambda point: len(ends[PointKey(point)]) == 2
+    used = [False] * len(lines)
+    merged = []
+    ## Start from lines with an end that is not joined, then from what is left - closed loops
+    starts = [i for i, line in enumerate(lines) if not joined(line[0]) or not joined(line[-1])] + range(len(lines))
+    for i in starts:
+        if used[i]:
+            continue
+        used[i] = True
+        chain = list(lines[i])
+        if joined(chain[0]) and not joined(chain[-1]):
+            chain.reverse()
+        while joined(chain[-1]):
+            key = PointKey(chain[-1])
+            following = [j for j in ends[key] if not used[j]]
+            if not following:
+                break
+            used[following[0]] = True
+            line = lines[following[0]]
+            if PointKey(line[0]) != key:
+                line = line[::-1]
+            chain.extend(line[1:])
+        merged.append(chain)
+    return merged
+
+def MergedMains(where):
+    ## Yield [NetworkSegmentID, line] for every merged main of the source mains selected by where - the mains of
+    ## each NetworkSegmentID stitched into single part lines, as Dissolve with SINGLE_PART did.
+    ## The mains are read ordered by NetworkSegmentID, so only one segment's mains are in memory at a time.
+    fields = [dissolve_field, "SHAPE@"]
+    with arcpy.da.SearchCursor(mains, fields, where, sql_clause=(None, "ORDER BY %s" % dissolve_field)) as cursor:
+        for networkSegmentID, rows in itertools.groupby(cursor, lambda row: row[0]):
+            lines = []
+            for row in rows:
+                if row[1] is None:
+                    continue
+                for part in row[1]:
+                    line = [(point.X, point.Y) for point in part if point is not None]
+                    if len(line) > 1:
+                        lines.append(line)
+            for line in MergeLines(lines):
+                yield networkSegmentID, line
+
+def WriteVertices(mergedMains, firstSegmentID, target):
+    ## Write a point for every vertex of the merged mains to target, numbering the mains from firstSegmentID + 1.
+    ## The vertices are written vertex_batch_size at a time, each batch ending with the last vertex of a main.
+    ## Return [[NetworkSegmentID, [SegmentID, ...]], ...]
+    projector = ProjectionService.GetProjector(arcpy.Describe(mains).spatialReference, sr, geographic_transformation)
+    networkSegments = {}
+    segmentID = firstSegmentID
+    segmentIDs, xs, ys = [], [], []
+    for networkSegmentID, line in mergedMains:
+        segmentID += 1
+        networkSegments.setdefault(networkSegmentID, []).append(segmentID)
+        segmentIDs += [segmentID] * len(line)
+        xs += [point[0] for point in line]
+        ys += [point[1] for point in line]
+        if len(segmentIDs) >= vertex_batch_size:
+            WriteVertexBatch(segmentIDs, xs, ys, projector, target)
+            segmentIDs, xs, ys = [], [], []
+    if segmentIDs:
+        WriteVertexBatch(segmentIDs, xs, ys, projector, target)
+    print "Segments written - %s" % (segmentID - firstSegmentID)
+    return [[networkSegmentID, ids] for networkSegmentID, ids in networkSegments.items()]
+
+def WriteVertexBatch(segmentIDs, xs, ys, projector, target):
+    ## Write the given vertices to target
+    ##      Latitude  = Y and Longitude = X, projected from StatePlane to WGS_1984 decimal degrees
+    ##      Example
+    ##      lat = 37.016514     lon = -76.42133
+    vertexCount = len(segmentIDs)
+    vertices = numpy.empty(vertexCount, dtype=[("SegmentID", numpy.int32), ("VertexID", numpy.int32),
+                                               ("Latitude", numpy.float64), ("Longitude", numpy.float64)])
+    vertices["SegmentID"] = segmentIDs
+    vertices["Longitude"], vertices["Latitude"] = projector.Project(xs, ys)
+
+    ## VertexID = 1, 2, 3, ... along each main, numbered by grouping the vertices on SegmentID
+    ##      The vertices of a main do not need to be next to each other, and SegmentIDs do not need to be
+    ##      contiguous or start at 1.  Only an index into the arrays is ordered; the vertices keep their order.
+    ##      Example
+    ##      SegmentID = 7 7 3 7 3 12    VertexID = 1 2 1 3 2 1
+    uniqueIDs, segments = numpy.unique(vertices["SegmentID"], return_inverse=True)
+    bySegment = numpy.argsort(segments, kind="mergesort")                   # stable - keeps vertex order within each main
+    segmentCounts = numpy.bincount(segments)
+    segmentStarts = numpy.cumsum(segmentCounts) - segmentCounts
+    vertices["VertexID"][bySegment] = numpy.arange(vertexCount) - segmentStarts[segments[bySegment]] + 1
+    del uniqueIDs, segments, bySegment
+
+    ## Write the vertices from the arrays, with points at (Longitude, Latitude)
+    ## If target already exists, the vertices are written in memory and then appended to it
+    if arcpy.Exists(target):
+        output = r"in_memory\wPM_Dissolved_Vertices"
+    else:
+        output = target
+    env.configKeyword = config_keyword
+    arcpy.da.NumPyArrayToFeatureClass(vertices, output, ["Longitude", "Latitude"], sr)
+    del env.configKeyword
+    if output != target:
+        arcpy.Append_management(output, target, "NO_TEST")
+        arcpy.Delete_management(output)
+    if exportFromPipeline:
+        ExportVertices(vertices)
+    del vertices
+    print "Vertices written - %s vertices of %s segments" % (vertexCount, len(segmentCounts))
+
+def ExportFile(partition):
+    ## Return the export file of the given SegmentID range - SegmentIDs partition * export_segments_per_file + 1 to
+    ## (partition + 1) * export_segments_per_file
+    return os.path.join(exportLocation, "wPM_Dissolved_Vertices_%06d.csv" % partition)
+
+def ExportVertices(vertices):
+    ## Append the vertices to the export files of their SegmentID ranges
+    partitions = (vertices["SegmentID"] - 1) // export_segments_per_file
+    for partition in numpy.unique(partitions):
+        path = ExportFile(partition)
+        newFile = not os.path.exists(path)
+        f = open(path, "ab")
+        if newFile:
+            f.write(",".join([name for name, dtype, fmt in export_columns]) + "\r\n")
+        numpy.savetxt(f, vertices[partitions == partition], fmt=[fmt for name, dtype, fmt in export_columns],
+                      delimiter=",", newline="\r\n")
+        f.close()
+
+def RewriteExportFiles(segmentIDs):
+    ## Rewrite, from wPM_Dissolved_Vertices, the export files of the SegmentID ranges containing segmentIDs
+    for partition in sorted(set([(segmentID - 1) // export_segments_per_file for segmentID in segmentIDs])):
+        if os.path.exists(ExportFile(partition)):
+            os.remove(ExportFile(partition))
+        where = "SegmentID > %s AND SegmentID <= %s" % (partition * export_segments_per_file, (partition + 1) * export_segments_per_file)
+        vertices = arcpy.da.FeatureClassToNumPyArray(wPM_Dissolved_Vertices, [name for name, dtype, fmt in export_columns], where,
+                                                     sql_clause=(None, "ORDER BY SegmentID, VertexID"))
+        if len(vertices):
+            ExportVertices(vertices)
+
+def WriteExportSchema():
+    ## Describe the columns of the export files, and the SegmentID range of each file
+    files = []
+    for fileName in sorted(os.listdir(exportLocation)):
+        if fileName.endswith(".csv"):
+            partition = int(fileName[len("wPM_Dissolved_Vertices_"):-len(".csv")])
+            files.append({"file": fileName,
+                          "firstSegmentID": partition * export_segments_per_file + 1,
+                          "lastSegmentID": (partition + 1) * export_segments_per_file})
+    schema = {"columns": [{"name": name, "type": dtype} for name, dtype, fmt in export_columns],
+              "header": True, "delimiter": ",", "orderedBy": ["SegmentID", "VertexID"],
+              "segmentsPerFile": export_segments_per_file, "files": files}
+    f = open(os.path.join(exportLocation, "wPM_Dissolved_Vertices.schema.json"), "w")
+    json.dump(schema, f, indent=2)
+    f.close()
+
 ## Start
 ExecutionStartTime = datetime.datetime.now()
 print "Started: %s" % ExecutionStartTime.strftime('%A, %B %d, %Y %I:%M:%S %p')
@@ -69,202 +369,325 @@ hydrants    =  r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConve
 meters      =  r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\Conway_sdeVector_sdeViewer.sde\sdeVector.SDEDATAOWNER.WaterUtility\sdeVector.SDEDATAOWNER.wServiceLocation"
 mains       =  r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\Conway_sdeVector_sdeViewer.sde\sdeVector.SDEDATAOWNER.WaterUtility\sdeVector.SDEDATAOWNER.wPressurizedMain"
 
-## Delete DataConversion Dataset if it exists
-if arcpy.Exists(r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\DataConversion"):
-    arcpy.Delete_management(r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\DataConversion")
-    print "Old DataConversion Dataset deleted"
+## Conversion state
+##      The GlobalID and edit date of every source row converted by the last run, and the SegmentIDs
+##      written for each NetworkSegmentID.  When it exists, only the rows that changed since the last run
+##      are converted, unless the script is run with /Full.
+stateFile = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\State\AssetWorksDataConversion.json"
+edit_date_field = "last_edited_date"
 
-## Create Dataset with desired spatial reference - WGS
-## http://resources.arcgis.com/en/help/arcgis-rest-api/index.html#/Projected_coordinate_systems/02r3000000vt000000/
-sr = arcpy.SpatialReference(4326)
-##sr = arcpy.SpatialReference(r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Data\Shapefiles\CoordinateFile.prj")
-arcpy.CreateFeatureDataset_management(r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde", "DataConversion", sr)
-print "DataConversion dataset created"
+## Converted rows keep the GlobalIDs of the source rows, so that they can be found again
+env.preserveGlobalIds = True
 
-## Make Copy of original sde files to DQSQL_AssetWorksGIS_sdeDataOwner.sde\DataConversion
 outLocation =       r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\DataConversion"
+convertedLocation = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\AssetWorksGIS.SDEDATAOWNER.DataConversion"
+wPM_Dissolved_Vertices = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\AssetWorksGIS.SDEDATAOWNER.DataConversion\AssetWorksGIS.SDEDATAOWNER.wPM_Dissolved_Vertices"
 
 copied_valves   =   "SystemValve"
 copied_hydrants =   "Hydrant"
 copied_meters   =   "wServiceLocation"
 copied_mains    =   "wPressurizedMain"
 
-config_keyword = "GEOGRAPHY"
+sources = [[valves, copied_valves], [hydrants, copied_hydrants], [meters, copied_meters], [mains, copied_mains]]
 
-arcpy.FeatureClassToFeatureClass_conversion(valves, outLocation, copied_valves, "", "", config_keyword)
-print "SystemValve converted"
-arcpy.FeatureClassToFeatureClass_conversion(hydrants, outLocation, copied_hydrants, "", "", config_keyword)
-print "Hydrant converted"
-arcpy.FeatureClassToFeatureClass_conversion(meters, outLocation, copied_meters, "", "", config_keyword)
-print "wServiceLocation converted"
-arcpy.FeatureClassToFeatureClass_conversion(mains, outLocation, copied_mains, "", "", config_keyword)
-print "wPressurizedMain converted"
-
-del env.workspace
-env.workspace = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\DataConversion"
-
-## Dissolve Tool on the wPressurizedMain feature class using NetworkSegmentID - single part not multipart
-in_feature_class =  "wPressurizedMain"
-out_feature_class = "wPressurizedMain_Dissolved"
+config_keyword = "GEOGRAPHY"
+sr = ProjectionService.GetSpatialReference(4326)
+geographic_transformation = ""                                              # NAD_1983 to WGS_1984 without a datum shift, as the tools did before
+env.geographicTransformations = geographic_transformation
 dissolve_field =    "NetworkSegmentID"                                      ################## Was "District"...Running a test using this fields..."NetworkSegmentID" will be the actual field used ##################
-multi_part =        "SINGLE_PART"
-
-arcpy.Dissolve_management(in_feature_class, out_feature_class, dissolve_field, "", multi_part)
-print "Dissolve complete of wPressurizedMains"
-
-## Feature Vertices to Points
-inFeatures =        "wPressurizedMain_Dissolved"
-outFeatureClass =   "wPM_Dissolved_Points"
-arcpy.FeatureVerticesToPoints_management(inFeatures, outFeatureClass, "ALL")
-print "Feature Vertices To Points complete"
-
-## Add Lat/Long Fields
-inFeature =         "wPM_Dissolved_Points"
-fieldName1 =        "Latitude"
-fieldName2 =        "Longitude"
-fieldType =         "DOUBLE"
-arcpy.AddField_management(inFeature, fieldName1, fieldType)
-arcpy.AddField_management(inFeature, fieldName2, fieldType)
-print "Lat/Long fields added"
-
-## Execute CalculateField of Lat/Long Fields
-##      Example
-##      lat = 37.016514     # !shape.extent.YMax!
-##      lon x Coord = -76.42133 or -8522343.5726    # !shape.extent.XMax!
-
-expression1 = "{0}".format("!SHAPE.extent.YMax!")
-expression2 = "{0}".format("!SHAPE.extent.XMax!")
+vertex_batch_size = 250000                                                  # Vertices written at a time.
+
+## Export for AssetWorks
+##      wPM_Dissolved_Vertices is also written to CSV files of export_segments_per_file SegmentIDs each, described by
+##      wPM_Dissolved_Vertices.schema.json, so that the interface can bulk load the vertices instead of querying SDE.
+exportLocation = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Export\wPM_Dissolved_Vertices"
+export_segments_per_file = 10000
+export_columns = [["SegmentID", "int32", "%d"], ["VertexID", "int32", "%d"],  # [name, type, format]
+                  ["Latitude", "float64", "%.9f"], ["Longitude", "float64", "%.9f"]]
+exportFromPipeline = False                                                  # True while WriteVertices writes the export files
+
+## Parallel conversion
+##      The source layers are projected into staging file geodatabases by conversion_workers processes at a time,
+##      wServiceLocation in meter_chunks ObjectID ranges, and then copied or appended into DataConversion.
+stagingLocation = os.path.join(os.environ["TEMP"], "AssetWorksDataConversion")
+conversion_workers = 4
+meter_chunks = 3
+layerTimings = []                                                           # [name, projection seconds, append seconds]
+
+## When run as a /ConvertLayer process, project one source layer into staging and stop
+if len(sys.argv) > 1 and sys.argv[1].lower() == "/convertlayer":
+    source, stagingGDB, name, where = sys.argv[2:6]
+    env.outputCoordinateSystem = sr
+    arcpy.CreateFileGDB_management(os.path.dirname(stagingGDB), os.path.basename(stagingGDB))
+    arcpy.FeatureClassToFeatureClass_conversion(source, stagingGDB, name, where)
+    print "%s projected into %s" % (name, stagingGDB)
+    sys.exit(0)
+
+## Stages
+##      The conversion runs as named stages.  After each stage, the conversion state is saved with a hash of the
+##      stage's inputs, so that a rerun skips the stages whose inputs have not changed and resumes at the stage
+##      that failed.
+##          Convert     - project the source layers into DataConversion         inputs: source GlobalIDs and edit dates
+##          Vertices    - merge the mains and write wPM_Dissolved_Vertices      inputs: converted wPressurizedMain rows
+##          Export      - rewrite the export files of the changed segments      inputs: SegmentIDs written
+##          Privileges  - give the roles their privileges                       inputs: feature classes, privileges, conversion
+##      A stage that fails part way leaves its output half written, and is run again by the next run.  So each stage
+##      first deletes what a failed run of it may have left - the whole output it rebuilds, or the rows or files it
+##      is about to write - and a full rebuild is recorded in the state before it starts, so that it is not resumed
+##      as an incremental update.
+
+def InputHash(inputs):
+    return hashlib.md5(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def SaveState():
+    f = open(stateFile + ".new", "w")
+    json.dump(state, f)
+    f.close()
+    if os.path.exists(stateFile):
+        os.remove(stateFile)
+    os.rename(stateFile + ".new", stateFile)
+
+def RunStage(name, inputs, stage):
+    ## Run stage, unless it was completed with the same inputs.  Save the conversion state when it is complete.
+    inputHash = InputHash(inputs)
+    if state["stages"].get(name, {}).get("inputHash") == inputHash:
+        print "%s stage skipped - inputs unchanged since %s" % (name, state["stages"][name]["completed"])
+        return
+    print "%s stage started" % name
+    startTime = time.time()
+    stage()
+    state["stages"][name] = {"inputHash": inputHash, "seconds": int(time.time() - startTime),
+                             "completed": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    SaveState()
+    print "%s stage complete" % name
+
+def ConvertStage():
+    if not state["rows"] or not arcpy.Exists(outLocation):
+        print "Full conversion"
+
+        ## Until the dataset is complete, the next run must convert everything again
+        state["rows"] = {}
+        state["vertexRows"] = None
+        state["stages"].pop("Vertices", None)
+        SaveState()
+
+        ## Delete DataConversion Dataset if it exists
+        if arcpy.Exists(outLocation):
+            arcpy.Delete_management(outLocation)
+            print "Old DataConversion Dataset deleted"
+
+        ## Create Dataset with desired spatial reference - WGS
+        ## http://resources.arcgis.com/en/help/arcgis-rest-api/index.html#/Projected_coordinate_systems/02r3000000vt000000/
+        ##sr = arcpy.SpatialReference(r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Data\Shapefiles\CoordinateFile.prj")
+        arcpy.CreateFeatureDataset_management(r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde", "DataConversion", sr)
+        print "DataConversion dataset created"
+
+        ## Make Copy of original sde files to DQSQL_AssetWorksGIS_sdeDataOwner.sde\DataConversion
+        ## Project every layer into staging in parallel, then copy the staged layers into the dataset
+        if os.path.exists(stagingLocation):
+            shutil.rmtree(stagingLocation)
+        os.makedirs(stagingLocation)
+        tasks = []
+        for source, name in sources:
+            if name == copied_meters:
+                tasks += [[name, source, where] for where in ObjectIDRanges(source, meter_chunks)]
+            else:
+                tasks.append([name, source, ""])
+        staged = ConvertInParallel(tasks)
+        for source, name in sources:
+            startTime = time.time()
+            stagedLayers = [fc for n, fc, seconds in staged if n == name]
+            arcpy.FeatureClassToFeatureClass_conversion(stagedLayers[0], outLocation, name, "", "", config_keyword)
+            for fc in stagedLayers[1:]:
+                arcpy.Append_management(fc, os.path.join(outLocation, name), "NO_TEST")
+            layerTimings.append([name, max([seconds for n, fc, seconds in staged if n == name]), time.time() - startTime])
+            print "%s converted" % name
+        shutil.rmtree(stagingLocation)
+
+        ## wPM_Dissolved_Vertices was deleted with the dataset, so all of the vertices must be written again
+        state["vertexRows"] = None
+        state["stages"].pop("Vertices", None)
+
+    else:
+        print "Incremental conversion of rows changed since the last run"
+
+        ## Replace the converted rows that were added, edited or deleted in the source.  The rows appended by a
+        ## failed run are among the changed rows, so they are deleted again before they are appended.
+        for source, name in sources:
+            startTime = time.time()
+            target = os.path.join(convertedLocation, "AssetWorksGIS.SDEDATAOWNER.%s" % name)
+            changed = ChangedRows(state["rows"][name], sourceRows[name])
+            deleted = DeleteRows(target, "GlobalID", changed)
+            AppendRows(source, target, [g for g in changed if g in sourceRows[name]])
+            layerTimings.append([name, 0, time.time() - startTime])
+            print "%s converted - %s changed rows, %s replaced" % (name, len(changed), deleted)
+
+    state["rows"] = sourceRows
+
+def VerticesStage():
+    global exportFromPipeline
+    mainsRows = state["rows"][copied_mains]
+    if state["vertexRows"] is None or not arcpy.Exists(wPM_Dissolved_Vertices):
+        ## Merge the source mains by NetworkSegmentID into single part lines - not multipart - and stream them
+        ## to WriteVertices, which projects their vertices from StatePlane to WGS_1984 and exports them.
+        ## Until they are all written, the next run must write all of the vertices again.
+        state["vertexRows"] = None
+        SaveState()
+        if arcpy.Exists(wPM_Dissolved_Vertices):
+            arcpy.Delete_management(wPM_Dissolved_Vertices)
+        if os.path.exists(exportLocation):
+            shutil.rmtree(exportLocation)
+        os.makedirs(exportLocation)
+        exportFromPipeline = True
+        state["segments"] = WriteVertices(MergedMains(None), 0, wPM_Dissolved_Vertices)
+        exportFromPipeline = False
+        WriteExportSchema()
+        state["exportPending"] = []
+        print "Merge complete of wPressurizedMains"
+        CheckVertices()
+
+    else:
+        ## Merge and extract the vertices of only the NetworkSegmentIDs whose mains changed since the vertices
+        ## were written, either the segment the main was in or the segment it is in now
+        affectedSegments = set()
+        for g in ChangedRows(state["vertexRows"], mainsRows):
+            for rows in [state["vertexRows"], mainsRows]:
+                if g in rows:
+                    affectedSegments.add(rows[g][1])
+        affectedSegments = sorted(affectedSegments)
+        segments = dict((networkSegmentID, segmentIDs) for networkSegmentID, segmentIDs in state["segments"])
+
+        if affectedSegments:
+            oldSegmentIDs = sorted(itertools.chain.from_iterable([segments.get(n, []) for n in affectedSegments]))
+            deleted = DeleteRows(wPM_Dissolved_Vertices, "SegmentID", oldSegmentIDs)
+            print "Deleted %s vertices of %s changed segments" % (deleted, len(affectedSegments))
+
+            ## New SegmentIDs follow the highest SegmentID written so far.  Rows above it were left by a run that
+            ## failed while writing them, and would be written again, so they are deleted first.
+            firstSegmentID = max([0] + list(itertools.chain.from_iterable([segmentIDs for n, segmentIDs in state["segments"]])))
+            deleted = DeleteWhere(wPM_Dissolved_Vertices, "SegmentID > %s" % firstSegmentID)
+            if deleted:
+                print "Deleted %s vertices left by a failed run" % deleted
+            mergedMains = MergedMains(" OR ".join(WhereIn(dissolve_field, affectedSegments)))
+            newSegments = WriteVertices(mergedMains, firstSegmentID, wPM_Dissolved_Vertices)
+            state["segments"] = [[n, segmentIDs] for n, segmentIDs in segments.items() if n not in affectedSegments] + newSegments
+            state["exportPending"] = sorted(set(itertools.chain(state["exportPending"], oldSegmentIDs,
+                                                           *[segmentIDs for n, segmentIDs in newSegments])))
+            print "Merge complete of changed wPressurizedMains"
+            CheckVertices(oldSegmentIDs + list(itertools.chain.from_iterable([segmentIDs for n, segmentIDs in newSegments])))
 
-arcpy.CalculateField_management(inFeature, fieldName1, expression1, "PYTHON_9.3")
-arcpy.CalculateField_management(inFeature, fieldName2, expression2, "PYTHON_9.3")
-
-print "Lat/Long fields calculated"
-
-del env.workspace
-env.workspace = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde"
-
-## Convert Coordinate Notation with SHAPE as input field.
-input_table = "wPM_Dissolved_Points"
-output_points = "wPM_Points_Converted"
-x_field = "Latitude"
-y_field = "Longitude"
-input_format = "SHAPE" 
-output_format = "DD_2" 
-id_field = ""
-spatial_ref = arcpy.SpatialReference(4326)
-
-arcpy.ConvertCoordinateNotation_management(input_table, output_points, x_field, y_field, input_format, output_format, id_field, spatial_ref)
-print "Lat/Long Converted"
-
-## Field Calculate
-input_FeatureClass = "wPM_Points_Converted"
-expression3 = "{0}".format("!DDLat![:-1]") 
-expression4 = "{0}".format("!DDLon![1:-1]")
-expression5 = "{0}".format("- !Longitude!")
-
-arcpy.CalculateField_management(input_FeatureClass, "Latitude", expression3, "PYTHON_9.3")
-print "Latitude Field Calculation Complete"
-arcpy.CalculateField_management(input_FeatureClass, "Longitude", expression4, "PYTHON_9.3")
-arcpy.CalculateField_management(input_FeatureClass, "Longitude", expression5, "PYTHON_9.3")
-print "Longitude Field Calculation Complete"
-
-## Delete fields that were created from Coordinate Notation
-arcpy.DeleteField_management(input_FeatureClass,  ["DDLat", "DDLon"])
-print "Deleted fields that were created from Coordinate Notation"
-
-## Delete wPM_Dissolved_Points in dataset, Copy file to dataset, deleted file outside of dataset
-deleteFC_1 =    r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\AssetWorksGIS.SDEDATAOWNER.DataConversion\AssetWorksGIS.SDEDATAOWNER.wPM_Dissolved_Points"
-copyFC_input =  "AssetWorksGIS.SDEDATAOWNER.wPM_Points_Converted"
-wPM_Dissolved_Vertices = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\AssetWorksGIS.SDEDATAOWNER.DataConversion\AssetWorksGIS.SDEDATAOWNER.wPM_Dissolved_Vertices"
-
-arcpy.Delete_management(deleteFC_1)
-print "Deleted wPM_Dissolved_Points in dataset"
-arcpy.Copy_management(copyFC_input, wPM_Dissolved_Vertices)
-print "Copied wPM_Points_Converted into dataset as wPM_Dissolved_Vertices"
-arcpy.Delete_management(copyFC_input)
-print "Deleted wPM_Points_Converted"
-
-## Delete field NetworkSegmentID from wPM_Dissolved_Vertices
-arcpy.DeleteField_management(wPM_Dissolved_Vertices, "NetworkSegmentID")
-print "Deleted field - NetworkSegmentID"
-
-## Add field SegmentID (Long)
-arcpy.AddField_management(wPM_Dissolved_Vertices, "SegmentID", "LONG")
-print "Added field - SegmentID"
-
-## Field Calculate SegmentID
-expression = "{0}".format("!ORIG_FID!")
-arcpy.CalculateField_management(wPM_Dissolved_Vertices, "SegmentID", expression, "PYTHON_9.3")
-print "SegmentID Field Calculation Complete"
-arcpy.DeleteField_management(wPM_Dissolved_Vertices, "ORIG_FID")
-print "Deleted field - ORIG_FID"
-
-## Add field VertexID (Long)
-arcpy.AddField_management(wPM_Dissolved_Vertices, "VertexID", "LONG")
-print "Added field - VertexID"
-
-## Sort Ascending creating a new file
-in_dataset = wPM_Dissolved_Vertices
-out_dataset = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\AssetWorksGIS.SDEDATAOWNER.DataConversion\AssetWorksGIS.SDEDATAOWNER.wPM_Dissolved_Vertices_Sorted"
-# Order features first by location (Shape) and then by WELL_YIELD
-sort_fields = [["SegmentID", "ASCENDING"]]
-# execute the function
-arcpy.Sort_management(in_dataset, out_dataset, sort_fields)
-print "wPM_Dissolved_Vertices sorted"
-
-featureclass = out_dataset
-fields = ['SegmentID', 'VertexID']
-# Create update cursor for feature class 
-with arcpy.da.UpdateCursor(featureclass, fields) as cursor:
-    # For each row, evaluate the SegmentID value (index position of 0) and update VertexID (index position of 1)
-    x = 1
-    y = 1
-    for row in cursor:
-        if row[0] == x:
-            row[1] = y
-            y += 1
         else:
-            x += 1
-            y = 1
-            if row[0] == x:
-                row[1] = y
-                y += 1
-
-        # Update the cursor with the updated list
-        cursor.updateRow(row)
-
-del cursor
-print "Cursor complete"
-
-# Delete original wPM_Dissolved_Vertices
-arcpy.Delete_management(wPM_Dissolved_Vertices)
-print "Deleted original wPM_Dissolved_Vertices"
-# Copy the sorted wPM_Dissolved_Vertices and then delete the original
-fc = out_dataset
-outfc = r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\AssetWorksGIS.SDEDATAOWNER.DataConversion\AssetWorksGIS.SDEDATAOWNER.wPM_Dissolved_Vertices"
-arcpy.CopyFeatures_management(fc, outfc)
-print "Copied sorted wPM_Dissolved_Vertices"
-arcpy.Delete_management(fc)
-print "Deleted sorted wPM_Dissolved_Vertices"
+            print "No wPressurizedMains changed - vertices unchanged"
+
+    state["vertexRows"] = mainsRows
+
+def CheckVertices(checkedIDs=None):
+    ## Check that wPM_Dissolved_Vertices has the rows a clean run would write - the vertices of the SegmentIDs in the
+    ## conversion state, each vertex once - and none left by a failed run.  Called only after vertices were written;
+    ## with checkedIDs, only the rows of those SegmentIDs and any above the highest SegmentID in the state are read,
+    ## not the whole feature class.
+    stateIDs = list(itertools.chain.from_iterable([ids for n, ids in state["segments"]]))
+    if checkedIDs is None:
+        where = ""
+        expected = numpy.unique(stateIDs)
+    else:
+        where = " OR ".join(WhereIn("SegmentID", checkedIDs) + ["SegmentID > %s" % max([0] + stateIDs)])
+        expected = numpy.unique(sorted(set(checkedIDs) & set(stateIDs)))
+    vertices = arcpy.da.FeatureClassToNumPyArray(wPM_Dissolved_Vertices, ["SegmentID", "VertexID"], where)
+    segmentIDs = numpy.unique(vertices["SegmentID"])
+    assert numpy.array_equal(segmentIDs, expected), \
+        "wPM_Dissolved_Vertices has %s SegmentIDs, the conversion state %s - run with /Full" % (len(segmentIDs), len(expected))
+    keys = vertices["SegmentID"].astype(numpy.int64) * 2 ** 32 + vertices["VertexID"]
+    assert len(numpy.unique(keys)) == len(keys), \
+        "wPM_Dissolved_Vertices has %s duplicate vertices - run with /Full" % (len(keys) - len(numpy.unique(keys)))
+    print "Vertices checked - %s vertices of %s segments" % (len(vertices), len(segmentIDs))
+
+def ExportStage():
+    ## Rewrite the export files of the changed segments, or all of them if they have not been exported.
+    ## The schema is written last, so without it the files are incomplete and are all written again.
+    if not os.path.exists(os.path.join(exportLocation, "wPM_Dissolved_Vertices.schema.json")):
+        if os.path.exists(exportLocation):
+            shutil.rmtree(exportLocation)
+        os.makedirs(exportLocation)
+        RewriteExportFiles(list(itertools.chain.from_iterable([segmentIDs for n, segmentIDs in state["segments"]])))
+    elif state["exportPending"]:
+        RewriteExportFiles(state["exportPending"])
+    state["exportPending"] = []
+    WriteExportSchema()
+    print "Vertices exported to %s" % exportLocation
 
 ## Execute ChangePrivileges
+##      Compare the privileges each role should have with the privileges it has, and change the privileges of
+##      only the feature classes that differ, in one ChangePrivileges call per role.
+##      With privilege_model = "SCHEMA", the privileges are granted once on the SDEDATAOWNER schema instead,
+##      so feature classes added to the dataset later need no grants of their own.
 dataset =       r"\\arctic\gis_data\GIS_Private\DataResources\AssetworksDataConversion\Interfaces\DQSQL_AssetWorksGIS_sdeDataOwner.sde\DataConversion"
-user_admin =    "gis_administrator"
-user_viewer =   "gis_viewer"
-view =          "GRANT"
-edit1 =         "GRANT"
-edit2 =         "REVOKE"
-
-fclist = arcpy.ListFeatureClasses("","",dataset)
-
-for fc in fclist:
-    arcpy.ChangePrivileges_management(fc, user_admin, view, edit1)
-    arcpy.ChangePrivileges_management(fc, user_viewer, view, edit2)
-
-print "Privilege changes successful"
+schema =        "SDEDATAOWNER"
+privilege_model = "OBJECT"                                                  # "OBJECT" or "SCHEMA"
+privileges = [["gis_administrator", "GRANT", "GRANT"],                      # [role, view, edit]
+              ["gis_viewer",        "GRANT", "REVOKE"]]
+
+def PrivilegesStage():
+    fclist = arcpy.ListFeatureClasses("","",dataset)
+    current = CurrentPrivileges(env.workspace)
+
+    for role, view, edit in privileges:
+        schemaPermissions = current.get((3, schema.lower(), role.lower()), set())
+        if privilege_model == "SCHEMA" and PrivilegesDiffer(schemaPermissions, view, edit):
+            sql = arcpy.ArcSDESQLExecute(env.workspace)
+            for permissions, change in [[["SELECT"], view], [edit_permissions, edit]]:
+                if change == "GRANT":
+                    sql.execute("GRANT %s ON SCHEMA::%s TO %s" % (", ".join(permissions), schema, role))
+                elif change == "REVOKE":
+                    sql.execute("REVOKE %s ON SCHEMA::%s FROM %s" % (", ".join(permissions), schema, role))
+            print "Privileges of %s changed on schema %s" % (role, schema)
+            schemaPermissions = set()
+            if view == "GRANT":
+                schemaPermissions |= set(["SELECT"])
+            if edit == "GRANT":
+                schemaPermissions |= set(edit_permissions)
+
+        ## Feature classes whose privileges, with those granted on the schema, differ from the role's
+        changes = [fc for fc in fclist
+                       if PrivilegesDiffer(current.get((1, ".".join(fc.split(".")[-2:]).lower(), role.lower()), set()) | schemaPermissions, view, edit)]
+        if changes:
+            arcpy.ChangePrivileges_management(changes, role, view, edit)
+        print "Privileges of %s changed on %s of %s feature classes" % (role, len(changes), len(fclist))
+
+    print "Privilege changes successful"
+
+## Load the conversion state of the last run, unless run with /Full
+state = {"rows": {}, "vertexRows": None, "segments": [], "exportPending": [], "stages": {}}
+if "/full" not in [arg.lower() for arg in sys.argv[1:]] and os.path.exists(stateFile):
+    f = open(stateFile, "r")
+    lastState = json.load(f)
+    f.close()
+    state.update(lastState)
+    if "stages" not in lastState:
+        state["vertexRows"] = state["rows"].get(copied_mains)           # Saved before there were stages
+
+## Read the GlobalID and edit date of every source row before converting, so that rows edited
+## during the conversion are converted again by the next run
+sourceRows = {}
+for source, name in sources:
+    sourceRows[name] = ReadRows(source, [dissolve_field] if name == copied_mains else [])
+print "Source rows read"
+
+RunStage("Convert", sourceRows, ConvertStage)
+RunStage("Vertices", state["rows"][copied_mains], VerticesStage)
+RunStage("Export", [state["segments"], state["exportPending"]], ExportStage)
+RunStage("Privileges", [arcpy.ListFeatureClasses("","",dataset), privileges, privilege_model,
+                        state["stages"]["Convert"]["completed"], state["stages"]["Vertices"]["completed"]], PrivilegesStage)
 
 ## Done
 ExecutionEndTime = datetime.datetime.now()
 ElapsedTime = ExecutionEndTime - ExecutionStartTime
 print "Ended: %s" % ExecutionEndTime.strftime('%A, %B %d, %Y %I:%M:%S %p')
 print "Elapsed Time: %s" % str(ElapsedTime).split('.')[0]
+
+## Run report, when the Convert stage ran
+if layerTimings:
+    print "%-20s %12s %12s" % ("Layer", "Projection", "Append")
+    for name, projectionSeconds, appendSeconds in layerTimings:
+        print "%-20s %12s %12s" % (name, str(datetime.timedelta(seconds=int(projectionSeconds))),
+                                   str(datetime.timedelta(seconds=int(appendSeconds))))
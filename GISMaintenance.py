@@ -3,7 +3,10 @@
 # Usage:
 #
 #   GISMaintenance.py [/AppServer applicationServer] [/DBServer databaseServer] \
-#                     [/Versions] [/Compress] [/Import] [/Indexes]
+#                     [/Versions] [/Compress] [/Import] [/Indexes] [/CatalogCache] \
+#                     [/WindowEnd HH:MM] [/Simulate [configFile]] [/Database database] \
+#                     [/Databases server:database[:workers],...] [/Workers n] [/Resume] [/Online] \
+#                     [/SchTasks path]
 
 
 # This program performs the specified GIS maintenance tasks in the sdeVector
@@ -14,7 +17,17 @@
 #
 # If a database server is specified, this program will work in the sdeVector
 # database on the specified database server.  Otherwise, it will work in the
-# sdeVector database on Conway.
+# sdeVector database on Conway.  /Database works in another database instead.
+#
+# If a list of databases is specified with /Databases, this program stops
+# services and scheduled tasks once for all of them, maintains the databases
+# concurrently - at most DatabaseWorkers at a time, each in its own process,
+# using at most the given number of threads - then restarts services and
+# scheduled tasks and sends one status report for all of them.  (The processes
+# are run with /SharedShutdown, which leaves services and tasks alone and
+# saves the outcome in the given result file.)
+#
+# /Workers limits the number of threads used for any concurrent work.
 #
 # This program performs the specified maintenance tasks:
 #
@@ -24,32 +37,77 @@
 #       - Stops GIS services.
 #       - Stops the database from accepting new connections.
 #       - Determines which Windows users are connected to the database,
-#         sends email asking them to disconnect, and
-#         waits 15 minutes for them to disconnect.
+#         disconnects idle connections, sends email asking users who are
+#         still editing to disconnect, and waits up to 15 minutes for them
+#         to finish.
 #       - Disconnects all users from the database.
 #
 #   Next, it performs the specified maintenance tasks:
 #
 #       /Versions
 #
-#           - Reconciles and posts all versions.
-#           - Deletes all versions.
-#           - Creates new versions for the SAP-GIS and AssetWorks-GIS
-#             interfaces.
+#           - Reconciles and posts all versions, leaves first.  Versions with
+#             conflicts are kept; all other versions are posted.
+#           - Deletes all versions that were posted and have no children.
+#           - Creates the versions for the SAP-GIS and AssetWorks-GIS
+#             interfaces that are missing, as described in VersionSpecFile.
 #
 #       /Compress
 #
 #           - Compresses the database.
+#           - Reports which versions and tables prevent the state tree from
+#             collapsing.
 #
 #       /Import
 #
-#           - Imports data from other systems.
+#           - Imports data from other systems - loads extract files into
+#             staging tables and merges them into their target tables.
 #
 #       /Indexes
 #
 #           - Rebuilds indexes.
 #           - Updates statistics.
 #
+#       /CatalogCache
+#
+#           - Reuses the list of sdeDataOwner rasters, tables and feature
+#             classes saved by a previous run, unless the geodatabase catalog
+#             has changed since then.
+#
+#       /WindowEnd HH:MM
+#
+#           - Predicts how long each maintenance task will take, and skips
+#             the lowest priority tasks that would keep services down past
+#             the given time.
+#
+#       /Simulate [configFile]
+#
+#           - Performs the specified maintenance tasks against simulated
+#             services, scheduled tasks, database, and email, with simulated
+#             durations, and reports how long each step would take.  Nothing
+#             on the servers or in the database is changed.  (See Simulation.)
+#
+#       /Online
+#
+#           - With /Indexes, rebuilds indexes and updates statistics after
+#             services have been restarted, a few tables at a time, pausing
+#             while the database responds slowly to a probe query.  Services
+#             are then stopped only for the other maintenance tasks.
+#
+#       /Resume
+#
+#           - Resumes the last run that did not finish, skipping the phases
+#             and tables it completed.  If no maintenance tasks are
+#             specified, performs the tasks of that run.  (A run started
+#             within ResumeHours of an unfinished run resumes it anyway.)
+#
+#       /SchTasks path
+#
+#           - Runs the given program instead of schtasks to query, disable
+#             and enable scheduled tasks, e.g. a stub that tests them
+#             offline.  The GISMAINTENANCE_SCHTASKS environment variable
+#             does the same.
+#
 #   Finally, it re-enables database connections, services, and scheduled tasks:
 #
 #       - Enables the database to accept new connections.
@@ -68,62 +126,108 @@
 #
 #       GISMaintenance.py /AppServer Arctic /DBServer Conway /Versions /Compress
 #       GISMaintenance.py /AppServer Arctic /DBServer Conway /Versions /Compress /Import /Indexes
+#
+# or, to maintain several databases in one maintenance window:
+#
+#       GISMaintenance.py /AppServer Arctic /Versions /Compress /Indexes /Databases Conway:sdeVector:4,DQSQL:sdeVector:2,Conway:AssetWorksGIS:2
 
 
 ################################################################################
 
-import arcpy, datetime, logging, os, re, shutil, smtplib, subprocess, sys, time
+import collections, csv, datetime, fnmatch, glob, json, logging, logging.handlers, os, Queue, random, re, shutil, smtplib, sqlite3, subprocess, sys, threading, time, types, zipfile
+try:
+    import arcpy
+except ImportError:
+    arcpy = None    # Not needed with /Simulate.
+from multiprocessing.pool import ThreadPool
 
 #
 # Main program
 #
 
 def PerformMaintenance():
-    global Versions, Compress, Import, Indexes
+    global Versions, Compress, Import, Indexes, Online, Databases, SharedShutdown
     try:
         Initialize()
-        #
-        # Disable scheduled tasks, services, and database connections.
-        #
-        if Versions or Compress or Indexes:
-            DisableTasks()
-            StopServices()
-        if Versions or Indexes:
-            StopAcceptingConnections()
-            SendWarningMail()
-            DisconnectUsers()
-        #
-        # Perform maintenance tasks that can only be done when services are
-        # stopped and users are disconnected from the database.
-        #
-        if Versions:
-            ReconcilePostDeleteVersions()
-        if Compress:
-            CompressDatabase()
-        if Versions:
-            CreateVersions()
-        if Import:
-            ImportDataFromOtherSystems()
-        if Indexes:
-            RebuildIndexes()
-            UpdateStatistics()
-    finally:
+        if not Databases:
+            ResumeMaintenance()
+            PlanMaintenanceWindow()
+        offlineIndexes = Indexes and not Online
         try:
+            if Databases:
+                #
+                # Disable scheduled tasks and services once, and maintain each
+                # database in its own process.
+                #
+                if Versions or Compress or offlineIndexes:
+                    RunPhase('Shutdown', [DisableTasks, StopServices], required=True)
+                if Versions or Compress or Import or offlineIndexes:
+                    RunPhase('Databases', [MaintainDatabases], required=True)
+            else:
+                #
+                # Disable scheduled tasks, services, and database connections.
+                #
+                if (Versions or Compress or offlineIndexes) and not SharedShutdown:
+                    RunPhase('Shutdown', [DisableTasks, StopServices], required=True)
+                if Versions or offlineIndexes:
+                    RunPhase('Drain', [StopAcceptingConnections, DrainUsers, DisconnectUsers], required=True)
+                #
+                # Perform maintenance tasks that can only be done when services are
+                # stopped and users are disconnected from the database.
+                #
+                reconciled = False
+                if Versions:
+                    reconciled = RunPhase('Reconcile', [ReconcilePostDeleteVersions])
+                if Compress:
+                    RunPhase('Compress', [CompressDatabase])
+                if Versions and reconciled:
+                    RunPhase('CreateVersions', [CreateVersions], required=True)
+                if Import:
+                    RunPhase('Import', [ImportDataFromOtherSystems])
+                if offlineIndexes:
+                    RunPhase('Indexes', [RebuildIndexes, UpdateStatistics])
+        finally:
             #
             # Enable database connections, services, and scheduled tasks.
             #
-            if Versions or Indexes:
+            restoreStartTime = datetime.datetime.now()
+            if (Versions or offlineIndexes) and not Databases:
                 AcceptConnections()
-            if Versions or Compress or Indexes:
+            if (Versions or Compress or offlineIndexes) and not SharedShutdown:
                 StartServices()
                 EnableTasks()
-            if Versions or Indexes:
+                RecordPhase('Restore', restoreStartTime)
+            if (Versions or offlineIndexes) and not SharedShutdown:
                 SendNotificationMail()
+        #
+        # With /Online, rebuild indexes and update statistics while services are running.
+        #
+        if Indexes and Online:
+            if Databases:
+                RunPhase('OnlineIndexes', [lambda: MaintainDatabases(online=True)], required=True)
+            else:
+                RunPhase('OnlineIndexes', [RebuildIndexes, UpdateStatistics], required=True)
+    finally:
+        try:
+            if not Databases:
+                FinishJournal()
         finally:
             #
             # Send execution status report to administrative users.
+            # (With /SharedShutdown, save the outcome for the status report
+            # of the process that started this one instead.)
             #
-            SendStatusMail()
+            try:
+                ReportPhaseTimings()
+                ReportCommands()
+                if Simulation:
+                    ReportSimulation()
+                if not SharedShutdown:
+                    SendStatusMail()
+            finally:
+                StopLogging()
+                if SharedShutdown:
+                    SaveMaintenanceResult()
 
 ################################################################################
 
@@ -140,9 +244,25 @@ def Initialize():
     global ApplicationServer, DatabaseServer
     global Versions, Compress, Import, Indexes
     global Database, DatabaseServer_Database_sde, DatabaseServer_Database_sdeAdmin, DatabaseUsers
-    global TaskServer_Tasks
-    global Services, ServiceServers, ServiceServer_Services
-    global LogDirectory, LogFile, VersionsLogFile
+    global Databases, DatabaseWorkers, DatabaseResults, DatabaseLogFiles, SharedShutdown, ResultFile, MaxWorkers
+    global Resume, ResumeHours, ResumablePhases, Journal, JournalFile, JournalBatchSize
+    global Online, OnlineBatchSize, OnlineBatchPauseSeconds, OnlineProbeSQL, OnlineProbes
+    global OnlineLatencyFactor, OnlineMinLatencyMs, OnlineLatencyLimit, OnlinePauseSeconds, OnlineMaxWaitMinutes
+    global TaskServer_Tasks, TaskServer_TaskStates, TaskStatesFile, TaskWorkers, SchTasks
+    global Services, ServiceServers, ServiceServer_Services, ServiceWorkers
+    global LogDirectory, LocalLogDirectory, LogFile, VersionsLogFile
+    global LogMaxBytes, LogBackupCount, LogShipSeconds, MailLogBytes
+    global LogManifestFile, LogManifestLockSeconds, LogManifestReconcileDays
+    global LogRetentionDays, LogRetentionBytes, LogCompressDays, RetentionThread
+    global StateDirectory, CatalogCache, CatalogCacheFile, CatalogSnapshot
+    global ReconcileWorkers, VersionTimings, VersionSpecFile
+    global CompressHistoryFile, CompressReportTables
+    global DrainMinutes, DrainReminderMinutes
+    global WindowEnd, PhaseHistoryFile, PhaseHistoryRuns, PhasePriority, PhaseIndicator, DefaultPhaseSeconds
+    global PhaseIndicators, PhasePredictions, PhaseTimings
+    global ImportSpecFile, ImportBatchSize
+    global Simulation, SimulationDirectory, SimulationConfigFile, SimulationTimelineFile
+    global CommandPool, CommandWorkers, CommandLock, CommandCache, CommandHistory, CommandTimeoutSeconds, CommandCacheSeconds
     global MailServer, MailSender, NotificationMailRecipients, StatusMailRecipientsIfSuccess, StatusMailRecipientsIfError
     try:
         #
@@ -155,16 +275,51 @@ def Initialize():
         thisServer = os.environ['COMPUTERNAME'].lower()
         thisUser = os.environ['USERNAME']
         #
+        # Simulation
+        #   With /Simulate, files are read and written only under SimulationDirectory.
+        #
+        Simulation = '/simulate' in [a.lower() for a in sys.argv]
+        SimulationDirectory = os.path.join(os.environ.get('TEMP', os.getcwd()), 'GISMaintenanceSimulation')
+        SimulationConfigFile = None
+        SimulationTimelineFile = os.path.join(SimulationDirectory, 'Timeline_%s_%s.csv' % (date, time))
+        #
         # Log files
-        #   Write progress and error messages to the log file.
+        #   Write progress and error messages to the log file on the local disk,
+        #   and copy it to the log directory on the network share in the background.
         #   Track events at and above the debug level - i.e., debug, info, warning, error, and critical.
+        #   With /SharedShutdown or /ReconcileGroup, several processes may start in
+        #   the same second, so the process id is added to the log file names.
         #
         LogDirectory = r'\\Arctic\GIS_Data\GIS_Private\DataResources\DBA\Maintenance\LogFiles'
-        LogFile         = '%s\%s_%s_%s.log'    % (LogDirectory, date, time, thisServer)
-        VersionsLogFile = '%s\%s_%s_%s_%s.log' % (LogDirectory, date, time, thisServer, 'Versions')
-        logging.basicConfig(filename=LogFile, filemode='w', format='[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
+        LocalLogDirectory = r'C:\GIS_Development\DataResources\DBA\Maintenance\LogFiles'
+        if Simulation:
+            LogDirectory      = os.path.join(SimulationDirectory, 'LogFiles')
+            LocalLogDirectory = os.path.join(SimulationDirectory, 'LocalLogFiles')
+            if not os.path.exists(LogDirectory):
+                os.makedirs(LogDirectory)
+        startedByAnotherProcess = set(['/sharedshutdown', '/reconcilegroup']) & set([a.lower() for a in sys.argv]) != set()
+        logName = '%s_%s_%s' % (date, time, thisServer)
+        if startedByAnotherProcess:
+            logName += '_%i' % os.getpid()
+        LogFile         = '%s\%s.log'    % (LocalLogDirectory, logName)
+        VersionsLogFile = '%s\%s_%s.log' % (LocalLogDirectory, logName, 'Versions')
+        LogMaxBytes    = 20 * 1024 * 1024   # Rotate the log file when it reaches this size.
+        LogBackupCount = 5                  # Number of rotated log files to keep.
+        LogShipSeconds = 60                 # Copy log files to the share this often.
+        MailLogBytes   = 256 * 1024         # Include at most this much of each log file in the status email.
+        LogManifestFile   = '%s\LogManifest.json' % LogDirectory
+        LogRetentionDays  = 30                  # Delete log files older than this.
+        LogRetentionBytes = 2 * 1024 ** 3       # Keep at most this much in the log directory.
+        LogCompressDays   = 2                   # Compress log files older than this.
+        LogManifestLockSeconds = 60             # Wait this long for the manifest lock.  (Older locks are stale.)
+        LogManifestReconcileDays = 7            # Reconcile the manifest with a listing of the log directory this often.
+        RetentionThread   = None
+        StartLogging()
         LoggingInfo('Start time: %s' % ExecutionStartTime)
-        DeleteOldLogFiles()
+        if Simulation:
+            InstallSimulation()
+        if not startedByAnotherProcess:
+            DeleteOldLogFiles()     # (The process that started this one deletes them.)
         #
         # Servers & maintenance tasks
         #   Initialize to defaults.
@@ -172,21 +327,122 @@ def Initialize():
         #
         ApplicationServer = thisServer  # Server on which this program must be run.  Default: Any.
         DatabaseServer    = 'conway'    # Server on which the database resides.  Default: Conway.
+        Database          = 'sdeVector' # Database to maintain.  Default: sdeVector.
+        Databases      = []     # Databases to maintain concurrently, each in its own process.  Default: None.
+        SharedShutdown = False  # If True, services and scheduled tasks are stopped and started by another process.
+        ResultFile     = None   # With /SharedShutdown, file in which the outcome of this run is saved.
+        MaxWorkers     = None   # Most threads used for any concurrent work.  Default: No limit.
+        Resume         = False  # If True, resume the last run that did not finish.
         Versions = False    # If True, reconcile, post, delete, and create versions.
         Compress = False    # If True, compress the database.
         Import   = False    # If True, import data from other systems.
         Indexes  = False    # If true, rebuild indexes and update statistics.
+        Online   = False    # If True, rebuild indexes and update statistics while services are running.
+        CatalogCache = False    # If True, reuse the catalog snapshot saved by a previous run.
+        WindowEnd    = None     # Time by which services must be running again.  Default: None.
+        SchTasks = os.environ.get('GISMAINTENANCE_SCHTASKS', 'schtasks')   # Path of the schtasks command, or of a stub to test offline.
         ProcessCommandLineArgs()
         VerifyApplicationServer()
+        if Simulation:
+            LoadSimulationConfig()  # (Once /Simulate has given the configuration file.)
         #
         # Database
         #
-        Database = 'sdeVector'
         DatabaseUsers = ['arcgiscontainer', 'dbo', 'sa', 'sde', 'sdeadmin', 'sdedataowner', 'sdeviewer']    # Users to whom email cannot be sent.
+        DrainMinutes         = 15   # Minutes users with open edit sessions are given to disconnect.
+        DrainReminderMinutes = 5    # Remind users still editing when this many minutes remain.
         DatabaseServer_Database_sde      = r'\\Arctic\GIS_Data\GIS_Private\DataResources\DBA\Maintenance\Interfaces\%s_%s_%s.sde' % (DatabaseServer, Database, 'sde')
         DatabaseServer_Database_sdeAdmin = r'\\Arctic\GIS_Data\GIS_Private\DataResources\DBA\Maintenance\Interfaces\%s_%s_%s.sde' % (DatabaseServer, Database, 'sdeAdmin')
-        assert os.path.exists(DatabaseServer_Database_sde), 'Database connection file "%s" does not exist.' % DatabaseServer_Database_sde
-        assert os.path.exists(DatabaseServer_Database_sdeAdmin), 'Database connection file "%s" does not exist.' % DatabaseServer_Database_sdeAdmin
+        if not Simulation:
+            assert os.path.exists(DatabaseServer_Database_sde), 'Database connection file "%s" does not exist.' % DatabaseServer_Database_sde
+            assert os.path.exists(DatabaseServer_Database_sdeAdmin), 'Database connection file "%s" does not exist.' % DatabaseServer_Database_sdeAdmin
+        #
+        # State files
+        #   Information saved from one run to the next.
+        #
+        StateDirectory = r'\\Arctic\GIS_Data\GIS_Private\DataResources\DBA\Maintenance\State'
+        if Simulation:
+            StateDirectory = os.path.join(SimulationDirectory, 'State')
+        if not os.path.exists(StateDirectory):
+            os.makedirs(StateDirectory)
+        #
+        # Catalog snapshot
+        #   Rasters, tables and feature classes owned by sdeDataOwner.
+        #   Listed at most once per run and shared by all maintenance tasks.
+        #
+        CatalogSnapshot  = None
+        CatalogCacheFile = '%s\CatalogCache_%s_%s.json' % (StateDirectory, DatabaseServer, Database)
+        #
+        # Versions
+        #   Versions with different parents are reconciled concurrently.
+        #
+        ReconcileWorkers = 4    # Number of versions reconciled at the same time.
+        VersionTimings   = []   # Outcome and elapsed time of each version's reconcile.
+        #
+        #   Versions to be recreated after the reconcile are described in
+        #   VersionSpecFile.  If it does not exist, DefaultVersionSpec is used.
+        #
+        VersionSpecFile  = r'\\Arctic\GIS_Data\GIS_Private\DataResources\DBA\Maintenance\Versions\VersionSpec_%s_%s.json' % (DatabaseServer, Database)
+        if Simulation:
+            VersionSpecFile = os.path.join(SimulationDirectory, os.path.basename(VersionSpecFile))
+        #
+        # Compress
+        #   State tree and delta table statistics recorded before and after each compress.
+        #
+        CompressHistoryFile  = '%s\CompressHistory_%s_%s.txt' % (StateDirectory, DatabaseServer, Database)
+        CompressReportTables = 20   # Number of tables listed in the compress report.
+        #
+        # Maintenance window
+        #   Each run's phase durations are appended to PhaseHistoryFile and used
+        #   to predict the durations of later runs.
+        #
+        PhaseHistoryFile = '%s\PhaseHistory_%s_%s.txt' % (StateDirectory, DatabaseServer, Database)
+        PhaseHistoryRuns = 30   # Number of recent runs used for predictions.
+        PhasePriority    = ['Versions', 'Compress', 'Indexes', 'Import']    # Most important first.
+        PhaseIndicator   = {'Reconcile': 'versions',    # Duration grows with ...
+                            'Compress':  'deltaRows',
+                            'Indexes':   'fragmentedPages',
+                            'OnlineIndexes': 'fragmentedPages'}
+        DefaultPhaseSeconds = {'Shutdown': 300, 'Drain': 900, 'Reconcile': 1800, 'Compress': 1800,
+                               'CreateVersions': 60, 'Import': 1800, 'Indexes': 3600, 'Restore': 600,
+                               'OnlineIndexes': 7200}
+        PhaseIndicators  = {}   # Current value of each indicator.
+        PhasePredictions = {}   # Predicted duration of each phase, in seconds.
+        PhaseTimings     = []   # Actual duration of each phase.
+        #
+        # Journal
+        #   The phases, and the tables within phases, completed by a run that
+        #   has not finished.  (Import is not journaled: extract files that
+        #   have been merged are archived, so importing again is cheap.)
+        #
+        Journal          = None
+        JournalFile      = '%s\Journal_%s_%s.json' % (StateDirectory, DatabaseServer, Database)
+        ResumeHours      = 12   # A run started this soon after an unfinished run resumes it.
+        ResumablePhases  = ['Reconcile', 'Compress', 'CreateVersions', 'Indexes', 'OnlineIndexes']
+        JournalBatchSize = 25   # Tables rebuilt or analyzed between journal updates.
+        #
+        # Online indexes
+        #   With /Online, indexes are rebuilt and statistics updated a few tables
+        #   at a time while services are running.  Before each batch, a probe
+        #   query is timed; while it takes longer than OnlineLatencyLimit, wait.
+        #
+        OnlineBatchSize         = 5     # Tables rebuilt or analyzed at a time.
+        OnlineBatchPauseSeconds = 10    # Pause between batches, to let queued queries through.
+        OnlineProbeSQL          = 'SELECT COUNT(*) FROM sde.SDE_table_registry'
+        OnlineProbes            = 3     # Number of probes timed to measure the baseline latency.
+        OnlineLatencyFactor     = 3.0   # Wait while the probe takes this many times its baseline latency ...
+        OnlineMinLatencyMs      = 200   # ... or this many milliseconds, whichever is more.
+        OnlineLatencyLimit      = None  # Milliseconds.  Set from the baseline latency.
+        OnlinePauseSeconds      = 60    # Time between probes while the database is busy.
+        OnlineMaxWaitMinutes    = 30    # Give up if the database stays busy this long.
+        #
+        # Import
+        #   Extracts from other systems to be loaded by /Import.
+        #
+        ImportSpecFile  = r'\\Arctic\GIS_Data\GIS_Private\DataResources\DBA\Maintenance\Imports\ImportSpec_%s_%s.json' % (DatabaseServer, Database)
+        if Simulation:
+            ImportSpecFile = os.path.join(SimulationDirectory, os.path.basename(ImportSpecFile))
+        ImportBatchSize = 10000 # Rows loaded per insert cursor.
         #
         # Scheduled tasks
         #   If working in production database (Conway sdeVector), temporarily
@@ -194,13 +450,35 @@ def Initialize():
         #   If working in development database (DQSQL sdeVector), temporarily
         #   stop scheduled tasks on development application server (DevArctic).
         #   Otherwise, temporarily stop scheduled tasks on all application servers.
+        #   With /Databases, stop the tasks for each of those databases only -
+        #   not for the default database server.
         #
-        if DatabaseServer == 'conway':
-            TaskServer_Tasks = {'arctic': ['\NNWW\ImportGisScadaReadings', '\NNWW\RefreshMapServices']}
-        elif DatabaseServer == 'dqsql':
-            TaskServer_Tasks = {}
-        else:
-            TaskServer_Tasks = {'arctic': ['\NNWW\ImportGisScadaReadings', '\NNWW\RefreshMapServices']}
+        databaseServers = sorted(set([d['server'] for d in Databases] or [DatabaseServer]))
+        TaskServer_Tasks = {}
+        for databaseServer in databaseServers:
+            if databaseServer == 'conway':
+                server_tasks = {'arctic': ['\NNWW\ImportGisScadaReadings', '\NNWW\RefreshMapServices']}
+            elif databaseServer == 'dqsql':
+                server_tasks = {}
+            else:
+                server_tasks = {'arctic': ['\NNWW\ImportGisScadaReadings', '\NNWW\RefreshMapServices']}
+            for (server, tasks) in server_tasks.items():
+                TaskServer_Tasks.setdefault(server, [])
+                TaskServer_Tasks[server] += [t for t in tasks if t not in TaskServer_Tasks[server]]
+        TaskServer_TaskStates = None    # State of each task before it was disabled.
+        TaskStatesFile = '%s\TaskStates_%s_%s.json' % (StateDirectory, DatabaseServer, Database)
+        TaskWorkers = 4         # Number of schtasks commands run at the same time.
+        #
+        # Windows commands
+        #   sc and schtasks commands run on a pool of threads, each with a timeout.
+        #
+        CommandPool = None              # Created when the first command is run.
+        CommandWorkers = 8              # Number of Windows commands run at the same time.
+        CommandLock = threading.Lock()
+        CommandCache = {}               # Recent output of queries, by command.
+        CommandHistory = []             # Duration, exit status, and outcome of each command.
+        CommandTimeoutSeconds = 120     # Kill a command that has not finished after this long.
+        CommandCacheSeconds = 30        # Reuse the output of an identical query for this long.
         #
         # Services
         #   If working in production database (Conway sdeVector), temporarily
@@ -208,15 +486,20 @@ def Initialize():
         #   If working in development database (DQSQL sdeVector), temporarily
         #   stop services on development application server (DevArctic).
         #   Otherwise, temporarily stop scheduled tasks on all application servers.
+        #   With /Databases, stop the services for each of those databases only.
         #
-        if DatabaseServer == 'conway':
-            ServiceServers = ['arctic']
-        elif DatabaseServer == 'dqsql':
-            ServiceServers = ['devarctic']
-        else:
-            ServiceServers = ['arctic', 'devarctic']
+        ServiceServers = []
+        for databaseServer in databaseServers:
+            if databaseServer == 'conway':
+                servers = ['arctic']
+            elif databaseServer == 'dqsql':
+                servers = ['devarctic']
+            else:
+                servers = ['arctic', 'devarctic']
+            ServiceServers += [s for s in servers if s not in ServiceServers]
         Services = ['ArcGIS Server', 'AW_GIS_Interface']
         ServiceServer_Services = {}
+        ServiceWorkers = 4      # Number of servers whose services are stopped or started at the same time.
         #
         # Email
         #
@@ -229,6 +512,23 @@ def Initialize():
         StatusMailRecipientsIfError   = ['Marietta Washington <mvwashington@nnva.gov>',
                                          'Brian Kingery <bkingery@nnva.gov>',
                                          'Barbara Gates <bgates@nnva.gov>']
+        #
+        # Databases
+        #   With /Databases, each database is maintained by its own process.
+        #
+        DatabaseWorkers  = 3    # Number of databases maintained at the same time.
+        DatabaseResults  = []   # Outcome of each database's maintenance.
+        DatabaseLogFiles = []   # Output of each database's process, and of each reconcile process.
+        #
+        # Resource limits
+        #   With /Workers, use at most that many threads for any concurrent work.
+        #
+        if MaxWorkers:
+            ReconcileWorkers = min(ReconcileWorkers, MaxWorkers)
+            TaskWorkers      = min(TaskWorkers, MaxWorkers)
+            CommandWorkers   = min(CommandWorkers, MaxWorkers)
+            ServiceWorkers   = min(ServiceWorkers, MaxWorkers)
+            DatabaseWorkers  = min(DatabaseWorkers, MaxWorkers)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingCritical(e)
@@ -242,21 +542,24 @@ def Initialize():
 
 def ProcessCommandLineArgs():
     global ApplicationServer, DatabaseServer
-    global Versions, Compress, Import, Indexes
+    global Versions, Compress, Import, Indexes, CatalogCache, WindowEnd, SimulationConfigFile
+    global Database, Databases, SharedShutdown, ResultFile, MaxWorkers, Resume, Online, SchTasks
     cmd = ' '.join(sys.argv)
     LoggingInfo('Command: "%s"' % cmd)
-    usage = 'Usage: GISMaintenance.py [/AppServer server] [/DBServer server] [/Versions] [/Compress] [/Import] [/Indexes]'
-    args = [a.lower()
-               for a in sys.argv[1:]]
+    usage = 'Usage: GISMaintenance.py [/AppServer server] [/DBServer server] [/Versions] [/Compress] [/Import] [/Indexes] [/CatalogCache] [/WindowEnd HH:MM] [/Simulate [configFile]] [/Database database] [/Databases server:database[:workers],...] [/Workers n] [/Resume] [/Online] [/SchTasks path]'
+    #
+    # Names are not case sensitive.  File paths keep their case.
+    #
+    args = list(sys.argv[1:])
     while args != []:
-        arg = args.pop(0)
+        arg = args.pop(0).lower()
         if arg == '/appserver':
             assert args != [], '"%s" is an invalid command.\n%s' % (cmd, usage)
-            ApplicationServer = args.pop(0)
+            ApplicationServer = args.pop(0).lower()
             assert ApplicationServer[0] != '/', '"%s" is an invalid command.\n%s' % (cmd, usage)
         elif arg == '/dbserver':
             assert args != [], '"%s" is an invalid command.\n%s' % (cmd, usage)
-            DatabaseServer = args.pop(0)
+            DatabaseServer = args.pop(0).lower()
             assert DatabaseServer[0] != '/', '"%s" is an invalid command.\n%s' % (cmd, usage)
         elif arg == '/versions':
             Versions = True
@@ -266,6 +569,47 @@ def ProcessCommandLineArgs():
             Import = True
         elif arg == '/indexes':
             Indexes = True
+        elif arg == '/catalogcache':
+            CatalogCache = True
+        elif arg == '/windowend':
+            assert args != [], '"%s" is an invalid command.\n%s' % (cmd, usage)
+            m = re.match('^(\d\d?):(\d\d)$', args.pop(0))
+            assert m, '"%s" is an invalid command.\n%s' % (cmd, usage)
+            WindowEnd = datetime.datetime.now().replace(hour=int(m.group(1)), minute=int(m.group(2)), second=0, microsecond=0)
+            if WindowEnd < datetime.datetime.now():
+                WindowEnd += datetime.timedelta(days=1)
+        elif arg == '/simulate':
+            if args != [] and args[0][0] != '/':
+                SimulationConfigFile = args.pop(0)
+        elif arg == '/database':
+            assert args != [], '"%s" is an invalid command.\n%s' % (cmd, usage)
+            Database = args.pop(0).lower()
+            assert Database[0] != '/', '"%s" is an invalid command.\n%s' % (cmd, usage)
+        elif arg == '/databases':
+            assert args != [], '"%s" is an invalid command.\n%s' % (cmd, usage)
+            for spec in args.pop(0).lower().split(','):
+                m = re.match('^([^:/]+):([^:]+)(:(\d+))?$', spec)
+                assert m, '"%s" is an invalid command.\n"%s" is not a valid database\n%s' % (cmd, spec, usage)
+                Databases.append({'server': m.group(1), 'database': m.group(2),
+                                  'workers': m.group(4) and int(m.group(4))})
+        elif arg == '/sharedshutdown':
+            assert args != [], '"%s" is an invalid command.\n%s' % (cmd, usage)
+            SharedShutdown = True
+            ResultFile = args.pop(0)
+        elif arg == '/reconcilegroup':
+            assert args != [], '"%s" is an invalid command.\n%s' % (cmd, usage)
+            SharedShutdown = True   # (Logs are registered by the process that started this one.)
+            ResultFile = args.pop(0)
+        elif arg == '/resume':
+            Resume = True
+        elif arg == '/online':
+            Online = True
+        elif arg == '/workers':
+            assert args != [] and args[0].isdigit(), '"%s" is an invalid command.\n%s' % (cmd, usage)
+            MaxWorkers = max(1, int(args.pop(0)))
+        elif arg == '/schtasks':
+            assert args != [] and args[0][0] != '/', '"%s" is an invalid command.\n%s' % (cmd, usage)
+            SchTasks = args.pop(0)
         else:
             assert False, '"%s" is an invalid command.\n"%s" is not a valid command line argument\n%s' % (cmd, arg, usage)
 
@@ -289,29 +633,615 @@ def VerifyApplicationServer():
 #
 # Delete old log files
 #
-#   - Delete log files more than 30 days old.
+#   - Delete log files more than LogRetentionDays days old, then delete the
+#     oldest log files until the log directory holds at most LogRetentionBytes.
+#   - Compress log files more than LogCompressDays days old into zip files.
+#
+#   - The name, date, and size of each log file in LogDirectory is kept in
+#     LogManifestFile, so the size of every file on the (slow) network share
+#     need not be read on every run.  If the manifest does not exist or cannot
+#     be read, it is rebuilt from a directory listing.  Log files written by
+#     this run are added to it when logging stops.
+#
+#   - Every LogManifestReconcileDays days, the manifest is reconciled with a
+#     listing of LogDirectory: log files it is missing (e.g. from a run that
+#     was killed before it registered its log files) are added, and files
+#     that no longer exist are removed.  The time of the last reconcile is
+#     the modification time of LogManifestFile.reconciled.  Other runs trust
+#     the manifest, and do not list the directory.
+#
+#   - Every change to the manifest is made while holding its lock file, and is
+#     applied to the manifest as saved, so concurrent runs do not overwrite
+#     each other's changes.
+#
+#   - This work is done in a background thread, RetentionThread, which
+#     StopLogging() waits for.
 #
 
 def DeleteOldLogFiles():
-    global LogDirectory
-    LoggingInfo('    Deleting old log files ...')
+    global RetentionThread
+    LoggingInfo('    Deleting old log files in the background ...')
+    RetentionThread = threading.Thread(target=ApplyLogRetention)
+    RetentionThread.daemon = True
+    RetentionThread.start()
+
+def ApplyLogRetention():
+    global ExecutionSuccessful, LogDirectory, LogManifestFile, LogRetentionDays, LogRetentionBytes, LogCompressDays
     try:
-        fileNamePattern = '^(\d\d\d\d)(\d\d)(\d\d)_(\d\d)(\d\d)(\d\d).*\.log$'
-        for fileName in os.listdir(LogDirectory):
-            m = re.match(fileNamePattern, fileName)
-            if m:
-                year = int(m.group(1))
-                month = int(m.group(2))
-                day = int(m.group(3))
-                logFileDate = datetime.datetime(year, month, day)
-                if datetime.datetime.today() - logFileDate > datetime.timedelta(days=30):
-                    logFile = os.path.join(LogDirectory, fileName)
-                    LoggingInfo('    Deleting %s' % logFile)
+        if LogManifestReconcileDue():
+            fileNames = os.listdir(LogDirectory)
+            UpdateLogManifest(lambda manifest: ReconcileLogManifest(manifest, fileNames))
+            open(LogManifestFile + '.reconciled', 'w').close()
+        manifest = LoadLogManifest()
+        removed = []
+        added = {}
+        today = datetime.datetime.today()
+        byAge = sorted(manifest.items(), key=lambda (fileName, entry): (entry['date'], fileName))
+        totalBytes = sum([entry['bytes'] for (fileName, entry) in byAge])
+        for (fileName, entry) in byAge:
+            age = today - datetime.datetime.strptime(entry['date'], '%Y%m%d')
+            if age > datetime.timedelta(days=LogRetentionDays) or totalBytes > LogRetentionBytes:
+                logFile = os.path.join(LogDirectory, fileName)
+                LoggingInfo('    Deleting %s' % logFile)
+                if os.path.exists(logFile):
                     os.remove(logFile)
+                totalBytes -= entry['bytes']
+                del manifest[fileName]
+                removed.append(fileName)
+        for (fileName, entry) in sorted(manifest.items()):
+            age = today - datetime.datetime.strptime(entry['date'], '%Y%m%d')
+            if age > datetime.timedelta(days=LogCompressDays) and not fileName.endswith('.zip'):
+                zipFileName = CompressLogFile(fileName)
+                removed.append(fileName)
+                if zipFileName:
+                    added[zipFileName] = {'date': entry['date'],
+                                          'bytes': os.path.getsize(os.path.join(LogDirectory, zipFileName))}
+        def update(manifest):
+            for fileName in removed:
+                manifest.pop(fileName, None)
+            manifest.update(added)
+        UpdateLogManifest(update)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingError(e)
 
+def CompressLogFile(fileName):
+    '''Replace the given log file in LogDirectory with a zip file containing it.
+       Return the name of the zip file, or None if the log file no longer exists.'''
+    global LogDirectory
+    logFile = os.path.join(LogDirectory, fileName)
+    if not os.path.exists(logFile):
+        return None
+    zipFileName = fileName + '.zip'
+    LoggingInfo('    Compressing %s' % logFile)
+    z = zipfile.ZipFile(os.path.join(LogDirectory, zipFileName), 'w', zipfile.ZIP_DEFLATED)
+    z.write(logFile, fileName)
+    z.close()
+    os.remove(logFile)
+    return zipFileName
+
+def LogFileDate(fileName):
+    '''Return the date (YYYYMMDD) in the name of the given log file, or None if it is not a log file.'''
+    m = re.match('^(\d\d\d\d\d\d\d\d)_(\d\d)(\d\d)(\d\d).*\.log(\.\d+)?(\.zip)?$', fileName)
+    if m:
+        return m.group(1)
+    return None
+
+def LoadLogManifest():
+    '''Return a dictionary which maps the name of each log file in LogDirectory
+       to its date (YYYYMMDD) and size in bytes.'''
+    global LogManifestFile, LogDirectory
+    if os.path.exists(LogManifestFile):
+        f = open(LogManifestFile, 'r')
+        try:
+            return json.load(f)
+        except ValueError, e:
+            LoggingError('    Unable to read log manifest %s: %s' % (LogManifestFile, e))
+        finally:
+            f.close()
+    LoggingInfo('    Building log manifest %s ...' % LogManifestFile)
+    manifest = {}
+    for fileName in os.listdir(LogDirectory):
+        date = LogFileDate(fileName)
+        if date:
+            manifest[fileName] = {'date': date, 'bytes': os.path.getsize(os.path.join(LogDirectory, fileName))}
+    return manifest
+
+def LogManifestReconcileDue():
+    '''Is it LogManifestReconcileDays days or more since the manifest was last
+       reconciled with a listing of LogDirectory?'''
+    global LogManifestFile, LogManifestReconcileDays
+    try:
+        reconciled = os.path.getmtime(LogManifestFile + '.reconciled')
+    except OSError:
+        return True
+    return time.time() - reconciled >= LogManifestReconcileDays * 24 * 60 * 60
+
+def ReconcileLogManifest(manifest, fileNames):
+    '''Add the log files in the given listing of LogDirectory that are missing
+       from the manifest, and remove the files that no longer exist.'''
+    global LogDirectory
+    listed = set(fileNames)
+    missing = [f for f in sorted(listed) if f not in manifest and LogFileDate(f)]
+    for fileName in missing:
+        try:
+            manifest[fileName] = {'date': LogFileDate(fileName), 'bytes': os.path.getsize(os.path.join(LogDirectory, fileName))}
+        except OSError:
+            pass    # (Deleted since it was listed.)
+    #
+    # A file registered since the listing was made is not in it, so check
+    # that a file is gone before removing it.
+    #
+    gone = [f for f in sorted(manifest.keys()) if f not in listed and not os.path.exists(os.path.join(LogDirectory, f))]
+    for fileName in gone:
+        del manifest[fileName]
+    if missing or gone:
+        LoggingInfo('    Log manifest reconciled with %s: %i files added, %i removed' % (LogDirectory, len(missing), len(gone)))
+
+def UpdateLogManifest(update):
+    '''Apply the given function to the saved manifest and save it, holding the
+       manifest's lock file so that concurrent runs do not lose each other's changes.'''
+    global LogManifestFile, LogManifestLockSeconds
+    lockFile = LogManifestFile + '.lock'
+    startTime = time.time()
+    while True:
+        try:
+            os.close(os.open(lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except OSError:
+            try:
+                stale = time.time() - os.path.getmtime(lockFile) > LogManifestLockSeconds
+            except OSError:
+                stale = False   # (Released in the meantime.)
+            if stale:
+                LoggingInfo('    Removing stale lock %s' % lockFile)
+                try:
+                    os.remove(lockFile)
+                except OSError:
+                    pass
+            else:
+                assert time.time() - startTime <= LogManifestLockSeconds, 'Timed out waiting for lock %s' % lockFile
+                time.sleep(1)
+    try:
+        manifest = LoadLogManifest()
+        update(manifest)
+        SaveLogManifest(manifest)
+    finally:
+        os.remove(lockFile)
+
+def SaveLogManifest(manifest):
+    global LogManifestFile
+    f = open(LogManifestFile + '.new', 'w')
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    if os.path.exists(LogManifestFile):
+        os.remove(LogManifestFile)
+    os.rename(LogManifestFile + '.new', LogManifestFile)
+
+def RegisterLogFiles(shipped):
+    '''Add the log files copied to LogDirectory by this run to the manifest.'''
+    def update(manifest):
+        for logFile in shipped.keys():
+            fileName = os.path.basename(logFile)
+            date = LogFileDate(fileName)
+            if date:
+                manifest[fileName] = {'date': date, 'bytes': shipped[logFile][0]}
+    UpdateLogManifest(update)
+
+################################################################################
+
+#
+# Maintain databases
+#
+#   - With /Databases, maintain each of the given databases in its own process
+#     - this program run with /DBServer, /Database, and the same maintenance
+#     tasks - at most DatabaseWorkers at a time.  Each process is given
+#     /Workers with the number of threads given for its database, if any.
+#
+#   - The processes are run with /SharedShutdown, so services and scheduled
+#     tasks are stopped and started once, by this process, rather than once
+#     per database.  Each process still drains and disconnects the users of
+#     its own database, and saves its outcome in a result file: whether it
+#     succeeded, the users to notify, its phase durations, and the log files
+#     it copied to LogDirectory.
+#
+#   - The output of each process is saved in DatabaseLogFiles and included in
+#     the status email, along with the outcome for each database.
+#
+
+def MaintainDatabases(online=False):
+    global ExecutionSuccessful, Databases, DatabaseWorkers, DatabaseResults, NotificationMailRecipients, LogShipped
+    LoggingInfo('Maintaining databases %s...' % ['', 'online '][online])
+    results = MapConcurrently(lambda database: MaintainDatabase(database, online), Databases, DatabaseWorkers)
+    DatabaseResults += results
+    LoggingInfo('    %-30s  %-8s  %s' % ('Database', 'Status', 'Elapsed Time'))
+    LoggingInfo('    %-30s  %-8s  %s' % ('--------', '------', '------------'))
+    for r in results:
+        LoggingInfo('    %-30s  %-8s  %s' % (r['name'], ['Error', 'Success'][r['successful']],
+                                            datetime.timedelta(seconds=int(r['seconds']))))
+        if not r['successful']:
+            ExecutionSuccessful = False
+        NotificationMailRecipients += [u for u in r.get('notify', []) if u not in NotificationMailRecipients]
+        for (logFile, shipped) in r.get('shipped', {}).items():
+            LogShipped[logFile] = tuple(shipped)
+
+def MaintainDatabase(database, online=False):
+    '''Maintain the given database in a new process, and wait for it to finish.
+       If online, only rebuild indexes and update statistics, with /Online.
+       Return its outcome.'''
+    global ApplicationServer, Versions, Compress, Import, Indexes, Online, CatalogCache, WindowEnd, Resume
+    global Simulation, SimulationConfigFile, LogFile, DatabaseLogFiles
+    name = '%s_%s' % (database['server'], database['database'])
+    tasks = [('/Versions', Versions), ('/Compress', Compress), ('/Import', Import), ('/Indexes', Indexes and not Online)]
+    if online:
+        name += '_Online'
+        tasks = [('/Indexes', True), ('/Online', True)]
+    logFile = '%s_%s.log' % (os.path.splitext(LogFile)[0], name)
+    resultFile = '%s_%s.json' % (os.path.splitext(LogFile)[0], name)
+    cmd = [sys.executable, os.path.abspath(sys.argv[0]), '/AppServer', ApplicationServer,
+           '/DBServer', database['server'], '/Database', database['database'], '/SharedShutdown', resultFile]
+    cmd += [arg for (arg, specified) in tasks + [('/CatalogCache', CatalogCache), ('/Resume', Resume)]
+                if specified]
+    if database['workers']:
+        cmd += ['/Workers', str(database['workers'])]
+    if WindowEnd is not None:
+        cmd += ['/WindowEnd', WindowEnd.strftime('%H:%M')]
+    if Simulation:
+        cmd += ['/Simulate'] + [f for f in [SimulationConfigFile] if f]
+    LoggingInfo('    Starting maintenance of %s %s: %s' % (database['server'], database['database'], ' '.join(cmd[1:])))
+    DatabaseLogFiles.append(logFile)
+    startTime = datetime.datetime.now()
+    f = open(logFile, 'w')
+    try:
+        exitStatus = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT).wait()
+    finally:
+        f.close()
+    result = {'successful': False}
+    try:
+        f = open(resultFile, 'r')
+        result = json.load(f)
+        f.close()
+        os.remove(resultFile)
+    except BaseException, e:
+        LoggingError('    Unable to read result of maintenance of %s %s from %s: %s' % (database['server'], database['database'], resultFile, e))
+    if Simulation:
+        SimulateStep('MaintainDatabase', name, sum([p['seconds'] for p in result.get('phases', [])]))
+    result.update({'name': ' '.join(name.split('_')), 'exitStatus': exitStatus,
+                   'seconds': (datetime.datetime.now() - startTime).total_seconds()})
+    if exitStatus != 0:
+        result['successful'] = False
+    LoggingInfo('    Finished maintenance of %s %s with exit status %i' % (database['server'], database['database'], exitStatus))
+    return result
+
+def SaveMaintenanceResult():
+    '''With /SharedShutdown, save the outcome of this run in ResultFile for the process that started it.'''
+    global ResultFile, ExecutionSuccessful, NotificationMailRecipients, PhaseTimings, LogShipped
+    try:
+        f = open(ResultFile, 'w')
+        json.dump({'successful': ExecutionSuccessful,
+                   'notify': NotificationMailRecipients,
+                   'phases': PhaseTimings,
+                   'shipped': LogShipped}, f, indent=1)
+        f.close()
+    except BaseException, e:
+        Log(logging.ERROR, 'Unable to save result in %s: %s' % (ResultFile, e))
+
+################################################################################
+
+#
+# Resume maintenance
+#
+#   - Record in JournalFile each phase this run completes, and each batch of
+#     tables whose indexes are rebuilt or whose statistics are updated.
+#     Delete JournalFile once every planned phase has completed.
+#
+#   - If JournalFile exists, a run did not finish.  With /Resume, or if that
+#     run started less than ResumeHours ago, resume it: skip the phases and
+#     tables it completed, and the maintenance tasks whose phases it completed.
+#     Services are then stopped only if the work that remains needs it.  With
+#     /Resume and no maintenance tasks, perform that run's tasks.
+#
+
+def ResumeMaintenance():
+    global Versions, Compress, Import, Indexes, Resume, ResumeHours, Journal, JournalFile
+    Journal = None
+    if os.path.exists(JournalFile):
+        try:
+            f = open(JournalFile, 'r')
+            Journal = json.load(f)
+            f.close()
+        except BaseException, e:
+            LoggingError('    Unable to read journal %s: %s' % (JournalFile, e))
+            Journal = None
+    if Journal is not None:
+        age = datetime.datetime.now() - datetime.datetime.strptime(Journal['started'], '%Y-%m-%d %H:%M:%S')
+        if Resume or age < datetime.timedelta(hours=ResumeHours):
+            LoggingInfo('Resuming the run started at %s ...' % Journal['started'])
+            LoggingInfo('    Completed phases: %s' % sorted(Journal['phases'].keys()))
+            if not (Versions or Compress or Import or Indexes):
+                Versions = 'Versions' in Journal['tasks']
+                Compress = 'Compress' in Journal['tasks']
+                Import   = 'Import'   in Journal['tasks']
+                Indexes  = 'Indexes'  in Journal['tasks']
+            #
+            # Skip the tasks whose phases have all been completed.
+            #
+            if Versions and PhaseCompleted('Reconcile') and PhaseCompleted('CreateVersions'):
+                Versions = False
+            if Compress and PhaseCompleted('Compress'):
+                Compress = False
+            if Indexes and (PhaseCompleted('Indexes') or PhaseCompleted('OnlineIndexes')):
+                Indexes = False
+        else:
+            LoggingInfo('    Not resuming the run started at %s, more than %i hours ago' % (Journal['started'], ResumeHours))
+            Journal = None
+    elif Resume:
+        LoggingInfo('    No unfinished run to resume')
+    if Journal is None:
+        Journal = {'started': ExecutionStartTime.strftime('%Y-%m-%d %H:%M:%S'),
+                   'tasks': [task for (task, specified) in [('Versions', Versions), ('Compress', Compress),
+                                                            ('Import', Import), ('Indexes', Indexes)]
+                                 if specified],
+                   'phases': {},
+                   'items': {}}
+
+def PhaseCompleted(phase):
+    global Journal
+    return Journal is not None and phase in Journal['phases']
+
+def RecordPhaseCompleted(phase):
+    global Journal, ResumablePhases
+    if Journal is not None and phase in ResumablePhases:
+        Journal['phases'][phase] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        SaveJournal()
+
+def CompletedItems(step):
+    '''Return the set of tables the given step completed in the run being resumed, or in this run.'''
+    global Journal
+    if Journal is None:
+        return set()
+    return set(Journal['items'].get(step, []))
+
+def RecordItemsCompleted(step, items):
+    global Journal
+    if Journal is not None:
+        Journal['items'].setdefault(step, []).extend(items)
+        SaveJournal()
+
+def SaveJournal():
+    global Journal, JournalFile
+    try:
+        f = open(JournalFile + '.new', 'w')
+        json.dump(Journal, f, indent=1, sort_keys=True)
+        f.close()
+        if os.path.exists(JournalFile):
+            os.remove(JournalFile)
+        os.rename(JournalFile + '.new', JournalFile)
+    except BaseException, e:
+        LoggingError('    Unable to save journal %s: %s' % (JournalFile, e))
+
+def FinishJournal():
+    '''Delete the journal if every planned phase has completed.'''
+    global Journal, JournalFile, ResumablePhases
+    try:
+        if Journal is None:
+            return
+        remaining = [p for p in PlannedPhases() if p in ResumablePhases]
+        if remaining:
+            LoggingInfo('Phases to be resumed: %s  (see %s)' % (remaining, JournalFile))
+        elif os.path.exists(JournalFile):
+            os.remove(JournalFile)
+    except BaseException, e:
+        LoggingError('Unable to finish journal %s: %s' % (JournalFile, e))
+
+def Batches(items, size):
+    '''Split the given list into lists of at most the given size.'''
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+################################################################################
+
+#
+# Plan maintenance window
+#
+#   - Predict how long each phase of this run will take from the durations
+#     of the same phases in recent runs (PhaseHistoryFile) and from current
+#     indicators of the work to be done - the number of versions, the number
+#     of rows in delta tables, and the number of pages in fragmented indexes.
+#
+#     A phase whose duration depends on an indicator is predicted with a
+#     least squares line through its recent (indicator, duration) pairs.
+#     Other phases are predicted with their median recent duration.
+#
+#   - The indicators are gathered only with /WindowEnd, when the predictions
+#     decide what is run, since they query the production database.  Index
+#     fragmentation is measured only with /Indexes, in LIMITED mode.
+#     Without /WindowEnd, every phase is predicted with its median.
+#
+#   - If /WindowEnd is specified, skip the lowest priority maintenance tasks
+#     until services are predicted to be running again by the end of the
+#     window.  Before each phase, check the prediction again against the time
+#     actually remaining.
+#
+#   - After the run, log predicted and actual durations and append them to
+#     PhaseHistoryFile.
+#
+
+def PlanMaintenanceWindow():
+    global Versions, Compress, Import, Indexes, Online
+    global WindowEnd, PhasePriority, PhaseIndicators, PhasePredictions
+    LoggingInfo('Planning maintenance window ...')
+    history = LoadPhaseHistory()
+    if WindowEnd is not None:
+        PhaseIndicators = GatherPhaseIndicators()
+        LoggingInfo('    Indicators: %s' % PhaseIndicators)
+    for phase in DefaultPhaseSeconds.keys():
+        PhasePredictions[phase] = PredictPhaseSeconds(phase, history)
+    if WindowEnd is None:
+        LoggingInfo('    Predicted duration: %s' % datetime.timedelta(seconds=int(PredictedSeconds(PlannedPhases()))))
+        return
+    #
+    # Only phases before services are restored count against the window.
+    #
+    PredictedEnd = lambda: datetime.datetime.now() + datetime.timedelta(seconds=PredictedSeconds([p for p in PlannedPhases()
+                                                                                                     if p != 'OnlineIndexes']))
+    for task in reversed(PhasePriority):
+        if PredictedEnd() <= WindowEnd:
+            break
+        if task == 'Versions' and Versions:
+            Versions = False
+        elif task == 'Compress' and Compress:
+            Compress = False
+        elif task == 'Import' and Import:
+            Import = False
+        elif task == 'Indexes' and Indexes and not Online:
+            Indexes = False
+        else:
+            continue
+        LoggingError('    Skipping /%s - predicted to end after %s' % (task, WindowEnd.strftime('%H:%M')))
+    LoggingInfo('    Predicted end: %s  Window end: %s' % (PredictedEnd().strftime('%H:%M:%S'), WindowEnd.strftime('%H:%M:%S')))
+
+def PlannedPhases():
+    '''Return the phases that will be run, given the maintenance tasks.'''
+    global Versions, Compress, Import, Indexes, Online, SharedShutdown
+    offlineIndexes = Indexes and not Online
+    phases = []
+    if (Versions or Compress or offlineIndexes) and not SharedShutdown:
+        phases += ['Shutdown']
+    if Versions or offlineIndexes:
+        phases += ['Drain']
+    if Versions:
+        phases += ['Reconcile']
+    if Compress:
+        phases += ['Compress']
+    if Versions:
+        phases += ['CreateVersions']
+    if Import:
+        phases += ['Import']
+    if offlineIndexes:
+        phases += ['Indexes']
+    if (Versions or Compress or offlineIndexes) and not SharedShutdown:
+        phases += ['Restore']
+    if Indexes and Online:
+        phases += ['OnlineIndexes']
+    return [p for p in phases if not PhaseCompleted(p)]
+
+def PredictedSeconds(phases):
+    global PhasePredictions
+    return sum([PhasePredictions[p] for p in phases])
+
+def RunPhase(phase, functions, required=False):
+    '''Run the given functions as one phase, and record its duration.
+       If the phase is not required and a maintenance window is in effect,
+       skip it unless it is predicted to leave time to restore services.
+       Skip it if the run being resumed completed it.
+       Return True if the phase was run, now or by that run.'''
+    global ExecutionSuccessful, PhasePredictions, WindowEnd
+    if PhaseCompleted(phase):
+        LoggingInfo('Skipping %s - completed by the run started at %s' % (phase, Journal['started']))
+        return True
+    if WindowEnd is not None and not required:
+        end = datetime.datetime.now() + datetime.timedelta(seconds=PredictedSeconds([phase, 'Restore']))
+        if end > WindowEnd:
+            ExecutionSuccessful = False
+            LoggingError('Skipping %s - predicted to end at %s, after %s' % (phase, end.strftime('%H:%M:%S'), WindowEnd.strftime('%H:%M')))
+            return False
+    startTime = datetime.datetime.now()
+    try:
+        for function in functions:
+            function()
+    finally:
+        RecordPhase(phase, startTime)
+    RecordPhaseCompleted(phase)
+    return True
+
+def RecordPhase(phase, startTime):
+    global PhaseTimings
+    seconds = (datetime.datetime.now() - startTime).total_seconds()
+    PhaseTimings.append({'phase': phase, 'seconds': seconds})
+
+def GatherPhaseIndicators():
+    '''Return the current value of each indicator of how much work maintenance will do.
+       An indicator that cannot be determined is omitted.'''
+    global DatabaseServer_Database_sde, Indexes
+    indicators = {}
+    try:
+        indicators['versions'] = len([v for v in arcpy.da.ListVersions(DatabaseServer_Database_sde)
+                                            if v.parentVersionName])
+    except BaseException, e:
+        LoggingError('    Unable to count versions: %s' % e)
+    try:
+        indicators['deltaRows'] = sum([c['adds'] + c['deletes'] for c in DeltaTableRows().values()])
+    except BaseException, e:
+        LoggingError('    Unable to count delta table rows: %s' % e)
+    if not Indexes:
+        return indicators
+    try:
+        sql  = "SELECT SUM(page_count) FROM sys.dm_db_index_physical_stats(DB_ID(), NULL, NULL, NULL, 'LIMITED') "
+        sql += "WHERE index_id > 0 AND avg_fragmentation_in_percent > 10"
+        indicators['fragmentedPages'] = int(SDEQuery(sql)[0][0] or 0)
+    except BaseException, e:
+        LoggingError('    Unable to measure index fragmentation: %s' % e)
+    return indicators
+
+def PredictPhaseSeconds(phase, history):
+    '''Predict the duration of the given phase, in seconds.'''
+    global DefaultPhaseSeconds, PhaseIndicator, PhaseIndicators
+    samples = [(run['indicators'].get(PhaseIndicator.get(phase)), t['seconds'])
+                  for run in history
+                      for t in run['phases']
+                          if t['phase'] == phase]
+    if samples == []:
+        return DefaultPhaseSeconds[phase]
+    x = PhaseIndicators.get(PhaseIndicator.get(phase))
+    points = [(xi, yi) for (xi, yi) in samples if xi is not None]
+    if x is not None and len(set([xi for (xi, yi) in points])) >= 2:
+        n = float(len(points))
+        meanX = sum([xi for (xi, yi) in points]) / n
+        meanY = sum([yi for (xi, yi) in points]) / n
+        slope = sum([(xi - meanX) * (yi - meanY) for (xi, yi) in points]) / \
+                sum([(xi - meanX) ** 2 for (xi, yi) in points])
+        slope = max(slope, 0.0)
+        return max(meanY + slope * (x - meanX), 0.0)
+    durations = sorted([yi for (xi, yi) in samples])
+    return durations[len(durations) / 2]
+
+def LoadPhaseHistory():
+    '''Return the most recent runs recorded in PhaseHistoryFile.'''
+    global PhaseHistoryFile, PhaseHistoryRuns
+    if not os.path.exists(PhaseHistoryFile):
+        return []
+    try:
+        f = open(PhaseHistoryFile, 'r')
+        history = [json.loads(line) for line in f.readlines() if line.strip() != '']
+        f.close()
+        return history[-PhaseHistoryRuns:]
+    except BaseException, e:
+        LoggingError('    Unable to read %s: %s' % (PhaseHistoryFile, e))
+        return []
+
+def ReportPhaseTimings():
+    '''Log the predicted and actual duration of each phase, and append them to PhaseHistoryFile.'''
+    global ExecutionStartTime, PhaseHistoryFile, PhaseIndicators, PhasePredictions, PhaseTimings
+    try:
+        if PhaseTimings == []:
+            return
+        LoggingInfo('Phase durations:')
+        LoggingInfo('    %-16s  %-10s  %s' % ('Phase', 'Predicted', 'Actual'))
+        LoggingInfo('    %-16s  %-10s  %s' % ('-----', '---------', '------'))
+        for t in PhaseTimings:
+            predicted = datetime.timedelta(seconds=int(PhasePredictions.get(t['phase'], 0)))
+            actual = datetime.timedelta(seconds=int(t['seconds']))
+            LoggingInfo('    %-16s  %-10s  %s' % (t['phase'], predicted, actual))
+        record = {'started': ExecutionStartTime.strftime('%Y-%m-%d %H:%M:%S'),
+                  'indicators': PhaseIndicators,
+                  'predictions': PhasePredictions,
+                  'phases': PhaseTimings}
+        f = open(PhaseHistoryFile, 'a')
+        f.write(json.dumps(record) + '\n')
+        f.close()
+    except BaseException, e:
+        LoggingError('Unable to record phase durations: %s' % e)
+
 ################################################################################
 
 #
@@ -321,27 +1251,106 @@ def DeleteOldLogFiles():
 #     It restarts the ArcGIS Server Object Manager service on Arctic,
 #     which causes maintenance tasks to hang.
 #
+#   - Query the state of every task on each server with a single schtasks
+#     command, and save the states in TaskStatesFile before changing them.
+#     Only tasks that are enabled are disabled, concurrently.  EnableTasks()
+#     re-enables exactly the tasks that were enabled beforehand.
+#
+#   - If TaskStatesFile still exists, a previous run disabled tasks but did not
+#     re-enable them.  The states it recorded are kept, so tasks that run
+#     left disabled are still re-enabled at the end of this run.
+#
 
 def DisableTasks():
-    global ExecutionSuccessful, TaskServer_Tasks
+    global ExecutionSuccessful, TaskServer_Tasks, TaskServer_TaskStates
     LoggingInfo('Disabling scheduled tasks ...')
     try:
-        for (server, tasks) in TaskServer_Tasks.items():
-            for task in tasks:
-                success = DisableTask(task, server)
-                assert success, 'Unable to disable scheduled task %s on server %s' % (task, server)
+        TaskServer_TaskStates = LoadTaskStates()
+        if TaskServer_TaskStates is None:
+            TaskServer_TaskStates = QueryTaskStates()
+            SaveTaskStates(TaskServer_TaskStates)
+        changes = [(server, task)
+                      for (server, tasks) in TaskServer_Tasks.items()
+                          for task in tasks
+                              if CurrentTaskState(task, server) != 'Disabled']
+        results = MapConcurrently(lambda (server, task): DisableTask(task, server), changes, TaskWorkers)
+        for ((server, task), success) in zip(changes, results):
+            assert success, 'Unable to disable scheduled task %s on server %s' % (task, server)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingCritical(e)
         raise e
 
 def DisableTask(taskname, server=os.environ['COMPUTERNAME']):
+    global SchTasks
     LoggingInfo('    Disabling task %s on server %s' % (taskname, server))
-    cmd = r'schtasks /Change /S %s /TN "%s" /Disable' % (server, taskname)
+    cmd = r'%s /Change /S %s /TN "%s" /Disable' % (SchTasks, server, taskname)
     output = RunCommand(cmd)
     success = ParseSchTasksCommandOutput(output)
     return success
 
+def QueryTaskStates():
+    '''Return a dictionary which maps each server in TaskServer_Tasks to a
+       dictionary which maps each of its tasks to its state (Ready, Running, Disabled, ...).'''
+    global TaskServer_Tasks, TaskWorkers
+    servers = TaskServer_Tasks.keys()
+    task_states = MapConcurrently(QueryTasks, servers, TaskWorkers)
+    server_task_states = {}
+    for (server, task_state) in zip(servers, task_states):
+        server_task_states[server] = {}
+        for task in TaskServer_Tasks[server]:
+            assert task.lower() in task_state, 'Scheduled task %s does not exist on server %s' % (task, server)
+            server_task_states[server][task] = task_state[task.lower()]
+        LoggingInfo('        %s: %s' % (server, server_task_states[server]))
+    return server_task_states
+
+def QueryTasks(server=os.environ['COMPUTERNAME']):
+    '''What is the state of each scheduled task on the given server?
+       Return a dictionary which maps lower case task names to states.'''
+    global SchTasks, CommandCacheSeconds
+    LoggingInfo('    Querying scheduled tasks on server %s ...' % server)
+    cmd = r'%s /Query /S %s /FO CSV /NH' % (SchTasks, server)
+    output = RunCommand(cmd, cacheSeconds=CommandCacheSeconds)
+    return ParseSchTasksQueryOutput(output)
+
+def ParseSchTasksQueryOutput(lines):
+    #
+    # Example input:
+    #
+    #   "\NNWW\ImportGisScadaReadings","10/20/2016 1:00:00 AM","Ready"
+    #   "\NNWW\RefreshMapServices","N/A","Disabled"
+    #
+    # Example output:
+    #
+    #   {'\\nnww\\importgisscadareadings': 'Ready', '\\nnww\\refreshmapservices': 'Disabled'}
+    #
+    task_state = {}
+    for row in csv.reader([line for line in lines if line.strip() != '']):
+        if len(row) >= 3 and row[0].startswith('\\'):
+            task_state[row[0].lower()] = row[2]
+    return task_state
+
+def CurrentTaskState(task, server):
+    global TaskServer_TaskStates
+    return TaskServer_TaskStates[server][task]
+
+def LoadTaskStates():
+    '''Return the task states saved by a run that did not re-enable its tasks, or None.'''
+    global TaskStatesFile
+    if not os.path.exists(TaskStatesFile):
+        return None
+    LoggingInfo('    Using task states saved in %s by a previous run' % TaskStatesFile)
+    f = open(TaskStatesFile, 'r')
+    server_task_states = json.load(f)
+    f.close()
+    return server_task_states
+
+def SaveTaskStates(server_task_states):
+    global TaskStatesFile
+    f = open(TaskStatesFile, 'w')
+    json.dump(server_task_states, f, indent=1)
+    f.close()
+
 def ParseSchTasksCommandOutput(lines):
     #
     # Example input:
@@ -366,6 +1375,9 @@ def ParseSchTasksCommandOutput(lines):
 # - Display each scheduled task on server Arctic along with its next run time and status.
 #   schtasks /Query /S Arctic
 #
+# - Display the same information as comma separated values, without a header line.
+#   schtasks /Query /S Arctic /FO CSV /NH
+#
 # - Disable scheduled task "RefreshMapservices" on server Arctic:
 #   schtasks /Change /S Arctic /TN "RefreshMapservices" /Disable
 #
@@ -385,31 +1397,38 @@ def ParseSchTasksCommandOutput(lines):
 #
 
 def StopServices():
-    global ExecutionSuccessful, ServiceServer_Services
+    global ExecutionSuccessful, ServiceServer_Services, ServiceWorkers
     LoggingInfo('Stopping services ...')
     try:
         IdentifyRunningServices()
-        for (server, services) in ServiceServer_Services.items():
-            services.sort(reverse=True)
-            for service in services:
-                stopDateTime = datetime.datetime.now() + datetime.timedelta(minutes=10)
-                state = StopService(service, server)
-                while state != 'STOPPED':
-                    assert datetime.datetime.now() < stopDateTime, 'Unable to stop service %s on server %s' % (service, server)
-                    Pause(seconds=10)
-                    state = QueryService(service, server)
+        #
+        # Stop services on different servers concurrently.
+        #
+        MapConcurrently(lambda (server, services): StopServerServices(server, services),
+                        ServiceServer_Services.items(), ServiceWorkers)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingCritical(e)
         raise e
 
+def StopServerServices(server, services):
+    '''Stop the given services on the given server, one after the other.'''
+    services.sort(reverse=True)
+    for service in services:
+        stopDateTime = datetime.datetime.now() + datetime.timedelta(minutes=10)
+        state = StopService(service, server)
+        while state != 'STOPPED':
+            assert datetime.datetime.now() < stopDateTime, 'Unable to stop service %s on server %s' % (service, server)
+            Pause(seconds=10)
+            state = QueryService(service, server)
+
 def IdentifyRunningServices():
     '''Determine which GIS services are currently running on each remote server.
        Save lists in ServiceServer_Services.'''
-    global Services, ServiceServer_Services
+    global Services, ServiceServer_Services, ServiceWorkers
     LoggingInfo('    Identifying running services ...')
-    for server in ServiceServers:
-        service_state = QueryServices(server)
+    service_states = MapConcurrently(QueryServices, ServiceServers, ServiceWorkers)
+    for (server, service_state) in zip(ServiceServers, service_states):
         services = []
         for (service, state) in service_state.items():
             if service in Services and state in ['RUNNING', 'START_PENDING']:
@@ -421,11 +1440,12 @@ def IdentifyRunningServices():
 def QueryServices(server=os.environ['COMPUTERNAME']):
     '''What is the state of each service on the given server?
        (A state is STOPPED, START_PENDING, STOP_PENDING, or RUNNING.)'''
+    global CommandCacheSeconds
     LoggingInfo('    Querying services on server %s ...' % server)
     # The Windows SC command communicates with the Service Controller and
     # installed services on a remote machine.
     cmd = r'sc \\%s query state= all' % server
-    output = RunCommand(cmd)
+    output = RunCommand(cmd, cacheSeconds=CommandCacheSeconds)
     service_state = ParseSCCommandOutput(output)
     return service_state
 
@@ -534,33 +1554,115 @@ def StopAcceptingConnections():
 ################################################################################
 
 #
-# Send warning mail
+# Drain users
+#
+#   - Determine which Windows users are currently connected to the database.
+#   - Separate idle connections from active ones - connections that hold an
+#     exclusive state lock (an open edit session) or an open transaction.
+#   - Disconnect idle connections immediately.
+#   - Send mail warning users with active connections that they will be
+#     disconnected from the database in 15 minutes to enable automated
+#     maintenance work to proceed, and send them a reminder shortly before
+#     the deadline.
+#   - Wait until 15 minutes have passed or no Windows user has an active
+#     connection, whichever comes first.  Connections that become idle while
+#     waiting are disconnected as soon as they are seen.
+#   - Save the email addresses of all Windows users who were connected in the
+#     NotificationMailRecipients list.
 #
-#   - Determine which Windows users are currently connected to the database, and
-#     save their email addresses in the NotificationMailRecipients list.
-#   - Send mail warning them that they will be disconnected from the database in
-#     15 minutes to enable automated maintenance work to proceed.
-#   - Wait 15 minutes for users to finish their work before disconnecting them.
+#   If active connections cannot be identified, every connection is treated as
+#   active, so users are warned and given the full 15 minutes.
 #
 
-def SendWarningMail():
-    global DatabaseServer_Database_sde, DatabaseUsers, MailSender, MailServer, NotificationMailRecipients
-    LoggingInfo('Sending warning email ...')
+def DrainUsers():
+    global DrainMinutes, DrainReminderMinutes, NotificationMailRecipients
+    LoggingInfo('Draining user connections ...')
     NotificationMailRecipients = ['%s@nnva.gov' % u
                                      for u in ConnectedWindowsUsers()]
-    if NotificationMailRecipients != []:
-        LoggingInfo('    Sending email to %s ...' % repr(NotificationMailRecipients))
-        subject = 'Please Disconnect from the GIS Database'
-        body =  'Please save your edits, stop editing, and disconnect from the GIS database.\n\r'
-        body += 'Automated GIS maintenance will begin in 15 minutes.\n\r\n\r'
-        body += 'This message was sent by an automated process.  Please do not reply.\n\r'
-        SendMail(MailServer, MailSender, NotificationMailRecipients, subject, body)
-        # Wait until 15 minutes have passed or all Windows users have disconnected
-        # from the database, whichever comes first.
-        deadline = datetime.datetime.now() + datetime.timedelta(minutes=15)
-        while datetime.datetime.now() < deadline and \
-              ConnectedWindowsUsers() != []:
-            Pause(minutes=1)
+    deadline = datetime.datetime.now() + datetime.timedelta(minutes=DrainMinutes)
+    warnedUsers = []
+    reminded = False
+    while True:
+        (idle, active) = ClassifyWindowsConnections()
+        if idle != []:
+            DisconnectConnections(idle)
+        activeUsers = sorted(set([u.Name.lower() for u in active]))
+        if activeUsers == []:
+            LoggingInfo('    No Windows users have active connections')
+            break
+        if datetime.datetime.now() >= deadline:
+            LoggingInfo('    Users still active after %i minutes: %s' % (DrainMinutes, activeUsers))
+            break
+        minutesLeft = int(round((deadline - datetime.datetime.now()).total_seconds() / 60))
+        newUsers = [u for u in activeUsers if u not in warnedUsers]
+        if newUsers != []:
+            SendWarningMail(newUsers, minutesLeft)
+            warnedUsers += newUsers
+        elif not reminded and minutesLeft <= DrainReminderMinutes:
+            SendWarningMail(activeUsers, minutesLeft)
+            reminded = True
+        Pause(minutes=1)
+
+#
+# Send warning mail
+#
+#   - Send mail to the given Windows users warning them that they will be
+#     disconnected from the database in the given number of minutes.
+#
+
+def SendWarningMail(users, minutes):
+    global MailSender, MailServer
+    LoggingInfo('Sending warning email ...')
+    recipients = ['%s@nnva.gov' % u
+                     for u in users]
+    LoggingInfo('    Sending email to %s ...' % repr(recipients))
+    subject = 'Please Disconnect from the GIS Database'
+    body =  'Please save your edits, stop editing, and disconnect from the GIS database.\n\r'
+    body += 'Automated GIS maintenance will begin in %i minutes.\n\r\n\r' % minutes
+    body += 'This message was sent by an automated process.  Please do not reply.\n\r'
+    SendMail(MailServer, MailSender, recipients, subject, body)
+
+def ClassifyWindowsConnections():
+    '''Return two lists of the connections of Windows users: idle connections,
+       and connections with an open edit session or transaction.'''
+    global DatabaseServer_Database_sde, DatabaseUsers
+    connections = [u
+                      for u in arcpy.ListUsers(DatabaseServer_Database_sde)
+                          if u.Name.lower() not in DatabaseUsers]
+    activeIds = ActiveConnectionIds()
+    if activeIds is None:
+        return ([], connections)
+    idle   = [u for u in connections if u.ID not in activeIds]
+    active = [u for u in connections if u.ID in activeIds]
+    LoggingInfo('    Windows user connections: %i idle, %i active' % (len(idle), len(active)))
+    return (idle, active)
+
+def ActiveConnectionIds():
+    '''Return the set of connection (sde) ids that hold an exclusive state lock
+       or have an open transaction.  Return None if they cannot be determined.'''
+    #
+    # An edit session holds an exclusive lock on the state it is editing.
+    # An open transaction shows up in sys.dm_tran_session_transactions for
+    # the connection's SQL Server session (spid).
+    #
+    sql  = "SELECT sde_id FROM sde.SDE_state_locks WHERE lock_type = 'E' "
+    sql += "UNION "
+    sql += "SELECT p.sde_id FROM sde.SDE_process_information p "
+    sql += "JOIN sys.dm_tran_session_transactions t ON t.session_id = p.spid"
+    try:
+        return set([int(row[0]) for row in SDEQuery(sql)])
+    except BaseException, e:
+        LoggingError('    Unable to identify active connections: %s' % e)
+        return None
+
+def DisconnectConnections(connections):
+    '''Disconnect the given connections (from arcpy.ListUsers) from the database.'''
+    global DatabaseServer_Database_sde
+    LoggingInfo('    Disconnecting idle connections %s ...' % ['%s (%s)' % (u.Name, u.ID) for u in connections])
+    try:
+        arcpy.DisconnectUser(DatabaseServer_Database_sde, [u.ID for u in connections])
+    except BaseException, e:
+        LoggingError(e)
 
 def ConnectedWindowsUsers():
     return [u
@@ -598,96 +1700,336 @@ def DisconnectUsers():
 #
 #   - For each version, except the default version:
 #
-#       - Reconcile version - bring edits from an ancestor (the target version)
+#       - Reconcile version - bring edits from its parent (the target version)
 #         into the edit version.
 #
-#         If conflicts are detected, abort the reconcile.  This may cause some,
-#         but not all, versions to be deleted.  When this happens, conflicts
-#         should be resolved manually - the administrator should decide whether
-#         to keep edits from the target version or edits from the edit version.
+#         If conflicts are detected, abort the reconcile of that version only.
+#         The version and its ancestors are kept, and every other version is
+#         still posted and deleted.  When this happens, conflicts should be
+#         resolved manually - the administrator should decide whether to keep
+#         edits from the target version or edits from the edit version.
 #
 #       - Post version - merge all edits made in the edit version into the
 #         target version, making both versions identical.
 #
 #       - Delete version.
+#
+#   - Versions are processed leaves first, so that a version's children have
+#     been posted into it and deleted before it is posted into its own parent.
+#     Every version that is deleted lets the following compress trim more of
+#     the state tree.
+#
+#   - Versions with different parents do not lock each other's target version,
+#     so they are reconciled concurrently, each group of versions with the same
+#     parent in its own process.  (arcpy is not thread-safe.)  The process is
+#     this program run with /ReconcileGroup, which reconciles the versions of
+#     its group one after the other and saves their outcomes in a result file.
+#
+#   - If a group's process fails, the versions it did not report are FAILED,
+#     and their ancestors are SKIPPED, since edits may not have been posted
+#     into them.  Every other group is still reconciled, and the compress
+#     still runs.
+#
+#   - The time taken to reconcile each version is logged and saved in
+#     VersionTimings.
+#
 
 def ReconcilePostDeleteVersions():
     global DatabaseServer_Database_sde, ExecutionSuccessful, VersionsLogFile
+    global ReconcileWorkers, VersionTimings
     LoggingInfo('Reconciling, posting and deleting versions ...')
     try:
-        #
-        # ALL_VERSIONS = Reconcile edit versions with the target version.
-        # BLOCKING_VERSIONS = Reconcile versions that are blocking the target version
-        #     from compressing.  Use the recommended reconcile order.
-        #
-        reconcileMode = 'ALL_VERSIONS'
-        #
-        # The target version is a version in the direct ancestry of an edit version,
-        # such as the parent version or the default version.  It typically contains
-        # edits from other versions that the user performing the reconcile would like
-        # to pull into their edit version.
-        #
-        targetVersion = 'sde.DEFAULT'
-        #
-        # Reconcile these edit versions with the target version.
-        #
-        editVersionList = arcpy.ListVersions(DatabaseServer_Database_sde)
-        #
-        # LOCK_ACQUIRED = Acquire locks during the reconcile process.  Use this when
-        #     edits will be posted.  It ensures that the target version is not
-        #     modified in the time between the reconcile and post operations.
-        # NO_LOCK_ACQUIRED = Do not acquire locks during the reconcile process.  This
-        #     allows multiple users to reconcile in parallel.  Use this when the
-        #     edit version will not be posted to the target version because the
-        #     target version might be modified in the time between the reconcile and
-        #     post operations.
-        #
-        acquireLocks = 'LOCK_ACQUIRED'
-        #
-        # BY_OBJECT = During reconcile, treat as a conflict changes to the same
-        #     feature (record) in the parent and child versions.
-        # BY_ATTRIBUTE = During reconcile, treat as a conflict changes to the same
-        #     attribute (field) of the same feature (record) in the parent and child
-        #     versions.
-        #
-        conflictDefinition = 'BY_ATTRIBUTE'
-        #
-        # ABORT_CONFLICTS = Abort the reconcile if conflicts are found between the
-        #     target version and the edit version.
-        # NO_ABORT = Do not abort the reconcile if conflicts are found between the
-        #     target version and the edit version.
-        #
-        abortIfConflicts = 'ABORT_CONFLICTS'
-        #
-        # FAVOR_TARGET_VERSION = Resolve conflicts in favor of the target version.
-        # FAVOR_EDIT_VERSION = Resolve conflicts in favor of the edit version.
-        #
-        conflictResolution = 'FAVOR_EDIT_VERSION'
-        #
-        # POST = After the reconcile, post the current edit version to the target
-        #     version.
-        # NO_POST = After the reconcile, do not post the current edit version to the
-        #     target version.
-        #
-        withPost = 'POST'
-        #
-        # DELETE_VERSION = Delete the current edit version after it is reconciled
-        #     and posted to the target version.
-        # KEEP_VERSION = Do not delete the current edit version after it is
-        #     reconciled and posted to the target version.
-        #
-        withDelete = 'DELETE_VERSION'
-        #
-        # Write geoprocessing messages to an ASCII log file.
-        #
-        arcpy.ReconcileVersions_management(DatabaseServer_Database_sde, reconcileMode, targetVersion, editVersionList,
-                                           acquireLocks, abortIfConflicts, conflictDefinition, conflictResolution,
-                                           withPost, withDelete, VersionsLogFile)
+        VersionTimings = []
+        version_parent = dict((v.name, v.parentVersionName)
+                                  for v in arcpy.da.ListVersions(DatabaseServer_Database_sde))
+        retainedVersions = set()
+        failedVersions = set()
+        groupCount = 0
+        for (wave, versions) in enumerate(PlanReconcile(version_parent)):
+            #
+            # Skip the versions with a child that failed or was skipped.
+            #
+            for version in versions:
+                failedChildren = sorted(c for c in failedVersions if version_parent[c] == version)
+                if failedChildren != []:
+                    LoggingError('    Version %s skipped: its children %s were not reconciled' % (version, failedChildren))
+                    VersionTimings.append({'version': version, 'target': version_parent[version], 'outcome': 'SKIPPED',
+                                           'seconds': 0, 'retainedChildren': failedChildren})
+                    failedVersions.add(version)
+                    retainedVersions.add(version)
+            versions = [v for v in versions if v not in failedVersions]
+            #
+            # Group the versions in this wave by target version.
+            # Each group is reconciled by its own process.
+            #
+            parent_versions = {}
+            for version in versions:
+                parent_versions.setdefault(version_parent[version], []).append(version)
+            LoggingInfo('    Wave %i: %s' % (wave + 1, parent_versions))
+            groups = [(groupCount + i, parent, children) for (i, (parent, children)) in enumerate(sorted(parent_versions.items()))]
+            groupCount += len(groups)
+            results = MapConcurrently(lambda (index, parent, children): ReconcileVersionGroup(index, parent, children, version_parent, retainedVersions),
+                                      groups, ReconcileWorkers)
+            for timings in results:
+                VersionTimings += timings
+                retainedVersions.update([t['version'] for t in timings if t['outcome'] != 'DELETED'])
+                failedVersions.update([t['version'] for t in timings if t['outcome'] == 'FAILED'])
+        MergeVersionLogFiles()
+        LogVersionTimings()
+        conflictVersions = [t['version'] for t in VersionTimings if t['outcome'] == 'CONFLICTS']
+        if conflictVersions != []:
+            ExecutionSuccessful = False
+            LoggingError('Reconcile aborted due to conflicts in versions %s.  Resolve the conflicts manually.' % conflictVersions)
+        if failedVersions:
+            ExecutionSuccessful = False
+            LoggingError('Reconcile failed or was skipped for versions %s.  See the reconcile logs.' % sorted(failedVersions))
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingCritical(e)
         raise e
 
+def PlanReconcile(version_parent):
+    '''Given a dictionary which maps each version name to its parent version name,
+       return a list of waves - lists of versions to be reconciled together.
+       A version appears in a later wave than all of its descendants.
+       The default version (which has no parent) is not reconciled.'''
+    #
+    # Example input:
+    #
+    #   {'sde.DEFAULT': None,
+    #    'DBO.SAP_GIS_Interface': 'sde.DEFAULT',
+    #    'DBO.ArcGISContainer': 'DBO.SAP_GIS_Interface',
+    #    'DBO.AW_GIS_Interface': 'sde.DEFAULT'}
+    #
+    # Example output:
+    #
+    #   [['DBO.AW_GIS_Interface', 'DBO.ArcGISContainer'], ['DBO.SAP_GIS_Interface']]
+    #
+    parent_children = {}
+    for (version, parent) in version_parent.items():
+        if parent:
+            parent_children.setdefault(parent, []).append(version)
+    height = {}
+    def Height(version):
+        # Length of the longest path from the given version down to a leaf.
+        if version not in height:
+            height[version] = 1 + max([Height(c) for c in parent_children.get(version, [])] + [-1])
+        return height[version]
+    waves = []
+    for version in sorted(version_parent.keys()):
+        if version_parent[version]:
+            h = Height(version)
+            while len(waves) <= h:
+                waves.append([])
+            waves[h].append(version)
+    return waves
+
+def ReconcileVersionGroup(index, parent, versions, version_parent, retainedVersions):
+    '''Reconcile, post and delete the given versions, which share the given parent,
+       one after the other, in a new process, and wait for it to finish.
+       Return the outcome and elapsed time of each version's reconcile.
+       If the process fails, the versions it did not report are FAILED.
+       When simulating, the process is seeded with the simulation seed plus the
+       index of the group, so that each group draws its own latencies.'''
+    global ExecutionSuccessful, ApplicationServer, DatabaseServer, Database, VersionsLogFile, DatabaseLogFiles, LogShipped
+    global Simulation, SimulationConfigFile, SimulationConfig, SimulationVersions
+    name = '%s_Reconcile_%s' % (os.path.splitext(VersionsLogFile)[0], parent.replace('.', '_'))
+    logFile = '%s.log' % name
+    groupFile = '%s.json' % name
+    cmd = [sys.executable, os.path.abspath(sys.argv[0]), '/AppServer', ApplicationServer,
+           '/DBServer', DatabaseServer, '/Database', Database, '/ReconcileGroup', groupFile]
+    if Simulation:
+        cmd += ['/Simulate'] + [f for f in [SimulationConfigFile] if f]
+    LoggingInfo('    Starting reconcile of %s into %s' % (versions, parent))
+    DatabaseLogFiles.append(logFile)
+    exitStatus = None
+    try:
+        group = {'parent': parent,
+                 'versionsLogFile': VersionsLogFile,
+                 'versions': [[version, [c for (c, p) in sorted(version_parent.items()) if p == version and c in retainedVersions]]
+                                 for version in versions]}
+        if Simulation:
+            group['seed'] = SimulationConfig.get('seed', 1) + index
+        f = open(groupFile, 'w')
+        json.dump(group, f, indent=1)
+        f.close()
+        f = open(logFile, 'w')
+        try:
+            exitStatus = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT).wait()
+        finally:
+            f.close()
+    except BaseException, e:
+        LoggingError('    Unable to start reconcile of %s into %s: %s' % (versions, parent, e))
+    result = {'successful': False}
+    try:
+        f = open(groupFile, 'r')
+        result = json.load(f)
+        f.close()
+        os.remove(groupFile)
+    except BaseException, e:
+        LoggingError('    Unable to read result of reconcile of %s from %s: %s' % (versions, groupFile, e))
+    timings = result.get('timings', [])
+    for (shippedFile, shipped) in result.get('shipped', {}).items():
+        LogShipped[shippedFile] = tuple(shipped)
+    if Simulation:
+        SimulateStep('ReconcileVersionGroup', parent, sum([t['seconds'] for t in timings]))
+        for t in timings:
+            if t['outcome'] == 'DELETED':
+                SimulationVersions.pop(t['version'], None)
+    if not (exitStatus == 0 and result.get('successful')):
+        ExecutionSuccessful = False
+        LoggingError('Reconcile of %s into %s failed with exit status %s.  See %s' % (versions, parent, exitStatus, logFile))
+        reported = [t['version'] for t in timings]
+        timings += [{'version': version, 'target': parent, 'outcome': 'FAILED', 'seconds': 0, 'retainedChildren': []}
+                       for version in versions if version not in reported]
+    return timings
+
+def ReconcileVersionGroupProcess():
+    '''With /ReconcileGroup, reconcile the versions given in ResultFile one after the other,
+       and save their outcomes in it for the process that started this one.'''
+    global ExecutionSuccessful, ResultFile, VersionsLogFile, VersionTimings, LogShipped, Simulation
+    try:
+        try:
+            Initialize()
+            f = open(ResultFile, 'r')
+            group = json.load(f)
+            f.close()
+            VersionsLogFile = group['versionsLogFile']
+            if Simulation and 'seed' in group:
+                random.seed(group['seed'])
+            for (version, retainedChildren) in group['versions']:
+                ReconcileVersion(version, group['parent'], retainedChildren)
+        except BaseException, e:
+            ExecutionSuccessful = False
+            LoggingCritical(e)
+            raise e
+    finally:
+        StopLogging()
+        try:
+            f = open(ResultFile, 'w')
+            json.dump({'successful': ExecutionSuccessful,
+                       'timings': VersionTimings,
+                       'shipped': LogShipped}, f, indent=1)
+            f.close()
+        except BaseException, e:
+            Log(logging.ERROR, 'Unable to save result in %s: %s' % (ResultFile, e))
+
+def ReconcileVersion(version, targetVersion, retainedChildren):
+    '''Reconcile the given version with its parent (the target version) and post it.
+       Delete it unless some of its children were retained.
+       Return DELETED, POSTED (posted and kept), or CONFLICTS.'''
+    global DatabaseServer_Database_sde, VersionTimings
+    #
+    # ALL_VERSIONS = Reconcile edit versions with the target version.
+    # BLOCKING_VERSIONS = Reconcile versions that are blocking the target version
+    #     from compressing.  Use the recommended reconcile order.
+    #
+    reconcileMode = 'ALL_VERSIONS'
+    #
+    # LOCK_ACQUIRED = Acquire locks during the reconcile process.  Use this when
+    #     edits will be posted.  It ensures that the target version is not
+    #     modified in the time between the reconcile and post operations.
+    # NO_LOCK_ACQUIRED = Do not acquire locks during the reconcile process.  This
+    #     allows multiple users to reconcile in parallel.  Use this when the
+    #     edit version will not be posted to the target version because the
+    #     target version might be modified in the time between the reconcile and
+    #     post operations.
+    #
+    acquireLocks = 'LOCK_ACQUIRED'
+    #
+    # BY_OBJECT = During reconcile, treat as a conflict changes to the same
+    #     feature (record) in the parent and child versions.
+    # BY_ATTRIBUTE = During reconcile, treat as a conflict changes to the same
+    #     attribute (field) of the same feature (record) in the parent and child
+    #     versions.
+    #
+    conflictDefinition = 'BY_ATTRIBUTE'
+    #
+    # ABORT_CONFLICTS = Abort the reconcile if conflicts are found between the
+    #     target version and the edit version.
+    # NO_ABORT = Do not abort the reconcile if conflicts are found between the
+    #     target version and the edit version.
+    #
+    abortIfConflicts = 'ABORT_CONFLICTS'
+    #
+    # FAVOR_TARGET_VERSION = Resolve conflicts in favor of the target version.
+    # FAVOR_EDIT_VERSION = Resolve conflicts in favor of the edit version.
+    #
+    conflictResolution = 'FAVOR_EDIT_VERSION'
+    #
+    # POST = After the reconcile, post the current edit version to the target
+    #     version.
+    # NO_POST = After the reconcile, do not post the current edit version to the
+    #     target version.
+    #
+    withPost = 'POST'
+    #
+    # DELETE_VERSION = Delete the current edit version after it is reconciled
+    #     and posted to the target version.
+    # KEEP_VERSION = Do not delete the current edit version after it is
+    #     reconciled and posted to the target version.
+    #
+    # A version cannot be deleted while it has children.
+    #
+    withDelete = 'DELETE_VERSION'
+    if retainedChildren != []:
+        withDelete = 'KEEP_VERSION'
+    LoggingInfo('    Reconciling version %s with %s (%s) ...' % (version, targetVersion, withDelete))
+    #
+    # Write geoprocessing messages to an ASCII log file for this version.
+    # (Reconciles in concurrent processes cannot share a log file.)
+    #
+    startTime = datetime.datetime.now()
+    result = arcpy.ReconcileVersions_management(DatabaseServer_Database_sde, reconcileMode, targetVersion, [version],
+                                                acquireLocks, abortIfConflicts, conflictDefinition, conflictResolution,
+                                                withPost, withDelete, VersionLogFile(version))
+    elapsedTime = datetime.datetime.now() - startTime
+    #
+    # With ABORT_CONFLICTS, a reconcile that finds conflicts ends with a
+    # warning (maxSeverity 1) instead of posting, and the version still exists.
+    #
+    aborted = result.maxSeverity >= 1
+    if aborted:
+        LoggingInfo('    Reconcile of %s ended with warnings: %s' % (version, result.getMessages(1)))
+    versionExists = version in [v.name for v in arcpy.da.ListVersions(DatabaseServer_Database_sde)]
+    if not versionExists:
+        outcome = 'DELETED'
+    elif withDelete == 'KEEP_VERSION' and not aborted:
+        outcome = 'POSTED'
+    else:
+        outcome = 'CONFLICTS'
+    VersionTimings.append({'version': version, 'target': targetVersion, 'outcome': outcome,
+                           'seconds': elapsedTime.total_seconds(), 'retainedChildren': retainedChildren})
+    LoggingInfo('    Version %s: %s in %s' % (version, outcome, str(elapsedTime).split('.')[0]))
+    return outcome
+
+def VersionLogFile(version):
+    global VersionsLogFile
+    return '%s_%s.log' % (os.path.splitext(VersionsLogFile)[0], version.replace('.', '_'))
+
+def MergeVersionLogFiles():
+    '''Append each per-version reconcile log to VersionsLogFile, and delete it.'''
+    global VersionTimings, VersionsLogFile
+    out = open(VersionsLogFile, 'a')
+    try:
+        for t in VersionTimings:
+            logFile = VersionLogFile(t['version'])
+            if os.path.exists(logFile):
+                f = open(logFile, 'r')
+                out.write(f.read())
+                f.close()
+                os.remove(logFile)
+    finally:
+        out.close()
+
+def LogVersionTimings():
+    global VersionTimings
+    LoggingInfo('    %-40s  %-40s  %-9s  %s' % ('Version', 'Target Version', 'Outcome', 'Elapsed Time'))
+    LoggingInfo('    %-40s  %-40s  %-9s  %s' % ('-------', '--------------', '-------', '------------'))
+    for t in VersionTimings:
+        elapsedTime = datetime.timedelta(seconds=int(t['seconds']))
+        LoggingInfo('    %-40s  %-40s  %-9s  %s' % (t['version'], t['target'], t['outcome'], elapsedTime))
+
 ################################################################################
 
 #
@@ -696,17 +2038,136 @@ def ReconcilePostDeleteVersions():
 #   - Reduce the amount of data the database must search through for each
 #     version query.
 #
+#   - Record the size of the state tree and of each delta table before and
+#     after compressing, and how long the compress took.  Append the record
+#     to CompressHistoryFile and log a report of the versions and tables that
+#     are preventing the state tree from collapsing.
+#
 
 def CompressDatabase():
     global DatabaseServer_Database_sde, ExecutionSuccessful
     LoggingInfo('Compressing database ...')
     try:
+        before = CompressStatistics()
+        startTime = datetime.datetime.now()
         arcpy.Compress_management(DatabaseServer_Database_sde)
+        elapsedTime = datetime.datetime.now() - startTime
+        after = CompressStatistics()
+        ReportCompress(before, after, elapsedTime)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingCritical(e)
         raise e
 
+def CompressStatistics():
+    '''Return the number of states and state lineages, the versions and the
+       length of their lineages, and the number of rows in each delta table.
+       Return None if they cannot be determined.'''
+    LoggingInfo('    Gathering state tree statistics ...')
+    try:
+        statistics = {}
+        statistics['states']   = SDEQuery('SELECT COUNT(*) FROM sde.SDE_states')[0][0]
+        statistics['lineages'] = SDEQuery('SELECT COUNT(*) FROM sde.SDE_state_lineages')[0][0]
+        #
+        # Each version points at a state.  The lineage of that state must be kept
+        # until the version is deleted or reconciled and posted.
+        #
+        sql  = "SELECT v.owner + '.' + v.name, v.state_id, COUNT(l.lineage_id) "
+        sql += "FROM sde.SDE_versions v "
+        sql += "JOIN sde.SDE_states s ON s.state_id = v.state_id "
+        sql += "JOIN sde.SDE_state_lineages l ON l.lineage_name = s.lineage_name AND l.lineage_id <= v.state_id "
+        sql += "GROUP BY v.owner, v.name, v.state_id"
+        statistics['versions'] = dict((name, {'state': int(state), 'lineage': int(lineage)})
+                                          for (name, state, lineage) in SDEQuery(sql))
+        statistics['deltas'] = DeltaTableRows()
+        return statistics
+    except BaseException, e:
+        LoggingError('    Unable to gather state tree statistics: %s' % e)
+        return None
+
+def DeltaTableRows():
+    '''Return a dictionary which maps each versioned table to the number of rows
+       in its adds table and its deletes table.'''
+    #
+    # Adds table a<registration_id> and deletes table D<registration_id> of
+    # each versioned table.  Row counts are read from sys.partitions rather
+    # than by counting rows.
+    #
+    sql  = "SELECT r.owner + '.' + r.table_name, LOWER(LEFT(t.name, 1)), SUM(p.rows) "
+    sql += "FROM sde.SDE_table_registry r "
+    sql += "JOIN sys.tables t ON t.name IN ('a' + CAST(r.registration_id AS VARCHAR), 'D' + CAST(r.registration_id AS VARCHAR)) "
+    sql += "JOIN sys.schemas c ON c.schema_id = t.schema_id AND c.name = r.owner "
+    sql += "JOIN sys.partitions p ON p.object_id = t.object_id AND p.index_id IN (0, 1) "
+    sql += "GROUP BY r.owner, r.table_name, t.name"
+    deltas = {}
+    for (table, kind, rows) in SDEQuery(sql):
+        counts = deltas.setdefault(table, {'adds': 0, 'deletes': 0})
+        counts[{'a': 'adds', 'd': 'deletes'}[kind]] = int(rows)
+    return deltas
+
+def ReportCompress(before, after, elapsedTime):
+    '''Log the effect of the compress and append it to CompressHistoryFile.'''
+    global CompressHistoryFile, CompressReportTables, ExecutionStartTime
+    LoggingInfo('    Compress took %s' % str(elapsedTime).split('.')[0])
+    record = {'started': ExecutionStartTime.strftime('%Y-%m-%d %H:%M:%S'),
+              'seconds': elapsedTime.total_seconds(),
+              'before': before,
+              'after': after}
+    try:
+        f = open(CompressHistoryFile, 'a')
+        f.write(json.dumps(record) + '\n')
+        f.close()
+    except BaseException, e:
+        LoggingError('    Unable to save compress statistics in %s: %s' % (CompressHistoryFile, e))
+    if before is None or after is None:
+        return
+    LoggingInfo('    States:          %8i -> %8i' % (before['states'], after['states']))
+    LoggingInfo('    State lineages:  %8i -> %8i' % (before['lineages'], after['lineages']))
+    DeltaRows = lambda statistics: sum([c['adds'] + c['deletes'] for c in statistics['deltas'].values()])
+    LoggingInfo('    Delta rows:      %8i -> %8i' % (DeltaRows(before), DeltaRows(after)))
+    #
+    # Versions preventing the state tree from collapsing - every version except
+    # the default version, with the longest lineages first.
+    # (After a full compress with no versions, the default version points at state 0.)
+    #
+    blockingVersions = sorted([(v['lineage'], name, v['state'])
+                                  for (name, v) in after['versions'].items()
+                                      if v['state'] != 0],
+                              reverse=True)
+    if blockingVersions:
+        LoggingInfo('    Versions preventing the state tree from collapsing:')
+        LoggingInfo('        %-40s  %-10s  %s' % ('Version', 'State', 'Lineage Length'))
+        for (lineage, name, state) in blockingVersions:
+            LoggingInfo('        %-40s  %-10i  %i' % (name, state, lineage))
+    #
+    # Tables whose delta tables still hold the most rows after the compress.
+    #
+    remainingDeltas = sorted([(c['adds'] + c['deletes'], table, c['adds'], c['deletes'])
+                                 for (table, c) in after['deltas'].items()
+                                     if c['adds'] + c['deletes'] > 0],
+                             reverse=True)
+    if remainingDeltas:
+        LoggingInfo('    Tables with rows remaining in delta tables:')
+        LoggingInfo('        %-50s  %10s  %10s' % ('Table', 'Adds', 'Deletes'))
+        for (total, table, adds, deletes) in remainingDeltas[:CompressReportTables]:
+            LoggingInfo('        %-50s  %10i  %10i' % (table, adds, deletes))
+
+def SDEQuery(sql):
+    '''Run the given SQL query in the database.  Return its result as a list of rows.'''
+    global DatabaseServer_Database_sde
+    result = arcpy.ArcSDESQLExecute(DatabaseServer_Database_sde).execute(sql)
+    #
+    # ArcSDESQLExecute returns a single value for a one-value result, a list
+    # for a one-row result, a list of lists otherwise, and True for no rows.
+    #
+    if result is True or result is None:
+        return []
+    if not isinstance(result, list):
+        return [[result]]
+    if result != [] and not isinstance(result[0], list):
+        return [result]
+    return result
+
 ################################################################################
 
 #
@@ -714,70 +2175,524 @@ def CompressDatabase():
 #
 #   Create versions for the SAP-GIS and AssetWorks-GIS Interfaces.
 #
+#   - The versions are described in VersionSpecFile, a JSON file of the form:
+#
+#       {"versions": [{"name": "SAP_GIS_Interface", "parent": "sde.DEFAULT",           "access": "PUBLIC"},
+#                     {"name": "ArcGISContainer",   "parent": "DBO.SAP_GIS_Interface", "access": "PUBLIC"},
+#                     {"name": "AW_GIS_Interface",  "parent": "sde.DEFAULT",           "access": "PUBLIC"}]}
+#
+#     Versions are created by the sdeAdmin connection, so they are owned by
+#     DBO.  Parents are given with their owner.
+#
+#   - Compare the specified versions with the versions in the database, and
+#     only create the versions that are missing.  A version with the wrong
+#     access level is altered.  A version with the wrong parent cannot be
+#     moved, and is reported as an error.  When every version is present,
+#     nothing is done.
+#
+#   - Each missing version whose parent exists starts a branch: the version
+#     and its missing descendants, created parent first.  The branches are
+#     created one after another: arcpy geoprocessing tools are not safe to
+#     run on several threads of one process.
+#
+
+DefaultVersionSpec = {'versions': [{'name': 'SAP_GIS_Interface', 'parent': 'sde.DEFAULT',           'access': 'PUBLIC'},
+                                   {'name': 'ArcGISContainer',   'parent': 'DBO.SAP_GIS_Interface', 'access': 'PUBLIC'},
+                                   {'name': 'AW_GIS_Interface',  'parent': 'sde.DEFAULT',           'access': 'PUBLIC'}]}
 
 def CreateVersions():
-    global ExecutionSuccessful
+    global DatabaseServer_Database_sde, ExecutionSuccessful
     LoggingInfo('Creating versions ...')
-    #
-    # Create versions for SAP-GIS Interface.
-    #
-    # Create SAP_GIS_Interface as child of Default with public access.
     try:
-        versionName = 'SAP_GIS_Interface'
-        parentVersion = 'sde.DEFAULT'
-        accessLevel = 'PUBLIC'
-        CreateVersion(versionName, parentVersion, accessLevel)
-    except BaseException, e:
-        ExecutionSuccessful = False
-        LoggingError(e)
-    # Create ArcGISContainer as child of SAP_GIS_Interface with public access.
-    try:
-        versionName = 'ArcGISContainer'
-        parentVersion = 'DBO.SAP_GIS_Interface'
-        accessLevel = 'PUBLIC'
-        CreateVersion(versionName, parentVersion, accessLevel)
+        spec = LoadVersionSpec()
+        existing = dict((v.name, v) for v in arcpy.da.ListVersions(DatabaseServer_Database_sde))
+        missing = {}
+        for version in spec:
+            name = 'DBO.%s' % version['name']
+            if name not in existing:
+                missing[name] = version
+            elif existing[name].parentVersionName != version['parent']:
+                ExecutionSuccessful = False
+                LoggingError('Version %s has parent %s instead of %s.  Delete it and run again to recreate it.'
+                                 % (name, existing[name].parentVersionName, version['parent']))
+            elif existing[name].access.upper() != version['access'].upper():
+                try:
+                    AlterVersionAccess(name, version['access'])
+                except BaseException, e:
+                    ExecutionSuccessful = False
+                    LoggingError(e)
+        if missing == {}:
+            LoggingInfo('    All %i versions exist' % len(spec))
+            return
+        for (name, version) in missing.items():
+            if version['parent'] not in existing and version['parent'] not in missing:
+                ExecutionSuccessful = False
+                LoggingError('Unable to create version %s: parent %s does not exist' % (name, version['parent']))
+        branches = sorted(name for (name, version) in missing.items() if version['parent'] in existing)
+        LoggingInfo('    Creating %i versions in %i branches' % (len(missing), len(branches)))
+        for name in branches:
+            CreateVersionBranch(name, missing)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingError(e)
-    #
-    # Create version for AssetWorks-GIS Interface.
-    #
-    # Create AW_GIS_Interface as child of Default with public access.
+
+def LoadVersionSpec():
+    '''Return the list of versions in VersionSpecFile, or in DefaultVersionSpec if it does not exist.'''
+    global VersionSpecFile
+    if not os.path.exists(VersionSpecFile):
+        return DefaultVersionSpec['versions']
+    f = open(VersionSpecFile, 'r')
+    spec = json.load(f)
+    f.close()
+    for version in spec['versions']:
+        version.setdefault('access', 'PUBLIC')
+        assert 'name' in version and 'parent' in version, 'Version without name or parent in %s: %s' % (VersionSpecFile, version)
+    return spec['versions']
+
+def CreateVersionBranch(name, missing):
+    '''Create the given version, then its missing descendants.
+       If a version cannot be created, its descendants are skipped.'''
+    global ExecutionSuccessful
     try:
-        versionName = 'AW_GIS_Interface'
-        parentVersion = 'sde.DEFAULT'
-        accessLevel = 'PUBLIC'
-        CreateVersion(versionName, parentVersion, accessLevel)
+        version = missing[name]
+        CreateVersion(version['name'], version['parent'], version['access'])
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingError(e)
+        return
+    for child in sorted(c for (c, v) in missing.items() if v['parent'] == name):
+        CreateVersionBranch(child, missing)
 
 def CreateVersion(versionName, parentVersion, accessLevel):
     global DatabaseServer_Database_sdeAdmin
     LoggingInfo('    Creating version %s with parent %s and access level %s...' % (versionName, parentVersion, accessLevel))
     arcpy.CreateVersion_management(DatabaseServer_Database_sdeAdmin, parentVersion, versionName, accessLevel)
 
+def AlterVersionAccess(version, accessLevel):
+    global DatabaseServer_Database_sdeAdmin
+    LoggingInfo('    Changing access level of version %s to %s...' % (version, accessLevel))
+    arcpy.AlterVersion_management(DatabaseServer_Database_sdeAdmin, version, '', '', accessLevel)
+
 ################################################################################
 
 #
 # Import data from other systems
 #
-#   - Run SSIS (SQL Server Integration Services) packages to import data into
-#     GIS from other systems.
-#   - Note:  SSIS packages must be run in Visual Studio 2008.
+#   - Load extracts exported by other systems (SAP, AssetWorks, SCADA) into
+#     staging tables, then merge the staging tables into their target tables.
+#
+#   - The extracts are described in ImportSpecFile, a JSON file of the form:
+#
+#       {"database": "",
+#        "sources": [{"name":    "ScadaReadings",
+#                     "files":   "\\\\Arctic\\...\\Imports\\ScadaReadings_*.csv",
+#                     "format":  "CSV",
+#                     "staging": "sdeDataOwner.Staging_ScadaReadings",
+#                     "fields":  [["StationID", "TEXT"], ["ReadingTime", "DATETIME"], ["Value", "DOUBLE"]],
+#                     "key":     ["StationID", "ReadingTime"],
+#                     "target":  "sdeDataOwner.ScadaReading",
+#                     "targetFields": {"StationID": "s.StationID", "ReadingTime": "s.ReadingTime", "Value": "s.Value"},
+#                     "version": ""}]}
+#
+#     database      - Empty to import into the database being maintained, or
+#                     the path of a SQLite database to import into instead
+#                     (for testing with local files).
+#     staging       - Staging table.  In a geodatabase it is created by the
+#                     connected user, so only the last part of its name is used.
+#     files         - Extract files to load (wildcards allowed).  CSV files
+#                     have a header line.  JSON files hold a list of objects,
+#                     or one object per line.
+#     fields        - Staging table columns and their types (TEXT, INTEGER,
+#                     DOUBLE, or DATETIME), in the order they are loaded.
+#     key           - Columns which identify a row in the target table.
+#     targetFields  - Target column -> SQL expression over staging table
+#                     alias "s".  Default: the staging columns, unchanged.
+#                     In a geodatabase, each must be a staging column (s.Name).
+#     version       - If the target is versioned, the version to edit.
+#                     Default: the version of the database connection.
+#
+#   - In a geodatabase, the staging table is created with geoprocessing tools
+#     and rows are loaded with an insert cursor, ImportBatchSize rows per
+#     cursor.  With SQLite, they are loaded with parameterized INSERT
+#     statements.  Sources are imported one after the other.  (arcpy is not
+#     thread-safe.)
+#
+#   - In a geodatabase, the staging rows are merged in an edit session on the
+#     target's version: an update cursor updates the target rows whose keys
+#     are staged, and an insert cursor inserts the others.  So edits to a
+#     versioned target are recorded in its delta tables, and new rows get
+#     their ObjectIDs from the geodatabase.  With SQLite, the merge is an
+#     UPDATE ... FROM join of the target and staging tables, and an INSERT of
+#     the staging rows whose keys are not in the target table.
+#
+#   - Extract files that have been merged are moved into the Imported
+#     subdirectory of their directory, so they are not imported twice.
 #
 
-# To do: Implement ImportDataFromOtherSystems().
-# Future to do: Reconfigure SSIS packages to import data into Conway sdeVector.
 def ImportDataFromOtherSystems():
-    global ExecutionSuccessful
+    global ExecutionSuccessful, ImportSpecFile
     LoggingInfo('Importing data from other systems ...')
     try:
-        assert False, 'Unable to import data from other systems - "/Import" option has not been implemented.'
+        if not os.path.exists(ImportSpecFile):
+            LoggingInfo('    No import specification %s - nothing to import' % ImportSpecFile)
+            return
+        f = open(ImportSpecFile, 'r')
+        spec = json.load(f)
+        f.close()
+        database = spec.get('database') or DatabaseServer_Database_sde
+        for source in spec['sources']:
+            error = ImportSource(database, source)
+            if error is not None:
+                ExecutionSuccessful = False
+                LoggingError('    Unable to import %s: %s' % (source['name'], error))
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingError(e)
 
+def ImportSource(database, source):
+    '''Load the given source's extract files into its staging table and merge
+       them into its target table.  Return None, or the exception that stopped it.'''
+    try:
+        files = sorted(glob.glob(source['files']))
+        if files == []:
+            LoggingInfo('    %s: no extract files' % source['name'])
+            return None
+        startTime = datetime.datetime.now()
+        connection = ImportConnect(database)
+        try:
+            staging = CreateStagingTable(connection, database, source)
+            rows = 0
+            for fileName in files:
+                rows += LoadExtractFile(connection, database, staging, source, fileName, rows)
+            RemoveDuplicateStagingRows(connection, staging, source)
+            ImportCommit(connection)
+            (updated, inserted) = MergeStagingTable(connection, database, staging, source)
+            ImportCommit(connection)
+            DropStagingTable(connection, database, staging)
+        finally:
+            ImportClose(connection)
+        for fileName in files:
+            ArchiveExtractFile(fileName)
+        LoggingInfo('    %s: loaded %i rows from %i files, updated %s and inserted %s rows in %s in %s'
+                    % (source['name'], rows, len(files), updated, inserted, source['target'],
+                       str(datetime.datetime.now() - startTime).split('.')[0]))
+        return None
+    except BaseException, e:
+        return e
+
+def CreateStagingTable(connection, database, source):
+    '''(Re)create the source's staging table, with an index on its key columns.
+       Return the staging table's qualified name.'''
+    fields = source['fields'] + [['ImportRow', 'INTEGER']]
+    tableName = source['staging'].split('.')[-1]
+    if IsSQLite(connection):
+        sqlTypes = {'TEXT': 'TEXT', 'INTEGER': 'INTEGER', 'DOUBLE': 'REAL', 'DATETIME': 'TEXT'}
+        staging = QuoteName(connection, source['staging'])
+        ImportExecute(connection, 'DROP TABLE IF EXISTS %s' % staging)
+        ImportExecute(connection, 'CREATE TABLE %s (%s)' % (staging, ', '.join(['%s %s' % (name, sqlTypes[fieldType.upper()])
+                                                                                  for (name, fieldType) in fields])))
+        ImportExecute(connection, 'CREATE INDEX %s ON %s (%s)'
+                                  % (QuoteName(connection, tableName + '_Key'), staging, ', '.join(source['key'])))
+        ImportCommit(connection)
+        return source['staging']
+    #
+    # In a geodatabase, create the table with geoprocessing tools, so that rows
+    # can be loaded with an insert cursor.
+    #
+    fieldTypes = {'TEXT': 'TEXT', 'INTEGER': 'LONG', 'DOUBLE': 'DOUBLE', 'DATETIME': 'DATE'}
+    if arcpy.Exists(os.path.join(database, tableName)):
+        arcpy.Delete_management(os.path.join(database, tableName))
+    path = arcpy.CreateTable_management(database, tableName).getOutput(0)
+    for (name, fieldType) in fields:
+        fieldType = fieldTypes[fieldType.upper()]
+        arcpy.AddField_management(path, name, fieldType, field_length=[None, 255][fieldType == 'TEXT'])
+    arcpy.AddIndex_management(path, source['key'], '%s_Key' % tableName)
+    return os.path.basename(path)
+
+def DropStagingTable(connection, database, staging):
+    if IsSQLite(connection):
+        ImportExecute(connection, 'DROP TABLE %s' % QuoteName(connection, staging))
+        ImportCommit(connection)
+    else:
+        arcpy.Delete_management(os.path.join(database, staging))
+
+def LoadExtractFile(connection, database, staging, source, fileName, rowsLoaded):
+    '''Insert the rows of the given extract file into the staging table in batches,
+       numbering them after the rows already loaded (in column ImportRow).
+       Return the number of rows inserted.'''
+    global ImportBatchSize
+    LoggingInfo('    %s: loading %s ...' % (source['name'], fileName))
+    names = [name for (name, fieldType) in source['fields']]
+    types = [fieldType.upper() for (name, fieldType) in source['fields']]
+    rows = 0
+    batch = []
+    for record in ReadExtractFile(fileName, source.get('format', 'CSV')):
+        batch.append([ConvertImportValue(record.get(name), fieldType)
+                         for (name, fieldType) in zip(names, types)] + [rowsLoaded + rows + len(batch) + 1])
+        if len(batch) == ImportBatchSize:
+            InsertStagingRows(connection, database, staging, names + ['ImportRow'], batch)
+            rows += len(batch)
+            batch = []
+    if batch != []:
+        InsertStagingRows(connection, database, staging, names + ['ImportRow'], batch)
+        rows += len(batch)
+    ImportCommit(connection)
+    return rows
+
+def ReadExtractFile(fileName, fileFormat):
+    '''Yield each record in the given CSV or JSON extract file as a dictionary.'''
+    f = open(fileName, 'rb')
+    try:
+        if fileFormat.upper() == 'CSV':
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            first = f.read(1)
+            f.seek(0)
+            if first == '[':
+                for record in json.load(f):
+                    yield record
+            else:
+                for line in f:
+                    if line.strip() != '':
+                        yield json.loads(line)
+    finally:
+        f.close()
+
+def ConvertImportValue(value, fieldType):
+    '''Convert a value read from an extract file to the given field type.
+       Empty values become None.'''
+    if value is None or (isinstance(value, basestring) and value.strip() == ''):
+        return None
+    if fieldType == 'INTEGER':
+        return int(value)
+    if fieldType == 'DOUBLE':
+        return float(value)
+    if fieldType == 'DATETIME':
+        return ParseImportDate(value)
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+ImportDateFormats = ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%d %H:%M', '%Y-%m-%d', '%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y']
+
+def ParseImportDate(value):
+    '''Return the date and time in the given extract file value.'''
+    text = str(value).strip()
+    if text.endswith('Z'):
+        text = text[:-1]
+    for dateFormat in ImportDateFormats:
+        try:
+            return datetime.datetime.strptime(text, dateFormat)
+        except ValueError:
+            pass
+    raise ValueError('"%s" is not a recognized date and time' % value)
+
+def InsertStagingRows(connection, database, staging, names, rows):
+    '''Insert the given rows into the staging table.'''
+    if IsSQLite(connection):
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (QuoteName(connection, staging), ', '.join(names), ', '.join(['?'] * len(names)))
+        connection.executemany(sql, rows)
+    else:
+        with arcpy.da.InsertCursor(os.path.join(database, staging), names) as cursor:
+            for row in rows:
+                cursor.insertRow(row)
+
+def QuoteName(connection, name):
+    '''Return the given table name, which may be qualified with a database and
+       schema (owner), with each part quoted.  SQLite has no owners, and reads
+       a qualified name as database.table, so only the last part is used.'''
+    if IsSQLite(connection):
+        return '"%s"' % name.split('.')[-1].replace('"', '""')
+    return '.'.join(['[%s]' % part.replace(']', ']]') for part in name.split('.')])
+
+def RemoveDuplicateStagingRows(connection, staging, source):
+    '''If several staging rows have the same key, keep only the last one loaded.'''
+    staging = QuoteName(connection, staging)
+    match = ' AND '.join(['s.%s = %s.%s' % (k, staging, k) for k in source['key']])
+    sql = 'DELETE FROM %s WHERE EXISTS (SELECT 1 FROM %s s WHERE %s AND s.ImportRow > %s.ImportRow)' % (staging, staging, match, staging)
+    ImportExecute(connection, sql)
+
+def MergeStagingTable(connection, database, staging, source):
+    '''Update target rows whose keys are in the staging table, and insert staging
+       rows whose keys are not in the target table.  Return the number of rows
+       updated and inserted, if known.'''
+    targetFields = source.get('targetFields') or dict((name, 's.%s' % name) for (name, fieldType) in source['fields'])
+    if not IsSQLite(connection):
+        return MergeStagingRows(database, staging, source, targetFields)
+    target = QuoteName(connection, source['target'])
+    staging = QuoteName(connection, staging)
+    keyFields = source['key']
+    match = ' AND '.join(['t.%s = s.%s' % (k, k) for k in keyFields])
+    updateFields = [name for name in sorted(targetFields.keys()) if name not in keyFields]
+    updated = None
+    if updateFields != []:
+        sql  = 'UPDATE %s SET %s ' % (target, ', '.join(['%s = %s' % (name, targetFields[name]) for name in updateFields]))
+        sql += 'FROM %s s WHERE %s' % (staging, ' AND '.join(['%s.%s = s.%s' % (target, k, k) for k in keyFields]))
+        updated = ImportExecute(connection, sql)
+    names = sorted(targetFields.keys())
+    sql  = 'INSERT INTO %s (%s) ' % (target, ', '.join(names))
+    sql += 'SELECT %s FROM %s s ' % (', '.join([targetFields[name] for name in names]), staging)
+    sql += 'WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE %s)' % (target, match)
+    inserted = ImportExecute(connection, sql)
+    return (updated, inserted)
+
+def MergeStagingRows(database, staging, source, targetFields):
+    '''In a geodatabase, merge the staging rows into the target with cursors, in an
+       edit session on the target's version.  Return the number of rows updated
+       and inserted.'''
+    names = sorted(targetFields.keys())
+    keyFields = source['key']
+    for name in names:
+        assert re.match(r'^s\.\w+$', targetFields[name]), \
+               'Target field %s of %s must be a staging column (s.Name), not %s' % (name, source['name'], targetFields[name])
+    assert set(keyFields) <= set(names), 'Key %s of %s is not in its target fields' % (keyFields, source['name'])
+    keyIndexes = [names.index(k) for k in keyFields]
+    #
+    # Read the staging rows by key.  A row with a null key matches no target row.
+    #
+    staged = {}
+    newRows = []
+    with arcpy.da.SearchCursor(os.path.join(database, staging), [targetFields[name][2:] for name in names]) as cursor:
+        for row in cursor:
+            key = tuple([row[i] for i in keyIndexes])
+            if None in key:
+                newRows.append(list(row))
+            else:
+                staged[key] = list(row)
+    #
+    # Select the target rows to update by the values of a text or integer key
+    # column, if there is one, and match them on the whole key.
+    #
+    wheres = [None]
+    for (j, k) in enumerate(keyFields):
+        values = sorted(set([key[j] for key in staged.keys()]))
+        if all([isinstance(v, (basestring, int, long)) for v in values]):
+            literals = [("'%s'" % v.replace("'", "''")) if isinstance(v, basestring) else str(v) for v in values]
+            wheres = ['%s IN (%s)' % (k, ', '.join(batch)) for batch in Batches(literals, 500)]
+            break
+    view = 'Import_%s' % source['name']
+    target = os.path.join(database, source['target'])
+    arcpy.MakeTableView_management(target, view)
+    try:
+        if source.get('version'):
+            arcpy.ChangeVersion_management(view, 'TRANSACTIONAL', source['version'])
+        editor = arcpy.da.Editor(database)
+        editor.startEditing(False, arcpy.Describe(target).isVersioned)
+        editor.startOperation()
+        try:
+            updated = 0
+            matched = set()
+            for where in wheres:
+                if staged == {}:
+                    break
+                with arcpy.da.UpdateCursor(view, names, where) as cursor:
+                    for row in cursor:
+                        key = tuple([row[i] for i in keyIndexes])
+                        if key in staged:
+                            cursor.updateRow(staged[key])
+                            matched.add(key)
+                            updated += 1
+            newRows += [row for (key, row) in sorted(staged.items()) if key not in matched]
+            with arcpy.da.InsertCursor(view, names) as cursor:
+                for row in newRows:
+                    cursor.insertRow(row)
+            editor.stopOperation()
+            editor.stopEditing(True)
+        except BaseException, e:
+            editor.abortOperation()
+            editor.stopEditing(False)
+            raise e
+    finally:
+        arcpy.Delete_management(view)
+    return (updated, len(newRows))
+
+def ArchiveExtractFile(fileName):
+    '''Move the given extract file into the Imported subdirectory of its directory.'''
+    (directory, name) = os.path.split(fileName)
+    archiveDirectory = os.path.join(directory, 'Imported')
+    if not os.path.exists(archiveDirectory):
+        os.makedirs(archiveDirectory)
+    archiveFile = os.path.join(archiveDirectory, name)
+    if os.path.exists(archiveFile):
+        os.remove(archiveFile)
+    shutil.move(fileName, archiveFile)
+
+#
+# Import database connection
+#
+#   - Either an ArcSDESQLExecute connection to a geodatabase (.sde file), or a
+#     sqlite3 connection to a SQLite database file.
+#
+
+def ImportConnect(database):
+    if database.lower().endswith('.sde'):
+        connection = arcpy.ArcSDESQLExecute(database)
+        connection.startTransaction()
+        return connection
+    return sqlite3.connect(database)
+
+def IsSQLite(connection):
+    return isinstance(connection, sqlite3.Connection)
+
+def ImportExecute(connection, sql):
+    '''Run the given SQL statement.  Return the number of rows it changed, if known.'''
+    if IsSQLite(connection):
+        return connection.execute(sql).rowcount
+    result = connection.execute(sql)
+    if isinstance(result, (int, long)) and not isinstance(result, bool):
+        return result
+    return None
+
+def ImportCommit(connection):
+    if IsSQLite(connection):
+        connection.commit()
+    else:
+        connection.commitTransaction()
+        connection.startTransaction()
+
+def ImportClose(connection):
+    if IsSQLite(connection):
+        connection.close()
+    else:
+        connection.rollbackTransaction()
+
+################################################################################
+
+#
+# Wait until not busy
+#
+#   - With /Online, indexes are rebuilt and statistics updated while users
+#     are working.  Before each batch of tables, time OnlineProbeSQL, and
+#     wait while it takes longer than OnlineLatencyLimit.
+#   - OnlineLatencyLimit is set from the fastest of OnlineProbes probes made
+#     before the first batch.
+#
+
+def WaitUntilNotBusy():
+    global OnlineProbes, OnlineLatencyFactor, OnlineMinLatencyMs, OnlineLatencyLimit
+    global OnlinePauseSeconds, OnlineMaxWaitMinutes
+    if OnlineLatencyLimit is None:
+        baseline = min([ProbeLatency() for i in range(OnlineProbes)])
+        OnlineLatencyLimit = max(OnlineLatencyFactor * baseline, OnlineMinLatencyMs)
+        LoggingInfo('    Probe latency is %i ms; waiting while it exceeds %i ms' % (baseline, OnlineLatencyLimit))
+    giveUpTime = datetime.datetime.now() + datetime.timedelta(minutes=OnlineMaxWaitMinutes)
+    latency = ProbeLatency()
+    while latency > OnlineLatencyLimit:
+        assert datetime.datetime.now() < giveUpTime, 'Database busy for %i minutes; probe latency is %i ms' % (OnlineMaxWaitMinutes, latency)
+        LoggingInfo('    Database busy; probe latency is %i ms' % latency)
+        Pause(seconds=OnlinePauseSeconds)
+        latency = ProbeLatency()
+
+def ProbeLatency():
+    '''Return the time taken by OnlineProbeSQL, in milliseconds.'''
+    global OnlineProbeSQL
+    startTime = datetime.datetime.now()
+    SDEQuery(OnlineProbeSQL)
+    elapsed = datetime.datetime.now() - startTime
+    return elapsed.days * 86400000 + elapsed.seconds * 1000 + elapsed.microseconds / 1000.0
+
 ################################################################################
 
 #
@@ -788,7 +2703,8 @@ def ImportDataFromOtherSystems():
 #
 
 def RebuildIndexes():
-    global DatabaseServer_Database_sde, ExecutionSuccessful
+    global DatabaseServer_Database_sde, ExecutionSuccessful, Journal, JournalBatchSize
+    global Online, OnlineBatchSize, OnlineBatchPauseSeconds
     LoggingInfo('Rebuilding indexes ...')
     try:
         #
@@ -800,7 +2716,7 @@ def RebuildIndexes():
         #
         # List the rasters, tables and feature classes owned by sdeDataOwner.
         #
-        dataList = ListData(DatabaseServer_Database_sde)
+        dataList = CatalogData(DatabaseServer_Database_sde)
         #
         # ALL = Rebuild indexes on all tables for the selected datasets.  This
         #     includes spatial indexes, user-created attribute indexes, and
@@ -811,7 +2727,24 @@ def RebuildIndexes():
         #     of edits in the delta tables.
         #
         deltaOnly = 'ALL'
-        arcpy.RebuildIndexes_management(DatabaseServer_Database_sde, includeSystem, dataList, deltaOnly)
+        #
+        # Rebuild JournalBatchSize tables at a time, recording each batch in
+        # the journal.  System tables are rebuilt with the first batch.
+        # With /Online, rebuild OnlineBatchSize tables at a time, when the
+        # database is not busy.
+        #
+        done = CompletedItems('RebuildIndexes')
+        if done:
+            LoggingInfo('    Skipping %i tables rebuilt by the run started at %s' % (len(done), Journal['started']))
+            includeSystem = 'NO_SYSTEM'
+        for batch in Batches([d for d in dataList if d not in done], [JournalBatchSize, OnlineBatchSize][Online]):
+            if Online:
+                WaitUntilNotBusy()
+            arcpy.RebuildIndexes_management(DatabaseServer_Database_sde, includeSystem, batch, deltaOnly)
+            RecordItemsCompleted('RebuildIndexes', batch)
+            includeSystem = 'NO_SYSTEM'
+            if Online:
+                Pause(seconds=OnlineBatchPauseSeconds)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingCritical(e)
@@ -819,15 +2752,91 @@ def RebuildIndexes():
 
 def ListData(workspace):
     # Return list of feature classes, tables, and rasters owned by sdeDataOwner.
+    # Feature datasets are walked one at a time; arcpy is not thread-safe.
     arcpy.env.workspace = workspace
     pattern='*.sdeDataOwner.*'
     data = arcpy.ListRasters(pattern)
     data += arcpy.ListTables(pattern)
     data += arcpy.ListFeatureClasses(pattern)
-    data += [f for d in arcpy.ListDatasets(pattern)
-                   for f in arcpy.ListFeatureClasses(pattern, 'ALL', d)]
+    datasets = arcpy.ListDatasets(pattern)
+    for dataset in datasets:
+        data += ListDatasetFeatureClasses(workspace, dataset, pattern)
     return data
 
+def ListDatasetFeatureClasses(workspace, dataset, pattern):
+    # Return list of feature classes in the given feature dataset whose names match the pattern.
+    featureClasses = []
+    for (dirPath, dirNames, fileNames) in arcpy.da.Walk(os.path.join(workspace, dataset), datatype='FeatureClass'):
+        featureClasses += [f for f in fileNames
+                               if fnmatch.fnmatch(f.lower(), pattern.lower())]
+    return featureClasses
+
+#
+# Catalog snapshot
+#
+#   - List the geodatabase once per run.  RebuildIndexes() and
+#     UpdateStatistics() share the same list.
+#   - If /CatalogCache is specified, save the list in CatalogCacheFile along
+#     with a signature of the geodatabase catalog (sde.GDB_ITEMS), and reuse
+#     it in later runs for as long as the signature is unchanged.  Computing
+#     the signature is a single query, far cheaper than listing the catalog.
+#
+
+def CatalogData(workspace):
+    '''Return the rasters, tables, and feature classes owned by sdeDataOwner,
+       listing the geodatabase at most once per run.'''
+    global CatalogCache, CatalogSnapshot
+    if CatalogSnapshot is None:
+        signature = None
+        if CatalogCache:
+            signature = CatalogSignature(workspace)
+            CatalogSnapshot = LoadCatalogSnapshot(signature)
+        if CatalogSnapshot is None:
+            LoggingInfo('    Listing geodatabase catalog ...')
+            CatalogSnapshot = {'signature': signature, 'data': ListData(workspace)}
+            if signature is not None:
+                SaveCatalogSnapshot(CatalogSnapshot)
+        LoggingInfo('    Catalog snapshot contains %i items' % len(CatalogSnapshot['data']))
+    return list(CatalogSnapshot['data'])
+
+def CatalogSignature(workspace):
+    '''Return a string which changes whenever an item is added to, removed from,
+       or renamed in the geodatabase catalog.  Return None if it cannot be determined.'''
+    try:
+        sql = 'SELECT COUNT(*), CHECKSUM_AGG(BINARY_CHECKSUM(UUID, Name, Path)) FROM sde.GDB_ITEMS'
+        result = arcpy.ArcSDESQLExecute(workspace).execute(sql)
+        return repr(result)
+    except BaseException, e:
+        LoggingInfo('    Unable to compute catalog signature: %s' % e)
+        return None
+
+def LoadCatalogSnapshot(signature):
+    '''Return the saved catalog snapshot if its signature matches, otherwise None.'''
+    global CatalogCacheFile
+    if signature is None or not os.path.exists(CatalogCacheFile):
+        return None
+    try:
+        f = open(CatalogCacheFile, 'r')
+        snapshot = json.load(f)
+        f.close()
+    except BaseException, e:
+        LoggingInfo('    Unable to read catalog cache %s: %s' % (CatalogCacheFile, e))
+        return None
+    if snapshot.get('signature') != signature:
+        LoggingInfo('    Catalog has changed since %s was saved' % CatalogCacheFile)
+        return None
+    LoggingInfo('    Reusing catalog snapshot saved in %s' % CatalogCacheFile)
+    return snapshot
+
+def SaveCatalogSnapshot(snapshot):
+    global CatalogCacheFile
+    try:
+        f = open(CatalogCacheFile, 'w')
+        json.dump(snapshot, f, indent=1)
+        f.close()
+    except BaseException, e:
+        LoggingInfo('    Unable to save catalog cache %s: %s' % (CatalogCacheFile, e))
+
 ################################################################################
 
 #
@@ -840,7 +2849,8 @@ def ListData(workspace):
 #
 
 def UpdateStatistics():
-    global DatabaseServer_Database_sde, ExecutionSuccessful
+    global DatabaseServer_Database_sde, ExecutionSuccessful, Journal, JournalBatchSize
+    global Online, OnlineBatchSize, OnlineBatchPauseSeconds
     LoggingInfo('Updating statistics ...')
     try:
         #
@@ -852,7 +2862,7 @@ def UpdateStatistics():
         #
         # List the rasters, tables and feature classes owned by sdeDataOwner.
         #
-        dataList = ListData(DatabaseServer_Database_sde)
+        dataList = CatalogData(DatabaseServer_Database_sde)
         #
         # ANALYZE_BASE = Gather statistics on the base tables for the selected
         #     datasets.
@@ -874,8 +2884,25 @@ def UpdateStatistics():
         #     for the selected datasets.
         #
         analyzeArchive = 'ANALYZE_ARCHIVE'
-        arcpy.AnalyzeDatasets_management(DatabaseServer_Database_sde, includeSystem, dataList,
-                                         analyzeBase, analyzeDelta, analyzeArchive)
+        #
+        # Analyze JournalBatchSize tables at a time, recording each batch in
+        # the journal.  System tables are analyzed with the first batch.
+        # With /Online, analyze OnlineBatchSize tables at a time, when the
+        # database is not busy.
+        #
+        done = CompletedItems('UpdateStatistics')
+        if done:
+            LoggingInfo('    Skipping %i tables analyzed by the run started at %s' % (len(done), Journal['started']))
+            includeSystem = 'NO_SYSTEM'
+        for batch in Batches([d for d in dataList if d not in done], [JournalBatchSize, OnlineBatchSize][Online]):
+            if Online:
+                WaitUntilNotBusy()
+            arcpy.AnalyzeDatasets_management(DatabaseServer_Database_sde, includeSystem, batch,
+                                             analyzeBase, analyzeDelta, analyzeArchive)
+            RecordItemsCompleted('UpdateStatistics', batch)
+            includeSystem = 'NO_SYSTEM'
+            if Online:
+                Pause(seconds=OnlineBatchPauseSeconds)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingCritical(e)
@@ -905,70 +2932,79 @@ def AcceptConnections():
 #
 
 def StartServices():
-    global ServiceServer_Services, ExecutionSuccessful
+    global ServiceServer_Services, ServiceWorkers
     LoggingInfo('Starting services ...')
     #
     # On each server, start each service that was previously stopped.
+    # Start services on different servers concurrently.
     # If unable to restart all services, start as many as possible and catch exceptions.
     # If any exceptions are caught, re-raise one of them.
     #
-    exception = None
-    for (server, services) in ServiceServer_Services.items():
-        services.sort(reverse=True)
-        while services != []:
-            service = services.pop()
-            try:
-                #
-                # Query the service for its current state --
-                # STOP_PENDING, STOPPED, START_PENDING, or RUNNING.
-                #
-                state = QueryService(service, server)
-                #
-                # If state is STOP_PENDING, wait until state is STOPPED.
-                # (If after 10 minutes it still is not STOPPED, raise an exception.)
-                #
-                if state == 'STOP_PENDING':
-                    deadline = datetime.datetime.now() + datetime.timedelta(minutes=10)
-                    while state != 'STOPPED':
-                        assert datetime.datetime.now() < deadline, \
-                               'Unable to stop service %s on server %s after 10 minutes' % (service, server)
-                        Pause(seconds=10)
-                        state = QueryService(service, server)
-                #
-                # If the state is STOPPED, start it.
-                #
-                if state == 'STOPPED':
-                    state = StartService(service, server)
-                #
-                # If state is START_PENDING, wait until state is RUNNING.
-                # (If after 10 minutes it still is not RUNNING, raise an exception.)
-                #
-                if state == 'START_PENDING':
-                    deadline = datetime.datetime.now() + datetime.timedelta(minutes=10)
-                    while state != 'RUNNING':
-                        assert datetime.datetime.now() < deadline, \
-                               'Unable to start service %s on server %s after 10 minutes' % (service, server)
-                        Pause(seconds=10)
-                        state = QueryService(service, server)
-                #
-                # The service should now be RUNNING.
-                # (If it is not, raise an exception.)
-                #
-                assert state == 'RUNNING', \
-                       'Unable to start service %s on server %s' % (service, server)
-            except BaseException, e:
-                #
-                # Caught an exception.
-                # Save it, and continue.
-                #
-                ExecutionSuccessful = False
-                LoggingCritical(e)
-                exception = e
+    exceptions = MapConcurrently(lambda (server, services): StartServerServices(server, services),
+                                 ServiceServer_Services.items(), ServiceWorkers)
+    exceptions = [e for e in exceptions if e is not None]
     #
     # If exceptions were caught, re-raise one of them.
     #
-    if exception:
-        raise exception
+    if exceptions:
+        raise exceptions[0]
+
+def StartServerServices(server, services):
+    '''Start the given services on the given server, one after the other.
+       Return one of the exceptions caught, or None.'''
+    global ExecutionSuccessful
+    exception = None
+    services.sort(reverse=True)
+    while services != []:
+        service = services.pop()
+        try:
+            #
+            # Query the service for its current state --
+            # STOP_PENDING, STOPPED, START_PENDING, or RUNNING.
+            #
+            state = QueryService(service, server)
+            #
+            # If state is STOP_PENDING, wait until state is STOPPED.
+            # (If after 10 minutes it still is not STOPPED, raise an exception.)
+            #
+            if state == 'STOP_PENDING':
+                deadline = datetime.datetime.now() + datetime.timedelta(minutes=10)
+                while state != 'STOPPED':
+                    assert datetime.datetime.now() < deadline, \
+                           'Unable to stop service %s on server %s after 10 minutes' % (service, server)
+                    Pause(seconds=10)
+                    state = QueryService(service, server)
+            #
+            # If the state is STOPPED, start it.
+            #
+            if state == 'STOPPED':
+                state = StartService(service, server)
+            #
+            # If state is START_PENDING, wait until state is RUNNING.
+            # (If after 10 minutes it still is not RUNNING, raise an exception.)
+            #
+            if state == 'START_PENDING':
+                deadline = datetime.datetime.now() + datetime.timedelta(minutes=10)
+                while state != 'RUNNING':
+                    assert datetime.datetime.now() < deadline, \
+                           'Unable to start service %s on server %s after 10 minutes' % (service, server)
+                    Pause(seconds=10)
+                    state = QueryService(service, server)
+            #
+            # The service should now be RUNNING.
+            # (If it is not, raise an exception.)
+            #
+            assert state == 'RUNNING', \
+                   'Unable to start service %s on server %s' % (service, server)
+        except BaseException, e:
+            #
+            # Caught an exception.
+            # Save it, and continue.
+            #
+            ExecutionSuccessful = False
+            LoggingCritical(e)
+            exception = e
+    return exception
 
 def StartService(service, server=os.environ['COMPUTERNAME']):
     '''Start the given service on the given server.'''
@@ -989,23 +3025,35 @@ def StartService(service, server=os.environ['COMPUTERNAME']):
 #
 #   - Enable the Refresh Map Services task on Arctic.
 #
+#   - Only tasks that were enabled before DisableTasks() ran are enabled,
+#     concurrently.  Once they have all been enabled, TaskStatesFile is deleted.
+#
 
 def EnableTasks():
-    global ExecutionSuccessful, TaskServer_Tasks
+    global ExecutionSuccessful, TaskServer_Tasks, TaskServer_TaskStates, TaskStatesFile
     LoggingInfo('Enabling scheduled tasks ...')
     try:
-        for (server, tasks) in TaskServer_Tasks.items():
-            for task in tasks:
-                success = EnableTask(task, server)
-                assert success, 'Unable to enable scheduled task %s on server %s' % (task, server)
+        if TaskServer_TaskStates is None:
+            LoggingInfo('    No scheduled tasks were disabled')
+            return
+        changes = [(server, task)
+                      for (server, tasks) in TaskServer_Tasks.items()
+                          for task in tasks
+                              if TaskServer_TaskStates.get(server, {}).get(task, 'Disabled') != 'Disabled']
+        results = MapConcurrently(lambda (server, task): EnableTask(task, server), changes, TaskWorkers)
+        for ((server, task), success) in zip(changes, results):
+            assert success, 'Unable to enable scheduled task %s on server %s' % (task, server)
+        if os.path.exists(TaskStatesFile):
+            os.remove(TaskStatesFile)
     except BaseException, e:
         ExecutionSuccessful = False
         LoggingCritical(e)
         raise e
 
 def EnableTask(taskname, server=os.environ['COMPUTERNAME']):
+    global SchTasks
     LoggingInfo('    Enabling task %s on server %s' % (taskname, server))
-    cmd = r'schtasks /Change /S %s /TN "%s" /Enable' % (server, taskname)
+    cmd = r'%s /Change /S %s /TN "%s" /Enable' % (SchTasks, server, taskname)
     output = RunCommand(cmd)
     success = ParseSchTasksCommandOutput(output)
     return success
@@ -1042,7 +3090,8 @@ def SendNotificationMail():
 
 def SendStatusMail():
     global ExecutionSuccessful, ExecutionStartTime, MailSender, MailServer
-    global StatusMailRecipientsIfError, StatusMailRecipientsIfSuccess
+    global StatusMailRecipientsIfError, StatusMailRecipientsIfSuccess, LogFile, VersionsLogFile, MailLogBytes
+    global DatabaseResults, DatabaseLogFiles, LogRecordsLost
     LoggingInfo('Sending status email ...')
     program = os.path.basename(sys.argv[0])
     args = ' '.join(sys.argv[1:])
@@ -1063,13 +3112,17 @@ def SendStatusMail():
     body += 'Ended:   %s\r\n\r\n' % executionEndTime.strftime('%A, %B %d, %Y %I:%M:%S %p')
     body += 'Elapsed Time:  %s\r\n\r\n' % str(elapsedTime).split('.')[0]
     body += 'Status:   %s\r\n\r\n' % status
-    for logFile in [LogFile, VersionsLogFile]:
+    if LogRecordsLost:
+        body += 'Log records lost:   %i (see standard error)\r\n\r\n' % LogRecordsLost
+    for r in DatabaseResults:
+        body += 'Database %s:   %s   %s\r\n\r\n' % (r['name'], ['Error', 'Success'][r['successful']],
+                                                  str(datetime.timedelta(seconds=int(r['seconds']))))
+    FlushLogging()
+    for logFile in [LogFile, VersionsLogFile] + DatabaseLogFiles:
         if os.path.exists(logFile):
             (logPath, logFileName) = os.path.split(logFile)
             body += '-------- %s --------\r\n\r\n' % logFileName
-            f = open(logFile, 'r')
-            body += ''.join(f.readlines())
-            f.close()
+            body += LogExcerpt(logFile, MailLogBytes)
             body += '\r\n'
     body += '\r\n'
     body += 'This message was sent by an automated process.  Please do not reply.\r\n'
@@ -1077,15 +3130,175 @@ def SendStatusMail():
 
 ################################################################################
 
-def RunCommand(cmd):
+def MapConcurrently(function, items, workers):
+    '''Apply the function to each of the items, using up to the given number of
+       threads.  Return the results in the same order as the items.'''
+    global Simulation
+    items = list(items)
+    if items == []:
+        return []
+    workers = max(1, min(workers, len(items)))
+    finish = None
+    if Simulation:
+        (function, finish) = SimulatedConcurrently(function, workers)
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+        if finish:
+            finish()
+
+#
+# Windows commands
+#
+#   - Commands run on a pool of CommandWorkers threads, so a caller may start
+#     several commands and wait for them later (StartCommand, WaitForCommand).
+#     RunCommand starts one command and waits for it.
+#
+#   - A command that has not finished after its timeout (CommandTimeoutSeconds
+#     by default) is killed, and waiting for it raises an exception, so a hung
+#     remote server cannot freeze maintenance.  A command can also be
+#     cancelled before or while it runs (CancelCommand).
+#
+#   - The duration, exit status, and outcome of each command (OK, FAILED,
+#     TIMEOUT, or CANCELLED) are logged and saved in CommandHistory.
+#
+#   - Queries that do not change anything may be cached for a few seconds
+#     (cacheSeconds), so identical queries - e.g. of the same server's
+#     services - are run once.  Cached queries expire after their cacheSeconds.
+#     A command that is not cached may change what the queries of its server
+#     would return, so it expires the cached queries of that server only (or
+#     all of them, if its server cannot be told from the command).
+#
+#   - A command that cannot be started (e.g. its program is missing) fails,
+#     and waiting for it raises the exception that stopped it.
+#
+
+def RunCommand(cmd, timeout=None, cacheSeconds=0):
     '''Run the given Windows command. Return its output as a list of strings.'''
+    return WaitForCommand(StartCommand(cmd, timeout, cacheSeconds))
+
+def StartCommand(cmd, timeout=None, cacheSeconds=0):
+    '''Start running the given Windows command on the command pool.
+       Return the command, to be passed to WaitForCommand or CancelCommand.'''
+    global CommandPool, CommandWorkers, CommandLock, CommandCache, CommandTimeoutSeconds
+    with CommandLock:
+        now = datetime.datetime.now()
+        for (cachedCmd, cached) in CommandCache.items():
+            if (now - cached['started']).total_seconds() > cached['cacheSeconds']:
+                del CommandCache[cachedCmd]
+        if cacheSeconds > 0:
+            cached = CommandCache.get(cmd)
+            if cached and cached['outcome'] in [None, 'OK'] and (now - cached['started']).total_seconds() <= cacheSeconds:
+                LoggingInfo('    Reusing output of Windows command "%s" from %s' % (cmd, cached['started'].strftime('%H:%M:%S')))
+                return cached
+        else:
+            server = CommandServer(cmd)
+            for cachedCmd in CommandCache.keys():
+                if server is None or CommandServer(cachedCmd) in [server, None]:
+                    del CommandCache[cachedCmd]
+        if CommandPool is None:
+            CommandPool = ThreadPool(CommandWorkers)
+        command = {'cmd': cmd, 'timeout': timeout or CommandTimeoutSeconds, 'started': datetime.datetime.now(),
+                   'seconds': None, 'exitStatus': None, 'outcome': None, 'output': '', 'process': None,
+                   'cancelled': threading.Event(), 'cacheSeconds': cacheSeconds}
+        if cacheSeconds > 0:
+            CommandCache[cmd] = command
     LoggingInfo('    Running Windows command "%s"' % cmd)
-    # subprocess.check_output runs the given Windows command and returns its output as a byte string.
-    # If return code is non-zero, raises a CalledProcessError, in which case subprocess.CalledProcessError
-    # has the return code in the returncode attribute and any output in the output attribute.
-    output = subprocess.check_output(cmd)   # Note: Must run on app server with Python 2.7.3 (Arctic, DevArctic)
-    lines = output.splitlines()
-    return lines
+    command['result'] = CommandPool.apply_async(ExecuteCommand, (command,))
+    return command
+
+def CommandServer(cmd):
+    '''Return the lower case name of the server the given sc or schtasks command
+       works on, or None if it cannot be told.'''
+    m = re.search(r'(^|\s)(\\\\|/S\s+)([^\s"]+)', cmd, re.IGNORECASE)
+    if m:
+        return m.group(3).lower()
+    return None
+
+def WaitForCommand(command):
+    '''Wait for the given command to finish.  Return its output as a list of strings.
+       Raise an exception if it failed, timed out, or was cancelled.'''
+    command['result'].get()     # (Raises the exception that stopped it, if any.)
+    if command['outcome'] == 'FAILED':
+        # Like subprocess.check_output, raise a CalledProcessError, with the
+        # return code in its returncode attribute and any output in its output attribute.
+        raise subprocess.CalledProcessError(command['exitStatus'], command['cmd'], command['output'])
+    assert command['outcome'] != 'TIMEOUT', 'Windows command "%s" did not finish within %i seconds' % (command['cmd'], command['timeout'])
+    assert command['outcome'] != 'CANCELLED', 'Windows command "%s" was cancelled' % command['cmd']
+    return command['output'].splitlines()
+
+def CancelCommand(command):
+    '''Cancel the given command.  If it is running, kill it.'''
+    command['cancelled'].set()
+    KillCommand(command)
+
+def ExecuteCommand(command):
+    '''Run the given command on a command pool thread, killing it after its timeout.'''
+    global CommandLock, CommandHistory
+    error = None
+    with CommandLock:
+        if command['cancelled'].is_set():
+            command['outcome'] = 'CANCELLED'
+        else:
+            command['started'] = datetime.datetime.now()
+            try:
+                # Note: Must run on app server with Python 2.7.3 (Arctic, DevArctic)
+                command['process'] = subprocess.Popen(command['cmd'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except BaseException, e:
+                command['outcome'] = 'FAILED'
+                command['output'] = 'Unable to run Windows command "%s": %s' % (command['cmd'], e)
+                error = e
+    if command['outcome'] is None:
+        timer = threading.Timer(command['timeout'], KillCommand, (command, 'TIMEOUT'))
+        timer.daemon = True
+        timer.start()
+        try:
+            command['output'] = command['process'].communicate()[0]
+        finally:
+            timer.cancel()
+        with CommandLock:
+            command['exitStatus'] = command['process'].returncode
+            if command['outcome'] is None:
+                command['outcome'] = 'OK' if command['exitStatus'] == 0 else 'FAILED'
+            command['process'] = None
+    command['seconds'] = (datetime.datetime.now() - command['started']).total_seconds()
+    with CommandLock:
+        CommandHistory.append(dict((k, command[k]) for k in ['cmd', 'started', 'seconds', 'exitStatus', 'outcome']))
+    LoggingInfo('    Windows command "%s": %s, exit status %s, in %.1f seconds' % (command['cmd'], command['outcome'], command['exitStatus'], command['seconds']))
+    if error is not None:
+        raise error
+
+def KillCommand(command, outcome='CANCELLED'):
+    '''Kill the given command's process, and record why.'''
+    global CommandLock
+    with CommandLock:
+        process = command['process']
+        if process is None or command['outcome'] is not None:
+            return
+        command['outcome'] = outcome
+    try:
+        process.kill()
+    except BaseException, e:
+        LoggingError('    Unable to kill Windows command "%s": %s' % (command['cmd'], e))
+
+def ReportCommands():
+    '''Log how many Windows commands were run, how long they took, and which were slowest or did not succeed.'''
+    global CommandHistory
+    try:
+        if CommandHistory == []:
+            return
+        LoggingInfo('Windows commands: %i run, %.1f seconds in total' % (len(CommandHistory), sum([c['seconds'] for c in CommandHistory])))
+        for c in CommandHistory:
+            if c['outcome'] != 'OK':
+                LoggingError('    %-9s  %7.1f  %s' % (c['outcome'], c['seconds'], c['cmd']))
+        LoggingInfo('    Slowest:')
+        for c in sorted(CommandHistory, key=lambda c: c['seconds'], reverse=True)[:5]:
+            LoggingInfo('    %-9s  %7.1f  %s' % (c['outcome'], c['seconds'], c['cmd']))
+    except BaseException, e:
+        LoggingError('Unable to report Windows commands: %s' % e)
 
 def Pause(minutes=0, seconds=0):
     seconds = 60 * minutes + seconds
@@ -1102,18 +3315,6 @@ def SendMail(mailServer, sender, recipients, subject, body):
         server.sendmail(sender, recipients, message)
         server.quit()
 
-def LoggingInfo(msg):
-    print msg
-    logging.info(msg)
-
-def LoggingError(msg):
-    print msg
-    logging.error(msg)
-
-def LoggingCritical(msg):
-    print msg
-    logging.critical(msg)
-
 def DisplayConnections():
     # Print all database connections.
     # This procedure is not called, but it is useful when testing code interactively.
@@ -1130,11 +3331,635 @@ def DisplayConnections():
 
 ################################################################################
 
+#
+# Logging
+#
+#   - LoggingInfo, LoggingError, and LoggingCritical put log records on
+#     LogQueue and return immediately.  A background thread prints each record
+#     and writes it to LogFile on the local disk.  LogFile is rotated when it
+#     reaches LogMaxBytes, keeping LogBackupCount old files.
+#
+#   - Another background thread copies the local log files to LogDirectory on
+#     the network share every LogShipSeconds, and once more when logging stops.
+#     A slow or unavailable share therefore never stalls maintenance.
+#
+#   - Before StartLogging() is called and after StopLogging() is called,
+#     messages are printed and logged directly.
+#
+
+def StartLogging():
+    global LogFile, LogMaxBytes, LogBackupCount, LogQueue, LogWriter, LogShipper, LogStopping, LogShipped, LogRecordsLost
+    (logPath, logFileName) = os.path.split(LogFile)
+    if not os.path.exists(logPath):
+        os.makedirs(logPath)
+    handler = logging.handlers.RotatingFileHandler(LogFile, maxBytes=LogMaxBytes, backupCount=LogBackupCount)
+    handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', '%Y-%m-%d %H:%M:%S'))
+    logger = logging.getLogger('GISMaintenance')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+    LogQueue = Queue.Queue()
+    LogStopping = threading.Event()
+    LogRecordsLost = 0
+    LogShipped = {}
+    LogWriter = threading.Thread(target=WriteLogRecords, args=(LogQueue,))
+    LogWriter.daemon = True
+    LogWriter.start()
+    LogShipper = threading.Thread(target=ShipLogFilesPeriodically, args=(LogStopping,))
+    LogShipper.daemon = True
+    LogShipper.start()
+
+def StopLogging():
+    '''Wait for old log files to be deleted, write all queued log records, copy the
+       log files to the share, add them to the log manifest, and stop the background threads.'''
+    global LogQueue, LogWriter, LogShipper, LogStopping, LogShipped, RetentionThread, SharedShutdown
+    if LogQueue is None:
+        return
+    if RetentionThread is not None:
+        RetentionThread.join()
+    queue = LogQueue
+    LogQueue = None
+    queue.put(None)
+    LogWriter.join()
+    LogStopping.set()
+    LogShipper.join()
+    try:
+        if not SharedShutdown:
+            RegisterLogFiles(LogShipped)    # (Otherwise, the process that started this one registers them.)
+    except BaseException, e:
+        Log(logging.ERROR, 'Unable to update log manifest: %s' % e)
+    for handler in logging.getLogger('GISMaintenance').handlers:
+        handler.close()
+
+def FlushLogging():
+    '''Wait until all queued log records have been written to LogFile.'''
+    global LogQueue
+    if LogQueue is not None:
+        LogQueue.join()
+
+def WriteLogRecords(queue):
+    '''Write each queued log record to the console and LogFile.  If a record
+       cannot be written (e.g. the disk is full), report it on stderr, count it
+       in LogRecordsLost, and carry on with the next record.'''
+    global LogRecordsLost
+    logger = logging.getLogger('GISMaintenance')
+    while True:
+        record = queue.get()
+        try:
+            if record is None:
+                return
+            print record.getMessage()
+            logger.handle(record)
+        except BaseException, e:
+            LogRecordsLost += 1
+            try:
+                sys.stderr.write('Unable to write log record "%s": %s\n' % (record.getMessage(), e))
+            except BaseException:
+                pass    # (Nowhere left to report it.)
+        finally:
+            queue.task_done()
+
+def ShipLogFilesPeriodically(stopping):
+    global LogShipSeconds, LogShipped
+    while not stopping.is_set():
+        stopping.wait(LogShipSeconds)
+        ShipLogFiles(LogShipped)
+
+def ShipLogFiles(shipped):
+    '''Copy each local log file that has changed since it was last copied to LogDirectory.
+       The given dictionary records the size and time of each file when it was copied.'''
+    global LogDirectory, LogFile, LogBackupCount, VersionsLogFile, DatabaseLogFiles
+    logFiles = [LogFile, VersionsLogFile] + ['%s.%i' % (LogFile, i) for i in range(1, LogBackupCount + 1)] + DatabaseLogFiles
+    for logFile in logFiles:
+        try:
+            if not os.path.exists(logFile):
+                continue
+            stat = os.stat(logFile)
+            if shipped.get(logFile) == (stat.st_size, stat.st_mtime):
+                continue
+            shutil.copyfile(logFile, os.path.join(LogDirectory, os.path.basename(logFile)))
+            shipped[logFile] = (stat.st_size, stat.st_mtime)
+        except BaseException, e:
+            logging.getLogger('GISMaintenance').error('Unable to copy %s to %s: %s' % (logFile, LogDirectory, e))
+
+def Log(level, msg):
+    global LogQueue
+    if LogQueue is None:
+        print msg
+        logging.getLogger('GISMaintenance').log(level, msg)
+    else:
+        LogQueue.put(logging.LogRecord('GISMaintenance', level, '', 0, msg, None, None))
+
+def LoggingInfo(msg):
+    Log(logging.INFO, msg)
+
+def LoggingError(msg):
+    Log(logging.ERROR, msg)
+
+def LoggingCritical(msg):
+    Log(logging.CRITICAL, msg)
+
+#
+# Log excerpt
+#
+#   - Return at most maxBytes of the given log file for the status email:
+#     the beginning of the file, its warnings and errors, and its end.
+#
+
+def LogExcerpt(logFile, maxBytes):
+    size = os.path.getsize(logFile)
+    f = open(logFile, 'rb')
+    try:
+        if size <= maxBytes:
+            return f.read()
+        headBytes = maxBytes / 4
+        problemBytes = maxBytes / 4
+        tailBytes = maxBytes - headBytes - problemBytes
+        head = f.read(headBytes)
+        head = head[:head.rfind('\n') + 1]
+        f.seek(0)
+        problems = []
+        problemSize = 0
+        problemCount = 0
+        for line in f:
+            if re.search('WARNING|ERROR|CRITICAL', line):
+                problemCount += 1
+                if problemSize + len(line) <= problemBytes:
+                    problems.append(line)
+                    problemSize += len(line)
+        f.seek(size - tailBytes)
+        tail = f.read()
+        tail = tail[tail.find('\n') + 1:]
+    finally:
+        f.close()
+    excerpt  = head
+    excerpt += '\r\n... %i bytes omitted - see %s ...\r\n\r\n' % (size - len(head) - len(tail), os.path.basename(logFile))
+    if problemCount > 0:
+        excerpt += 'Warnings and errors (%i of %i):\r\n\r\n' % (len(problems), problemCount)
+        excerpt += ''.join(problems)
+        excerpt += '\r\n...\r\n\r\n'
+    excerpt += tail
+    return excerpt
+
+################################################################################
+
+#
+# Simulation
+#
+#   - With /Simulate, run the full control flow of PerformMaintenance(),
+#     including the finally blocks that restore connections, services, and
+#     tasks, without touching production servers, the database, or email.
+#
+#   - Windows commands (RunCommand), arcpy, and email (SendMail) are replaced
+#     by stand-ins that keep a simulated state - services, scheduled tasks,
+#     connected users, versions, and catalog - and take a simulated time drawn
+#     from a latency distribution for each step.  Pause() advances the
+#     simulated clock instead of sleeping, and datetime.datetime.now() returns
+#     the simulated time, so timeouts behave as they would in production and
+#     a whole night runs in seconds.
+#
+#   - Each thread has its own simulated clock.  Work started by
+#     MapConcurrently() is scheduled on its simulated workers from the
+#     caller's time, and the caller resumes when the last worker finishes.
+#
+#   - The simulation can be configured with a JSON file, /Simulate config.json:
+#
+#       {"seed":      1,
+#        "latency":   {"Compress_management": ["lognormal", 7.0, 0.5],
+#                      "ServiceStop": ["uniform", 30, 900],
+#                      "RunCommand": ["constant", 100000]},
+#        "users":     [{"Name": "jsmith", "ID": 101, "editMinutes": 12}],
+#        "versions":  {"DBO.SAP_GIS_Interface": "sde.DEFAULT"},
+#        "conflicts": ["DBO.AW_GIS_Interface"],
+#        "catalog":   {"tables": [], "featureClasses": [], "datasets": {}},
+#        "tables":    {"ScadaReading": [{"StationID": "S2", "Value": 0.0}]},
+#        "sql":       [["FROM sde.SDE_states", 5000]]}
+#
+#     Latency distributions are ["constant", seconds], ["uniform", low, high],
+#     ["normal", mean, sd], or ["lognormal", mu, sigma] (of seconds).  A very
+#     large constant simulates a hang (a RunCommand that hangs is killed after
+#     its timeout, as it would be in production).  Latency keys are arcpy function names,
+#     RunCommand, SendMail, SQL, ServiceStop, and ServiceStart.
+#
+#   - Each /ReconcileGroup process is seeded with the seed plus the index of
+#     its group, so that concurrent groups draw different latencies.
+#
+#   - The timeline of simulated steps is logged and written to
+#     SimulationTimelineFile.
+#
+
+DefaultSimulationLatency = {
+    'RunCommand':                      ['uniform', 1, 5],
+    'ServiceStop':                     ['uniform', 20, 120],
+    'ServiceStart':                    ['uniform', 30, 180],
+    'SendMail':                        ['uniform', 1, 3],
+    'SQL':                             ['uniform', 0.1, 2],
+    'AcceptConnections':               ['uniform', 1, 3],
+    'ListUsers':                       ['uniform', 1, 3],
+    'DisconnectUser':                  ['uniform', 1, 5],
+    'ListVersions':                    ['uniform', 1, 3],
+    'ListData':                        ['uniform', 2, 10],
+    'ReconcileVersions_management':    ['lognormal', 5.0, 1.0],
+    'Compress_management':             ['lognormal', 7.0, 0.5],
+    'CreateVersion_management':        ['uniform', 2, 10],
+    'AlterVersion_management':         ['uniform', 1, 5],
+    'RebuildIndexes_management':       ['lognormal', 7.5, 0.4],
+    'AnalyzeDatasets_management':      ['lognormal', 7.0, 0.4]}
+
+DefaultSimulationSQL = [
+    ['FROM sde.GDB_ITEMS',                  [[500, 123456789]]],
+    ['COUNT\(\*\) FROM sde.SDE_states',     5000],
+    ['COUNT\(\*\) FROM sde.SDE_state_lineages', 25000],
+    ['FROM sde.SDE_versions',               [['sde.DEFAULT', 4000, 40]]],
+    ['FROM sde.SDE_table_registry',         [['SDEDATAOWNER.wPressurizedMain', 'a', 20000],
+                                             ['SDEDATAOWNER.wPressurizedMain', 'd', 15000],
+                                             ['SDEDATAOWNER.Hydrant', 'a', 3000]]],
+    ['dm_db_index_physical_stats',          250000]]
+
+def InstallSimulation():
+    '''Replace Windows commands, arcpy, and email with simulated stand-ins.'''
+    global arcpy, datetime, RealDatetime, RunCommand, SendMail, Pause
+    global SimulationClock, SimulationStartTime, SimulationTimeline, SimulationLock
+    global SimulationServices, SimulationTasks
+    LoggingInfo('Installing simulation stand-ins ...')
+    SimulationLock = threading.Lock()
+    SimulationTimeline = []
+    SimulationServices = {}
+    SimulationTasks = {}
+    #
+    # Simulated clock.
+    #
+    RealDatetime = datetime
+    SimulationStartTime = RealDatetime.datetime.now()
+    SimulationClock = threading.local()
+    SimulationClock.now = SimulationStartTime
+    simulatedDatetime = types.ModuleType('datetime')
+    simulatedDatetime.datetime = type('datetime', (RealDatetime.datetime,),
+                                      {'now':   classmethod(lambda cls: SimulationNow()),
+                                       'today': classmethod(lambda cls: SimulationNow())})
+    simulatedDatetime.timedelta = RealDatetime.timedelta
+    datetime = simulatedDatetime
+    #
+    # Simulated Windows commands, email, and pauses.
+    #
+    RunCommand = SimulatedRunCommand
+    SendMail = SimulatedSendMail
+    Pause = SimulatedPause
+    #
+    # Simulated arcpy.
+    #
+    simulatedArcpy = types.ModuleType('arcpy')
+    simulatedArcpy.env = types.ModuleType('arcpy.env')
+    simulatedArcpy.env.workspace = None
+    simulatedArcpy.da = types.ModuleType('arcpy.da')
+    simulatedArcpy.da.ListVersions = SimulatedListVersions
+    simulatedArcpy.da.Walk = SimulatedWalk
+    simulatedArcpy.AcceptConnections = lambda workspace, accept: SimulateStep('AcceptConnections', str(accept))
+    simulatedArcpy.ListUsers = SimulatedListUsers
+    simulatedArcpy.DisconnectUser = SimulatedDisconnectUser
+    simulatedArcpy.ListRasters = lambda *args: SimulatedList('rasters')
+    simulatedArcpy.ListTables = lambda *args: SimulatedList('tables')
+    simulatedArcpy.ListFeatureClasses = lambda *args: SimulatedList('featureClasses')
+    simulatedArcpy.ListDatasets = lambda *args: sorted(SimulationConfig.get('catalog', {}).get('datasets', {'sdeVector.SDEDATAOWNER.WaterUtility': []}).keys())
+    simulatedArcpy.ReconcileVersions_management = SimulatedReconcileVersions
+    simulatedArcpy.Compress_management = lambda *args: SimulateStep('Compress_management')
+    simulatedArcpy.CreateVersion_management = SimulatedCreateVersion
+    simulatedArcpy.AlterVersion_management = lambda workspace, version, name, description, access: SimulateStep('AlterVersion_management', version)
+    simulatedArcpy.RebuildIndexes_management = lambda *args: SimulateStep('RebuildIndexes_management', '%i items' % len(args[2]))
+    simulatedArcpy.AnalyzeDatasets_management = lambda *args: SimulateStep('AnalyzeDatasets_management', '%i items' % len(args[2]))
+    simulatedArcpy.ArcSDESQLExecute = SimulatedArcSDESQLExecute
+    simulatedArcpy.Exists = lambda path: False
+    simulatedArcpy.Delete_management = lambda path: SimulateStep('Delete_management', path)
+    simulatedArcpy.CreateTable_management = SimulatedCreateTable
+    simulatedArcpy.AddField_management = lambda table, name, fieldType, **kwargs: SimulateStep('AddField_management', name)
+    simulatedArcpy.AddIndex_management = lambda table, fields, name: SimulateStep('AddIndex_management', name)
+    simulatedArcpy.da.InsertCursor = SimulatedInsertCursor
+    simulatedArcpy.da.SearchCursor = SimulatedSearchCursor
+    simulatedArcpy.da.UpdateCursor = SimulatedUpdateCursor
+    simulatedArcpy.da.Editor = SimulatedEditor
+    simulatedArcpy.MakeTableView_management = SimulatedMakeTableView
+    simulatedArcpy.ChangeVersion_management = lambda view, versionType, version: SimulateStep('ChangeVersion_management', version)
+    simulatedArcpy.Describe = lambda path: collections.namedtuple('Describe', 'isVersioned')(True)
+    arcpy = simulatedArcpy
+
+def LoadSimulationConfig():
+    '''Read SimulationConfigFile, if any, and set up the simulated users and versions.
+       Called once, after the command line has been processed.'''
+    global SimulationConfigFile, SimulationConfig, SimulationUsers, SimulationVersions, SimulationTables
+    SimulationConfig = {}
+    if SimulationConfigFile:
+        LoggingInfo('    Reading simulation configuration %s ...' % SimulationConfigFile)
+        f = open(SimulationConfigFile, 'r')
+        SimulationConfig = json.load(f)
+        f.close()
+    random.seed(SimulationConfig.get('seed', 1))
+    SimulationUsers = SimulationConfig.get('users', [{'Name': 'sde',    'ID': 1,   'editMinutes': 0},
+                                                     {'Name': 'jsmith', 'ID': 101, 'editMinutes': 0},
+                                                     {'Name': 'mdoe',   'ID': 102, 'editMinutes': 8}])
+    SimulationVersions = SimulationConfig.get('versions', {'sde.DEFAULT': None,
+                                                           'DBO.SAP_GIS_Interface': 'sde.DEFAULT',
+                                                           'DBO.ArcGISContainer': 'DBO.SAP_GIS_Interface',
+                                                           'DBO.AW_GIS_Interface': 'sde.DEFAULT'})
+    SimulationTables = dict((name.lower(), rows) for (name, rows) in SimulationConfig.get('tables', {}).items())
+
+def SimulationNow():
+    global SimulationClock, SimulationStartTime
+    return getattr(SimulationClock, 'now', SimulationStartTime)
+
+def SimulationAdvance(seconds):
+    global SimulationClock
+    SimulationClock.now = SimulationNow() + RealDatetime.timedelta(seconds=seconds)
+
+def SimulationLatency(step):
+    '''Draw a simulated duration, in seconds, for the given step.'''
+    global SimulationConfig
+    distribution = SimulationConfig.get('latency', {}).get(step) or DefaultSimulationLatency.get(step, ['constant', 1])
+    kind = distribution[0]
+    if kind == 'uniform':
+        return random.uniform(distribution[1], distribution[2])
+    if kind == 'normal':
+        return max(random.normalvariate(distribution[1], distribution[2]), 0)
+    if kind == 'lognormal':
+        return random.lognormvariate(distribution[1], distribution[2])
+    return float(distribution[1])
+
+def SimulateStep(step, detail='', seconds=None):
+    '''Advance the simulated clock by the duration of the given step, and record it in the timeline.'''
+    global SimulationLock, SimulationTimeline
+    if seconds is None:
+        seconds = SimulationLatency(step)
+    startTime = SimulationNow()
+    SimulationAdvance(seconds)
+    with SimulationLock:
+        SimulationTimeline.append((startTime, seconds, threading.current_thread().name, step, detail))
+
+def SimulatedConcurrently(function, workers):
+    '''Return a function which runs the given function on one of the given
+       number of simulated workers, and a function which moves the caller's
+       clock to the time the last worker finished.'''
+    #
+    # Each call starts on the simulated worker that becomes free first, so the
+    # simulated schedule does not depend on which pool thread runs it.
+    #
+    freeTimes = [SimulationNow()] * workers
+    lock = threading.Lock()
+    def worker(item):
+        with lock:
+            freeTimes.sort()
+            SimulationClock.now = freeTimes.pop(0)
+        try:
+            return function(item)
+        finally:
+            with lock:
+                freeTimes.append(SimulationNow())
+    def finish():
+        SimulationClock.now = max(freeTimes)
+    return (worker, finish)
+
+def SimulatedPause(minutes=0, seconds=0):
+    seconds = 60 * minutes + seconds
+    LoggingInfo('    Pausing %s seconds (simulated) ...' % seconds)
+    SimulateStep('Pause', '', seconds)
+
+def SimulatedSendMail(mailServer, sender, recipients, subject, body):
+    if recipients:
+        SimulateStep('SendMail', '%s -> %s' % (subject, ', '.join(recipients)))
+
+def SimulatedRunCommand(cmd, timeout=None, cacheSeconds=0):
+    '''Simulate the sc and schtasks commands run by this program.'''
+    global SimulationServices, SimulationTasks, Services, TaskServer_Tasks, CommandTimeoutSeconds
+    LoggingInfo('    Running Windows command "%s" (simulated)' % cmd)
+    timeout = timeout or CommandTimeoutSeconds
+    seconds = SimulationLatency('RunCommand')
+    SimulateStep('RunCommand', cmd, min(seconds, timeout))
+    assert seconds <= timeout, 'Windows command "%s" did not finish within %i seconds' % (cmd, timeout)
+    now = SimulationNow()
+    m = re.match(r'^sc \\\\(\S+) query state= all$', cmd)
+    if m:
+        server = m.group(1)
+        lines = []
+        for service in Services:
+            lines += ['SERVICE_NAME: %s' % service, '        STATE              : 4  %s' % SimulatedServiceState(server, service, now)]
+        return lines
+    m = re.match(r'^sc \\\\(\S+) (query|stop|start) "(.+)"$', cmd)
+    if m:
+        (server, action, service) = m.groups()
+        state = SimulatedServiceState(server, service, now)
+        if action == 'stop' and state in ['RUNNING', 'START_PENDING']:
+            SimulationServices[(server, service)] = ('STOP_PENDING', 'STOPPED', now + RealDatetime.timedelta(seconds=SimulationLatency('ServiceStop')))
+        elif action == 'start' and state == 'STOPPED':
+            SimulationServices[(server, service)] = ('START_PENDING', 'RUNNING', now + RealDatetime.timedelta(seconds=SimulationLatency('ServiceStart')))
+        return ['SERVICE_NAME: %s' % service, '        STATE              : 2  %s' % SimulatedServiceState(server, service, now)]
+    m = re.match(r'^\S+ /Query /S (\S+) /FO CSV /NH$', cmd)
+    if m:
+        server = m.group(1)
+        return ['"%s","N/A","%s"' % (task, SimulationTasks.get((server, task.lower()), 'Ready'))
+                   for task in TaskServer_Tasks.get(server, [])]
+    m = re.match(r'^\S+ /Change /S (\S+) /TN "(.+)" /(Enable|Disable)$', cmd)
+    if m:
+        (server, task, action) = m.groups()
+        SimulationTasks[(server, task.lower())] = {'Enable': 'Ready', 'Disable': 'Disabled'}[action]
+        return ['SUCCESS: The parameters of scheduled task "%s" have been changed.' % task]
+    return []
+
+def SimulatedServiceState(server, service, now):
+    global SimulationServices
+    (state, nextState, readyTime) = SimulationServices.get((server, service), ('RUNNING', 'RUNNING', now))
+    if now >= readyTime:
+        state = nextState
+    return state
+
+def SimulatedListUsers(workspace):
+    global SimulationUsers, SimulationStartTime
+    SimulateStep('ListUsers')
+    now = SimulationNow()
+    User = collections.namedtuple('User', 'ID Name ClientName ConnectionTime IsDirectConnection')
+    #
+    # A user who is editing disconnects by himself after editMinutes.
+    #
+    return [User(u['ID'], u['Name'], 'simulated', SimulationStartTime, True)
+               for u in SimulationUsers
+                   if not u.get('editMinutes') or now < SimulationStartTime + RealDatetime.timedelta(minutes=u['editMinutes'])]
+
+def SimulatedDisconnectUser(workspace, users):
+    global SimulationUsers
+    SimulateStep('DisconnectUser', str(users))
+    if users == 'ALL':
+        SimulationUsers = [u for u in SimulationUsers if u['Name'] in DatabaseUsers]
+    else:
+        SimulationUsers = [u for u in SimulationUsers if u['ID'] not in users]
+
+def SimulatedActiveUserIds():
+    global SimulationUsers, SimulationStartTime
+    now = SimulationNow()
+    return [[u['ID']]
+               for u in SimulationUsers
+                   if u.get('editMinutes') and now < SimulationStartTime + RealDatetime.timedelta(minutes=u['editMinutes'])]
+
+def SimulatedListVersions(workspace):
+    global SimulationVersions
+    SimulateStep('ListVersions')
+    Version = collections.namedtuple('Version', 'name parentVersionName access')
+    return [Version(name, parent, 'Public') for (name, parent) in sorted(SimulationVersions.items())]
+
+def SimulatedReconcileVersions(workspace, mode, target, versions, acquireLocks, abortIfConflicts,
+                               conflictDefinition, conflictResolution, withPost, withDelete, logFile):
+    global SimulationConfig, SimulationVersions
+    result = types.ModuleType('Result')
+    result.maxSeverity = 0
+    warnings = []
+    f = open(logFile, 'a')
+    for version in versions:
+        SimulateStep('ReconcileVersions_management', '%s -> %s' % (version, target))
+        if version in SimulationConfig.get('conflicts', []):
+            f.write('Reconciling %s with %s: conflicts detected, reconcile aborted (simulated)\n' % (version, target))
+            result.maxSeverity = 1
+            warnings.append('WARNING 000084: Conflicts detected, aborting the reconcile. (simulated)')
+        else:
+            f.write('Reconciled and posted %s to %s (simulated)\n' % (version, target))
+            if withDelete == 'DELETE_VERSION':
+                del SimulationVersions[version]
+    f.close()
+    result.getMessages = lambda severity=0: '\n'.join(warnings)
+    return result
+
+def SimulatedCreateVersion(workspace, parent, name, access):
+    global SimulationVersions
+    SimulateStep('CreateVersion_management', name)
+    SimulationVersions['DBO.%s' % name] = parent
+
+def SimulatedList(kind):
+    global SimulationConfig
+    SimulateStep('ListData', kind)
+    return list(SimulationConfig.get('catalog', {}).get(kind, ['sdeVector.SDEDATAOWNER.%s' % kind.capitalize()]))
+
+def SimulatedWalk(path, datatype=None):
+    global SimulationConfig
+    SimulateStep('ListData', path)
+    dataset = os.path.basename(path)
+    featureClasses = SimulationConfig.get('catalog', {}).get('datasets', {}).get(dataset,
+                         ['sdeVector.SDEDATAOWNER.wPressurizedMain', 'sdeVector.SDEDATAOWNER.Hydrant'])
+    yield (path, [], list(featureClasses))
+
+def SimulatedArcSDESQLExecute(workspace):
+    connection = types.ModuleType('ArcSDESQLExecute')
+    connection.execute = SimulatedSQL
+    connection.startTransaction = lambda: None
+    connection.commitTransaction = lambda: None
+    connection.rollbackTransaction = lambda: None
+    return connection
+
+def SimulatedCreateTable(path, name):
+    SimulateStep('CreateTable_management', name)
+    result = types.ModuleType('Result')
+    result.getOutput = lambda index: '%s\\sde.%s' % (path, name)
+    return result
+
+#
+# Simulated tables hold their rows in the simulation configuration, and the
+# rows inserted into them, as dictionaries, by table name.  A table view is
+# simulated by the name of its table.
+#
+
+SimulationTables = {}
+SimulationViews = {}
+
+def SimulatedTable(path):
+    global SimulationTables, SimulationViews
+    name = SimulationViews.get(path, path).split('\\')[-1].split('.')[-1].lower()
+    return SimulationTables.setdefault(name, [])
+
+def SimulatedMakeTableView(path, view):
+    global SimulationViews
+    SimulateStep('MakeTableView_management', view)
+    SimulationViews[view] = path
+
+class SimulatedInsertCursor(object):
+    def __init__(self, table, fields):
+        self.table = table
+        self.fields = fields
+        self.rows = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        SimulateStep('InsertCursor', '%i rows into %s' % (self.rows, os.path.basename(self.table)))
+    def insertRow(self, row):
+        SimulatedTable(self.table).append(dict(zip(self.fields, row)))
+        self.rows += 1
+
+class SimulatedSearchCursor(object):
+    '''Simulated search cursor.  The where clause is ignored.'''
+    def __init__(self, table, fields, where=None, sql_clause=None):
+        self.table = table
+        self.fields = fields
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        SimulateStep(self.__class__.__name__[9:], os.path.basename(self.table))
+    def __iter__(self):
+        for self.current in list(SimulatedTable(self.table)):
+            yield [self.current.get(f) for f in self.fields]
+
+class SimulatedUpdateCursor(SimulatedSearchCursor):
+    def updateRow(self, row):
+        self.current.update(zip(self.fields, row))
+
+class SimulatedEditor(object):
+    def __init__(self, workspace):
+        pass
+    def startEditing(self, withUndo, multiuserMode):
+        SimulateStep('StartEditing', 'multiuser' if multiuserMode else '')
+    def startOperation(self):
+        pass
+    def stopOperation(self):
+        pass
+    def abortOperation(self):
+        pass
+    def stopEditing(self, saveChanges):
+        SimulateStep('StopEditing', 'save' if saveChanges else 'discard')
+
+def SimulatedSQL(sql):
+    global SimulationConfig
+    SimulateStep('SQL', sql[:60])
+    if re.search('SDE_state_locks', sql):
+        return SimulatedActiveUserIds()
+    for (pattern, result) in SimulationConfig.get('sql', []) + DefaultSimulationSQL:
+        if re.search(pattern, sql):
+            return result
+    return True
+
+def ReportSimulation():
+    '''Log the simulated timeline and write it to SimulationTimelineFile.'''
+    global SimulationStartTime, SimulationTimeline, SimulationTimelineFile
+    try:
+        LoggingInfo('Simulated timeline:')
+        LoggingInfo('    %-10s  %-10s  %-14s  %-30s  %s' % ('Start', 'Seconds', 'Thread', 'Step', 'Detail'))
+        f = open(SimulationTimelineFile, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(['Start', 'Seconds', 'Thread', 'Step', 'Detail'])
+        for (startTime, seconds, thread, step, detail) in sorted(SimulationTimeline):
+            offset = str(startTime - SimulationStartTime).split('.')[0]
+            LoggingInfo('    %-10s  %-10.1f  %-14s  %-30s  %s' % (offset, seconds, thread[:14], step, detail[:80]))
+            writer.writerow([offset, '%.1f' % seconds, thread, step, detail])
+        f.close()
+        endTime = max([SimulationStartTime] + [s + RealDatetime.timedelta(seconds=d) for (s, d, t, step, detail) in SimulationTimeline])
+        LoggingInfo('    Simulated elapsed time: %s' % str(endTime - SimulationStartTime).split('.')[0])
+    except BaseException, e:
+        LoggingError('Unable to report simulated timeline: %s' % e)
+
+################################################################################
+
 #
 # If maintenance tasks were specified on the commmand line, run the main program.
+# With /ReconcileGroup, reconcile a group of versions for the process that started this one.
 #
 
+LogQueue = None     # Set by StartLogging().
+LogRecordsLost = 0  # Counted by WriteLogRecords().
+Simulation = False  # Set by Initialize().
+
 args = set([a.lower() for a in sys.argv])
-args.intersection_update(['/versions', '/compress', '/import', '/indexes'])
-if args:
+if '/reconcilegroup' in args:
+    ReconcileVersionGroupProcess()
+elif args & set(['/versions', '/compress', '/import', '/indexes', '/resume']):
     PerformMaintenance()
@@ -0,0 +1,115 @@
+# ProjectionService.py
+
+# OVERVIEW
+#
+#   Projects coordinates from one spatial reference to another in large
+#   batches, for programs that work with coordinate arrays rather than
+#   feature classes.
+#
+#   Each batch of coordinates is projected by writing it to an in_memory
+#   feature class in the source spatial reference and reading it back in
+#   the target spatial reference, which projects the whole batch in one
+#   call instead of one call per point.
+#
+#   Only the lookups are cached: the spatial references, and the geographic
+#   transformation chosen for each (source, target) pair, are kept in a
+#   projector that is reused for every batch projected between the same
+#   pair.  The projection itself is done again for every batch.
+#
+# HOW TO USE
+#
+#   import ProjectionService
+#
+#   projector = ProjectionService.GetProjector(2284, 4326)
+#   (longitudes, latitudes) = projector.Project(xs, ys)
+#
+#   Spatial references may be given as a WKID, a .prj file, or an
+#   arcpy.SpatialReference.  xs and ys are sequences or NumPy arrays of the
+#   same length; the results are NumPy arrays of float64.
+#
+#   A geographic transformation may be given by name.  If it is not given,
+#   the first transformation listed by arcpy.ListTransformations is used.
+#   An empty name projects without a geographic transformation.
+
+import arcpy, numpy, threading
+
+BatchSize = 500000      # Points projected at a time.
+
+SpatialReferences = {}  # Spatial reference for each WKID or .prj file.
+Projectors = {}         # Projector for each (source, target, transformation).
+CacheLock = threading.Lock()
+
+################################################################################
+
+def GetSpatialReference(spatialReference):
+    '''Return the arcpy.SpatialReference for the given WKID, .prj file, or spatial reference.'''
+    if isinstance(spatialReference, arcpy.SpatialReference):
+        return spatialReference
+    with CacheLock:
+        if spatialReference not in SpatialReferences:
+            SpatialReferences[spatialReference] = arcpy.SpatialReference(spatialReference)
+        return SpatialReferences[spatialReference]
+
+def GetProjector(source, target, transformation=None):
+    '''Return the projector from the source to the target spatial reference,
+       creating it the first time it is requested.'''
+    source = GetSpatialReference(source)
+    target = GetSpatialReference(target)
+    key = (source.exportToString(), target.exportToString(), transformation)
+    with CacheLock:
+        if key not in Projectors:
+            Projectors[key] = Projector(source, target, transformation)
+        return Projectors[key]
+
+################################################################################
+
+class Projector(object):
+    '''Projects coordinates from a source to a target spatial reference,
+       with the geographic transformation chosen when it is created.'''
+
+    def __init__(self, source, target, transformation=None):
+        self.source = source
+        self.target = target
+        self.identity = source.exportToString() == target.exportToString()
+        if transformation is None and not self.identity:
+            transformations = arcpy.ListTransformations(source, target)
+            transformation = transformations[0] if transformations else ''
+        self.transformation = transformation or ''
+
+    def Project(self, xs, ys):
+        '''Return the given coordinates projected to the target spatial reference,
+           as arrays of x and y.'''
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        assert xs.shape == ys.shape, 'Different numbers of x and y coordinates: %s and %s' % (xs.shape, ys.shape)
+        if self.identity or len(xs) == 0:
+            return (xs.copy(), ys.copy())
+        projectedXs = numpy.empty_like(xs)
+        projectedYs = numpy.empty_like(ys)
+        for start in range(0, len(xs), BatchSize):
+            end = min(start + BatchSize, len(xs))
+            (projectedXs[start:end], projectedYs[start:end]) = self.ProjectBatch(xs[start:end], ys[start:end])
+        return (projectedXs, projectedYs)
+
+    def ProjectBatch(self, xs, ys):
+        #
+        # Write the points to an in-memory feature class in the source spatial
+        # reference, and read them back in the target spatial reference.
+        # Rows are read back in ObjectID order, which is the order written.
+        #
+        points = numpy.empty(len(xs), dtype=[('X', numpy.float64), ('Y', numpy.float64)])
+        points['X'] = xs
+        points['Y'] = ys
+        featureClass = r'in_memory\ProjectionService_%s' % threading.current_thread().ident
+        savedTransformations = arcpy.env.geographicTransformations
+        try:
+            arcpy.da.NumPyArrayToFeatureClass(points, featureClass, ['X', 'Y'], self.source)
+            arcpy.env.geographicTransformations = self.transformation
+            projected = arcpy.da.FeatureClassToNumPyArray(featureClass, ['SHAPE@X', 'SHAPE@Y'],
+                                                          spatial_reference=self.target)
+        finally:
+            arcpy.env.geographicTransformations = savedTransformations
+            if arcpy.Exists(featureClass):
+                arcpy.Delete_management(featureClass)
+        assert len(projected) == len(xs), 'Projected %i of %i points' % (len(projected), len(xs))
+        return (projected['SHAPE@X'], projected['SHAPE@Y'])